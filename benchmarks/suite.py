@@ -0,0 +1,383 @@
+"""
+Benchmarks for the sprockets.logging hot paths.
+
+Run the suite from the repository root with the working tree on the
+import path so that the benchmarks measure the code that is checked
+out rather than an installed release::
+
+    PYTHONPATH=. python benchmarks/suite.py
+
+Use ``--save FILE`` to store the results as a baseline and
+``--compare FILE`` to report the change from a saved baseline.
+``benchmarks/baseline.json`` holds reference results along with the
+Python version, Tornado version, platform, and CPU count that they
+were measured on.  Timings only compare meaningfully on the same
+machine, so measure a fresh baseline from the unchanged tree before
+comparing a change::
+
+    git stash
+    PYTHONPATH=. python benchmarks/suite.py --save /tmp/before.json
+    git stash pop
+    PYTHONPATH=. python benchmarks/suite.py --compare /tmp/before.json
+
+Refresh ``benchmarks/baseline.json`` with ``--save`` when a change
+intentionally moves the numbers.
+
+Each micro benchmark is run in batches.  The reported latency
+percentiles are the per-call averages of each batch, ``peak`` is the
+largest amount of memory that tracemalloc saw allocated during a batch
+and ``retained`` is the number of memory blocks per call that were
+still allocated after it.
+
+"""
+import argparse
+import atexit
+import asyncio
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import tornado
+from tornado import httpclient, httpserver, httputil, testing, web
+
+import sprockets.logging
+from sprockets.logging import frames, handlers, rotating
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    def decorator(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return decorator
+
+
+def measure(func, batch_size=1000, batches=50):
+    """Run `func` repeatedly and return its statistics."""
+    for _ in range(batch_size):  # warm caches
+        func()
+    timings = []
+    for _ in range(batches):
+        start = time.perf_counter()
+        for _ in range(batch_size):
+            func()
+        timings.append((time.perf_counter() - start) / batch_size)
+    timings.sort()
+
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    for _ in range(batch_size):
+        func()
+    retained = (sys.getallocatedblocks() - blocks) / float(batch_size)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    total = sum(timings)
+    return {'ops_per_sec': len(timings) / total,
+            'p50_usec': timings[len(timings) // 2] * 1e6,
+            'p90_usec': timings[int(len(timings) * 0.9)] * 1e6,
+            'p99_usec': timings[min(int(len(timings) * 0.99),
+                                    len(timings) - 1)] * 1e6,
+            'peak_bytes': peak,
+            'retained_blocks': retained}
+
+
+def make_record(msg='message', args=(), exc_info=None, **extra):
+    record = logging.LogRecord('benchmark', logging.INFO, __file__, 10,
+                               msg, args, exc_info)
+    record.__dict__.update(extra)
+    return record
+
+
+class StubRequest(object):
+
+    def __init__(self):
+        self.headers = httputil.HTTPHeaders({
+            'Accept': '*/*', 'Host': 'localhost:8000',
+            'User-Agent': 'benchmark/1.0', 'Correlation-ID': 'abc123',
+            'Cookie': 'session=' + 'x' * 512})
+        self.method = 'GET'
+        self.path = '/items/1'
+        self.protocol = 'http'
+        self.query_arguments = {'page': [b'1'], 'sort': [b'name']}
+        self.remote_ip = '127.0.0.1'
+
+    def request_time(self):
+        return 0.0123
+
+
+class StubHandler(object):
+
+    def __init__(self):
+        self.request = StubRequest()
+
+    def get_status(self):
+        return 200
+
+
+class NullStream(object):
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def null_logger(name, formatter=None):
+    logger = logging.getLogger(name)
+    logger.handlers = []
+    handler = logging.StreamHandler(NullStream())
+    handler.setFormatter(formatter or logging.Formatter())
+    logger.addHandler(handler)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    return logger, handler
+
+
+@benchmark('ContextFilter.filter')
+def bench_context_filter():
+    log_filter = sprockets.logging.ContextFilter(
+        properties=['correlation_id', 'user', 'request_id'])
+    record = make_record()
+
+    def run():
+        record.__dict__.pop('correlation_id', None)
+        log_filter.filter(record)
+    return run
+
+
+@benchmark('JSONRequestFormatter.format plain')
+def bench_format_plain():
+    formatter = sprockets.logging.JSONRequestFormatter()
+    record = make_record()
+    return lambda: formatter.format(record)
+
+
+@benchmark('JSONRequestFormatter.format args')
+def bench_format_args():
+    formatter = sprockets.logging.JSONRequestFormatter()
+    record = make_record('user %s fetched %d items in %0.3f ms',
+                         ('someone', 10, 12.5))
+    return lambda: formatter.format(record)
+
+
+@benchmark('JSONRequestFormatter.format exception')
+def bench_format_exception():
+    formatter = sprockets.logging.JSONRequestFormatter()
+    try:
+        raise RuntimeError('failed')
+    except RuntimeError:
+        record = make_record('failed', exc_info=sys.exc_info())
+    return lambda: formatter.format(record)
+
+
+@benchmark('currentframe via findCaller')
+def bench_currentframe():
+    frames.install()
+    logger = logging.getLogger('benchmark')
+    return lambda: logger.findCaller()
+
+
+@benchmark('tornado_log_function')
+def bench_tornado_log_function():
+    null_logger('tornado.access', sprockets.logging.JSONRequestFormatter())
+    handler = StubHandler()
+    return lambda: sprockets.logging.tornado_log_function(handler)
+
+
+@benchmark('tornado_log_function disabled')
+def bench_tornado_log_function_disabled():
+    logger, _ = null_logger('tornado.access',
+                            sprockets.logging.JSONRequestFormatter())
+    logger.setLevel(logging.WARNING)
+    handler = StubHandler()
+    return lambda: sprockets.logging.tornado_log_function(handler)
+
+
+@benchmark('StreamHandler to /dev/null')
+def bench_stream_handler():
+    stream = open(os.devnull, 'w')
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(sprockets.logging.JSONRequestFormatter())
+    record = make_record()
+    return lambda: handler.handle(record)
+
+
+@benchmark('FileDescriptorHandler to /dev/null')
+def bench_file_descriptor_handler():
+    handler = handlers.FileDescriptorHandler(os.devnull)
+    handler.setFormatter(sprockets.logging.JSONRequestFormatter())
+    record = make_record()
+    return lambda: handler.handle(record)
+
+
+@benchmark('CompressedRotatingFileHandler emit')
+def bench_compressed_rotating_file_handler():
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory)
+    handler = rotating.CompressedRotatingFileHandler(
+        directory, max_pending_bytes=1 << 30)
+    handler.setFormatter(sprockets.logging.JSONRequestFormatter())
+    record = make_record()
+    return lambda: handler.handle(record)
+
+
+def measure_file_throughput(create_handler, records=200000):
+    """Return records per second written to disk by a handler.
+
+    The time includes closing the handler so background work is
+    counted.
+
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        handler = create_handler(directory)
+        handler.setFormatter(sprockets.logging.JSONRequestFormatter())
+        record = make_record()
+        start = time.perf_counter()
+        for _ in range(records):
+            handler.handle(record)
+        handler.close()
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(directory)
+    return {'ops_per_sec': records / elapsed}
+
+
+def run_file_throughput():
+    results = {}
+    results['file throughput StreamHandler'] = measure_file_throughput(
+        lambda directory: logging.FileHandler(
+            os.path.join(directory, 'log.ndjson')))
+    for compression in (rotating.GZIP, rotating.ZSTD):
+        if rotating._select_codec(compression) != compression:
+            continue
+        name = 'file throughput compressed {0}'.format(compression)
+        results[name] = measure_file_throughput(
+            lambda directory: rotating.CompressedRotatingFileHandler(
+                directory, compression=compression,
+                max_pending_bytes=1 << 30))
+    return results
+
+
+class BenchmarkHandler(web.RequestHandler):
+
+    def get(self):
+        self.write('ok')
+
+
+def measure_throughput(log_function, requests=2000, concurrency=20):
+    """Return requests per second for a Tornado application."""
+
+    async def run():
+        sock, port = testing.bind_unused_port()
+        app = web.Application([web.url('/', BenchmarkHandler)],
+                              log_function=log_function)
+        server = httpserver.HTTPServer(app)
+        server.add_sockets([sock])
+        client = httpclient.AsyncHTTPClient(force_instance=True,
+                                            max_clients=concurrency)
+        url = 'http://127.0.0.1:{0}/'.format(port)
+
+        async def worker(count):
+            for _ in range(count):
+                await client.fetch(url)
+
+        async def fetch_all():
+            await asyncio.gather(*[worker(requests // concurrency)
+                                   for _ in range(concurrency)])
+
+        await fetch_all()  # warm up the connections
+        start = time.perf_counter()
+        await fetch_all()
+        elapsed = time.perf_counter() - start
+        server.stop()
+        client.close()
+        return {'ops_per_sec': requests / elapsed}
+
+    return asyncio.run(run())
+
+
+def run_throughput():
+    results = {}
+    results['tornado requests logging off'] = measure_throughput(
+        lambda handler: None)
+    null_logger('tornado.access', sprockets.logging.JSONRequestFormatter())
+    results['tornado requests logging on'] = measure_throughput(
+        sprockets.logging.tornado_log_function)
+    return results
+
+
+def report(results, baseline=None):
+    header = '{0:<40} {1:>12} {2:>10} {3:>10} {4:>10} {5:>10} {6:>9}'
+    print(header.format('benchmark', 'ops/sec', 'p50 usec', 'p99 usec',
+                        'peak B', 'retained', 'change'))
+    for name in sorted(results):
+        result = results[name]
+        change = ''
+        if baseline and name in baseline:
+            ratio = result['ops_per_sec'] / baseline[name]['ops_per_sec']
+            change = '{0:+.1%}'.format(ratio - 1)
+        print('{0:<40} {1:>12.0f} {2:>10} {3:>10} {4:>10} {5:>10} {6:>9}'
+              .format(name, result['ops_per_sec'],
+                      _fmt(result.get('p50_usec'), '.2f'),
+                      _fmt(result.get('p99_usec'), '.2f'),
+                      _fmt(result.get('peak_bytes'), 'd'),
+                      _fmt(result.get('retained_blocks'), '.2f'),
+                      change))
+
+
+def _fmt(value, spec):
+    return '-' if value is None else format(value, spec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with a saved baseline')
+    parser.add_argument('--filter', default='',
+                        help='only run benchmarks containing this text')
+    parser.add_argument('--no-throughput', action='store_true',
+                        help='skip the end-to-end Tornado benchmark')
+    options = parser.parse_args()
+
+    results = {}
+    for name, factory in BENCHMARKS:
+        if options.filter in name:
+            results[name] = measure(factory())
+    frames.uninstall()
+    if not options.no_throughput and options.filter in 'tornado requests':
+        results.update(run_throughput())
+    if not options.no_throughput and options.filter in 'file throughput':
+        results.update(run_file_throughput())
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as handle:
+            baseline = json.load(handle)['results']
+    report(results, baseline)
+
+    if options.save:
+        with open(options.save, 'w') as handle:
+            json.dump({'python': '{0} {1}'.format(
+                           platform.python_implementation(),
+                           platform.python_version()),
+                       'tornado': tornado.version,
+                       'platform': platform.platform(),
+                       'machine': platform.machine(),
+                       'cpus': os.cpu_count(),
+                       'results': results}, handle, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
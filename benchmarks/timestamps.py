@@ -0,0 +1,35 @@
+"""
+Compare the cost of rendering JSONRequestFormatter timestamps.
+
+Run from the repository root with the working tree on the import
+path::
+
+    PYTHONPATH=. python benchmarks/timestamps.py
+
+"""
+import logging
+import time
+import timeit
+
+from sprockets.logging import timestamps
+
+
+def main(number=200000):
+    formatter = logging.Formatter()
+    record = logging.makeLogRecord({'msg': 'message'})
+    renderers = [
+        ('Formatter.formatTime', formatter.formatTime),
+        ('local (cached)', timestamps.get_renderer('local', formatter)),
+        ('rfc3339 (cached)', timestamps.get_renderer('rfc3339', formatter)),
+        ('epoch', timestamps.get_renderer('epoch', formatter)),
+    ]
+    record.created = time.time()
+    for name, renderer in renderers:
+        elapsed = min(timeit.repeat(lambda: renderer(record),
+                                    number=number, repeat=3))
+        print('{0:<24} {1:8.3f} usec/record'.format(
+            name, elapsed / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -49,9 +49,8 @@ class RequestHandler(web.RequestHandler):
 
    def prepare(self):
       uniq_id = self.request.headers.get('X-UniqID', uuid.uuid4().hex)
-      self.logger = logging.LoggerAdapter(
-         self.parent_log.getChild('RequestHandler'),
-         extra={'context': uniq_id})
+      sprockets.logging.context.bind(context=uniq_id)
+      self.logger = self.parent_log.getChild('RequestHandler')
 
    def get(self, object_id):
       self.logger.debug('fetchin %s', object_id)
@@ -48,9 +48,8 @@ class RequestHandler(web.RequestHandler):
 
    def prepare(self):
       uniq_id = self.request.headers.get('X-UniqID', uuid.uuid4().hex)
-      self.logger = logging.LoggerAdapter(
-         self.parent_log.getChild('RequestHandler'),
-         extra={'context': uniq_id})
+      sprockets.logging.context.bind(context=uniq_id)
+      self.logger = self.parent_log.getChild('RequestHandler')
 
    def get(self, object_id):
       self.logger.debug('fetchin %s', object_id)
@@ -64,6 +63,7 @@ def sig_handler(signo, frame):
 
 if __name__ == '__main__':
    logging.config.dictConfig(LOG_CONFIG)
+   sprockets.logging.frames.install()
    logger = logging.getLogger('app')
    app = web.Application([
       web.url('/(?P<object_id>\w+)', RequestHandler,
@@ -20,7 +20,8 @@ setuptools.setup(
     author='Dave Shawley',
     author_email='daves@aweber.com',
     license='BSD',
-    extras_require={'tornado': ['tornado>3,<5']},
+    extras_require={'tornado': ['tornado>3,<5'],
+                    'ujson': ['ujson>=5.4']},
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Developers',
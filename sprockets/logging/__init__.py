@@ -6,28 +6,35 @@ Make good log output easier.
 - :method:`tornado_log_function` is for use as the
     :class`tornado.web.Application.log_function` in conjunction with
     :class:`JSONRequestFormatter` to output log lines as JSON.
+- :class:`AccessLogFunction` is a configurable version of
+    :func:`tornado_log_function` that supports sampling
+- :class:`AccessLogPayload` builds an access log line only when it
+    will be logged
+- :class:`QueueHandler` writes log records from a background thread
+- :func:`sprockets.logging.frames.install` makes log records report the
+    caller of :func:`tornado_log_function` and other logging wrappers
+- :func:`sprockets.logging.stats.snapshot` reports statistics about the
+    logging pipeline itself
+- :func:`configure` sets up the standard logging pipeline
+
+Importing this package does not import :mod:`tornado`, :mod:`json`, or
+the handler modules.  They are imported when they are first used.
 
 """
 from __future__ import absolute_import
 
-from logging import config
-import json
+import collections
+import importlib
 import logging
 import os
 import sys
-import traceback
 
-try:
-    from tornado import escape, log
-except ImportError:  # pragma no cover
-    escape = None
-    log = None
+from sprockets.logging import context, frames, stats
 
 version_info = (1, 3, 2)
 __version__ = '.'.join(str(v) for v in version_info)
 
 # Shortcut methods and constants to avoid needing to import logging directly
-dictConfig = config.dictConfig
 getLogger = logging.getLogger
 
 DEBUG = logging.DEBUG
@@ -36,6 +43,20 @@ WARN = logging.WARN
 WARNING = logging.WARNING
 ERROR = logging.ERROR
 
+# attributes that are imported on first use by __getattr__
+_LAZY_ATTRIBUTES = {
+    'BinaryStreamHandler': 'sprockets.logging.handlers',
+    'QueueHandler': 'sprockets.logging.handlers',
+    'SamplingPolicy': 'sprockets.logging.sampling',
+    'dictConfig': 'logging.config',
+}
+_SUBMODULES = ('buffering', 'dedup', 'encoders', 'funnel', 'handlers',
+               'metrics', 'profiling', 'redaction', 'ringbuffer', 'rotating',
+               'sampling', 'shipping', 'timestamps', 'timing',
+               'tracebacks')
+
+_access_log = logging.getLogger('tornado.access')
+
 
 class ContextFilter(logging.Filter):
     """
@@ -50,6 +71,14 @@ class ContextFilter(logging.Filter):
     to a property that is not explicitly passed in will result in an
     ugly ``KeyError`` exception.
 
+    Missing properties are taken from the active
+    :mod:`sprockets.logging.context` and are set to :data:`None` if the
+    context does not contain them.  Values that were passed in ``extra``
+    or by a :class:`logging.LoggerAdapter` take precedence.
+
+    The number of records that pass through the filter is counted in
+    :data:`sprockets.logging.stats.STATS`.
+
     """
 
     def __init__(self, name='', properties=None):
@@ -57,18 +86,215 @@ class ContextFilter(logging.Filter):
         self.properties = list(properties) if properties else []
 
     def filter(self, record):
+        attributes = record.__dict__
+        values = context.get()
         for property_name in self.properties:
-            if not hasattr(record, property_name):
-                setattr(record, property_name, None)
+            if property_name not in attributes:
+                attributes[property_name] = values.get(property_name)
+        stats.STATS.filtered += 1
         return True
 
 
+class Field(object):
+    """Describes a value that :class:`JSONRequestFormatter` emits.
+
+    :param str key: the key in the JSON output
+    :param str attribute: the :class:`logging.LogRecord` attribute to
+        read.  This defaults to `key`.
+    :param bool drop_empty: omit the key when the value is empty?
+
+    The attributes in :data:`JSONRequestFormatter.STANDARD_FIELDS` are
+    computed from the record instead of being read from it directly.
+
+    """
+
+    def __init__(self, key, attribute=None, drop_empty=True):
+        self.key = key
+        self.attribute = attribute or key
+        self.drop_empty = drop_empty
+
+    @classmethod
+    def create(cls, spec):
+        """Create a field from a name, dictionary, or :class:`Field`."""
+        if isinstance(spec, Field):
+            return spec
+        if isinstance(spec, dict):
+            return cls(**spec)
+        return cls(spec)
+
+    def __repr__(self):
+        return '<{0} {1}={2}>'.format(self.__class__.__name__, self.key,
+                                      self.attribute)
+
+
 class JSONRequestFormatter(logging.Formatter):
     """Instead of spitting out a "human readable" log line, this outputs
     the log data as JSON.
 
+    :param str fmt: passed to :class:`logging.Formatter`
+    :param str datefmt: the :func:`time.strftime` format of ``local``
+        timestamps
+    :param str style: passed to :class:`logging.Formatter`
+    :param bool validate: passed to :class:`logging.Formatter`
+    :param dict defaults: passed to :class:`logging.Formatter`
+
+    The remaining options must be passed as keyword arguments:
+
+    :param str encoder: the JSON encoder backend to use.  This is
+        ``json`` for the standard library, ``ujson``, or ``auto`` to
+        use the fastest installed backend.  See
+        :mod:`sprockets.logging.encoders` for details.
+    :param list fields: the fields to emit in order.  Each entry is a
+        key name, a dictionary of :class:`Field` arguments, or a
+        :class:`Field` instance.  This defaults to
+        :data:`DEFAULT_FIELDS`.
+    :param list properties: additional record attributes to emit as
+        top-level keys, such as the properties that a
+        :class:`ContextFilter` adds
+    :param str timestamp_format: how to render the ``timestamp`` field.
+        This is ``local`` for the :meth:`~logging.Formatter.formatTime`
+        format, ``rfc3339`` for UTC times, or ``epoch`` for seconds
+        since the epoch.  See :mod:`sprockets.logging.timestamps`.
+    :param int traceback_depth: the maximum number of stack frames to
+        include in the ``traceback`` field
+    :param bool traceback_source: include source lines in the
+        ``traceback`` field?
+    :param bool traceback_chain: include chained exceptions in the
+        ``traceback`` field?
+    :param bool collect_stats: count records, formatting time, and
+        failures in :data:`sprockets.logging.stats.STATS`?
+
+    The fields are compiled into a list of accessors when the formatter
+    is created so that formatting a record only reads the values that
+    are emitted.
+
+    The ``request`` field holds the record's arguments and is only
+    emitted when the ``message`` field is not, regardless of the order
+    of the fields.
+
+    If the encoder cannot serialize a value, the failure is counted and
+    values that are not strings, numbers, lists, or dictionaries are
+    replaced with their string form so that the record is not lost.
+
     """
 
+    STANDARD_FIELDS = ('file', 'level', 'line_number', 'message', 'module',
+                       'name', 'process', 'request', 'thread', 'timestamp',
+                       'traceback')
+    DEFAULT_FIELDS = ('name', 'module', 'message', 'level', 'line_number',
+                      'process', 'timestamp', 'thread', 'file', 'request',
+                      'traceback')
+
+    #: the keyword-only options and their defaults
+    OPTIONS = {'encoder': 'json', 'fields': None, 'properties': None,
+               'timestamp_format': 'local', 'traceback_depth': None,
+               'traceback_source': True, 'traceback_chain': True,
+               'collect_stats': True}
+
+    def __init__(self, fmt=None, datefmt=None, style='%', validate=True,
+                 defaults=None, **options):
+        from sprockets.logging import encoders, timestamps, tracebacks
+        unknown = set(options).difference(self.OPTIONS)
+        if unknown:
+            raise TypeError('unexpected keyword arguments: {0}'.format(
+                ', '.join(sorted(unknown))))
+        settings = dict(self.OPTIONS)
+        settings.update(options)
+
+        # only pass what the running version of logging needs to know
+        # about so that the defaults work with every version
+        args = [fmt, datefmt]
+        if style != '%' or not validate:
+            args.append(style)
+        if not validate:
+            args.append(validate)
+        kwargs = {'defaults': defaults} if defaults is not None else {}
+        logging.Formatter.__init__(self, *args, **kwargs)
+
+        self.stats = stats.STATS if settings['collect_stats'] else None
+        self.encoder = encoders.get_encoder(settings['encoder'])
+        self.exception_serializer = tracebacks.ExceptionSerializer(
+            settings['traceback_depth'], settings['traceback_source'],
+            settings['traceback_chain'])
+        if type(self).formatTime is not logging.Formatter.formatTime:
+            self._render_timestamp = self.formatTime
+        else:
+            self._render_timestamp = timestamps.get_renderer(
+                settings['timestamp_format'], self)
+        self.fields = [Field.create(spec)
+                       for spec in (settings['fields'] or self.DEFAULT_FIELDS)]
+        self.fields.extend(Field(name)
+                           for name in settings['properties'] or [])
+        self._accessors = self._compile(self.fields)
+
+    def _compile(self, fields):
+        accessors = []
+        self._message_field = None
+        for field in fields:
+            if field.attribute == 'message':
+                self._message_field = field
+            if field.attribute in self.STANDARD_FIELDS:
+                getter = getattr(self, '_get_' + field.attribute)
+            else:
+                getter = self._make_getter(field.attribute)
+            accessors.append((field.key, getter, field.drop_empty))
+        return tuple(accessors)
+
+    @staticmethod
+    def _make_getter(attribute):
+        def getter(record, output):
+            return getattr(record, attribute, None)
+        return getter
+
+    def _get_file(self, record, output):
+        return record.filename
+
+    def _get_level(self, record, output):
+        return logging.getLevelName(record.levelno)
+
+    def _get_line_number(self, record, output):
+        return record.lineno
+
+    def _get_message(self, record, output):
+        return record.getMessage()
+
+    def _get_module(self, record, output):
+        return record.module
+
+    def _get_name(self, record, output):
+        return record.name
+
+    def _get_process(self, record, output):
+        return record.processName
+
+    def _get_request(self, record, output):
+        message = self._message_field
+        if message is not None:
+            # the message is only computed again when it comes later
+            if message.key in output or not message.drop_empty or \
+                    record.getMessage():
+                return None
+        return record.args
+
+    def _get_thread(self, record, output):
+        return record.threadName
+
+    def _get_timestamp(self, record, output):
+        return self._render_timestamp(record)
+
+    def _get_traceback(self, record, output):
+        exc_record = getattr(record, 'exc_record', None)
+        if exc_record is not None:
+            return exc_record
+        if not record.exc_info or record.exc_info[0] is None:
+            return None
+        try:
+            return self.extract_exc_record(*record.exc_info)
+        except Exception:
+            if self.stats is not None:
+                self.stats.traceback_failures += 1
+            return None
+
     def extract_exc_record(self, typ, val, tb):
         """Create a JSON representation of the traceback given the records
         exc_info
@@ -79,16 +305,11 @@ class JSONRequestFormatter(logging.Formatter):
 
         :rtype: dict
 
+        See :class:`sprockets.logging.tracebacks.ExceptionSerializer`
+        for the details.
+
         """
-        exc_record = {'type': typ.__name__,
-                      'message': str(val),
-                      'stack': []}
-        for file_name, line_no, func_name, txt in traceback.extract_tb(tb):
-            exc_record['stack'].append({'file': file_name,
-                                        'line': str(line_no),
-                                        'func': func_name,
-                                        'text': txt})
-        return exc_record
+        return self.exception_serializer(typ, val, tb)
 
     def format(self, record):
         """Return the log data as JSON
@@ -97,29 +318,46 @@ class JSONRequestFormatter(logging.Formatter):
         :rtype: str
 
         """
-        if hasattr(record, 'exc_info'):
-            try:
-                traceback = self.extract_exc_record(*record.exc_info)
-            except:
-                traceback = None
-
-        output = {'name': record.name,
-                  'module': record.module,
-                  'message': record.msg % record.args,
-                  'level': logging.getLevelName(record.levelno),
-                  'line_number': record.lineno,
-                  'process': record.processName,
-                  'timestamp': self.formatTime(record),
-                  'thread': record.threadName,
-                  'file': record.filename,
-                  'request': record.args,
-                  'traceback': traceback}
-        for key, value in list(output.items()):
-            if not value:
-                del output[key]
-        if 'message' in output:
-            output.pop('request', None)
-        return json.dumps(output)
+        return self._encode(self.encoder.dumps, record)
+
+    def format_bytes(self, record):
+        """Return the log data as JSON encoded bytes
+
+        :param record logging.LogRecord: The record to format
+        :rtype: bytes
+
+        """
+        return self._encode(self.encoder.dumps_bytes, record)
+
+    def _encode(self, dumps, record):
+        if self.stats is None:
+            return self._dumps(dumps, self.get_output(record))
+        start = stats.clock()
+        data = self._dumps(dumps, self.get_output(record))
+        self.stats.record_formatted(record.levelname, stats.clock() - start)
+        return data
+
+    def _dumps(self, dumps, output):
+        try:
+            return dumps(output)
+        except (TypeError, ValueError, OverflowError):
+            if self.stats is not None:
+                self.stats.encoder_failures += 1
+            return dumps(_make_safe(output))
+
+    def get_output(self, record):
+        """Return the values to serialize for a log record
+
+        :param record logging.LogRecord: The record to format
+        :rtype: dict
+
+        """
+        output = {}
+        for key, getter, drop_empty in self._accessors:
+            value = getter(record, output)
+            if value or not drop_empty:
+                output[key] = value
+        return output
 
 
 def tornado_log_function(handler):
@@ -133,45 +371,372 @@ def tornado_log_function(handler):
 
     :type handler: :py:class:`tornado.web.RequestHandler`
 
+    Records held for the request by
+    :class:`~sprockets.logging.buffering.RequestBufferMixin` are flushed
+    before the access log line or discarded.  The payload is only built
+    when ``tornado.access`` is enabled for the request's level, and the
+    ``ENVIRONMENT`` environment variable is read once on the first call.
+
     """
     status_code = handler.get_status()
-    if status_code < 400:
-        log_method = log.access_log.info
-    elif status_code < 500:
-        log_method = log.access_log.warning
+    duration = 1000.0 * handler.request.request_time()
+    _finish_request(handler, status_code, duration)
+    AccessLogPayload(handler, status_code, duration,
+                     environment=_get_environment()).log(_access_log)
+
+
+class AccessLogFunction(object):
+    """Configurable version of :func:`tornado_log_function`.
+
+    :param sampling: optional
+        :class:`~sprockets.logging.sampling.SamplingPolicy` that selects
+        which requests are logged
+    :param list header_allowlist: if set, only these headers are logged
+    :param list header_denylist: headers that are never logged
+    :param list redact_headers: headers that are logged with their value
+        replaced.  :data:`sprockets.logging.redaction.SENSITIVE_HEADERS`
+        is a good place to start.
+    :param list query_allowlist: if set, only these query arguments
+        are logged
+    :param list query_denylist: query arguments that are never logged
+    :param list redact_query_args: query arguments that are logged with
+        their value replaced
+    :param int max_value_length: header and query argument values that
+        are longer than this are truncated
+
+    Instances are passed as the ``log_function`` argument when creating
+    a :py:class:`tornado.web.Application`:
+
+    .. code:: python
+
+        log_function = AccessLogFunction(
+            sampling=SamplingPolicy(status_rates={'2xx': 0.1}))
+        app = tornado.web.Application([('/', RequestHandler)],
+                                      log_function=log_function)
+
+    When a sampling policy is used, each line includes ``sample_rate``
+    and, if the route is rate limited, ``rate_limited`` is the number of
+    sampled requests that were suppressed since the previous line.  A
+    line therefore stands for ``(1 + rate_limited) / sample_rate``
+    requests.
+
+    The ``ENVIRONMENT`` environment variable is read when the instance
+    is created.
+
+    """
+
+    def __init__(self, sampling=None, header_allowlist=None,
+                 header_denylist=None, redact_headers=None,
+                 query_allowlist=None, query_denylist=None,
+                 redact_query_args=None, max_value_length=None):
+        from sprockets.logging import redaction
+        self.sampling = sampling
+        self.environment = os.environ.get('ENVIRONMENT')
+        self.header_selector = self.query_selector = None
+        if (header_allowlist is not None or header_denylist or
+                redact_headers or max_value_length is not None):
+            self.header_selector = redaction.FieldSelector(
+                header_allowlist, header_denylist, redact_headers,
+                max_value_length)
+        if (query_allowlist is not None or query_denylist or
+                redact_query_args or max_value_length is not None):
+            self.query_selector = redaction.FieldSelector(
+                query_allowlist, query_denylist, redact_query_args,
+                max_value_length)
+
+    def __call__(self, handler):
+        status_code = handler.get_status()
+        duration = 1000.0 * handler.request.request_time()
+        _finish_request(handler, status_code, duration)
+        payload = AccessLogPayload(handler, status_code, duration,
+                                   self.header_selector, self.query_selector,
+                                   self.environment)
+        if not payload.is_enabled(_access_log):
+            return
+        extra = {}
+        if self.sampling is not None:
+            decision = self.sampling.sample(status_code,
+                                            handler.request.path, duration)
+            if decision is None:
+                return
+            extra['sample_rate'], suppressed = decision
+            if suppressed:
+                extra['rate_limited'] = suppressed
+        payload.log(_access_log, **extra)
+
+
+class AccessLogPayload(object):
+    """The access log line for a finished request.
+
+    :param tornado.web.RequestHandler handler: the request handler
+    :param int status_code: the response status code
+    :param float duration: the request duration in milliseconds
+    :param header_selector: optional
+        :class:`~sprockets.logging.redaction.FieldSelector` for the
+        request headers
+    :param query_selector: optional
+        :class:`~sprockets.logging.redaction.FieldSelector` for the
+        query arguments
+    :param str environment: the value of the ``environment`` key
+
+    Creating the payload only stores its arguments.  The headers and
+    query arguments are copied when :meth:`as_dict` is called, which
+    :meth:`log` only does if the logger is enabled for :attr:`level`.
+
+    If the request handler has a ``get_access_log_fields`` method, the
+    dictionary that it returns is added to the payload.  Mixins such as
+    :class:`~sprockets.logging.timing.RequestTimingMixin` use this to
+    add their own keys.
+
+    """
+
+    __slots__ = ('handler', 'status_code', 'duration', 'header_selector',
+                 'query_selector', 'environment', 'level')
+
+    def __init__(self, handler, status_code, duration, header_selector=None,
+                 query_selector=None, environment=None):
+        self.handler = handler
+        self.status_code = status_code
+        self.duration = duration
+        self.header_selector = header_selector
+        self.query_selector = query_selector
+        self.environment = environment
+        if status_code < 400:
+            self.level = logging.INFO
+        elif status_code < 500:
+            self.level = logging.WARNING
+        else:
+            self.level = logging.ERROR
+
+    def is_enabled(self, logger):
+        """Will `logger` log the payload?"""
+        return logger.isEnabledFor(self.level)
+
+    def as_dict(self):
+        """Return the payload as a JSON-ready dictionary."""
+        from tornado import escape
+        handler, request = self.handler, self.handler.request
+        correlation_id = (getattr(handler, 'correlation_id', None) or
+                          request.headers.get('Correlation-ID', None))
+        if self.header_selector is None:
+            headers = dict(request.headers)
+        else:
+            headers = self.header_selector.select(request.headers)
+        if self.query_selector is None:
+            query_args = escape.recursive_unicode(request.query_arguments)
+        else:
+            query_args = self.query_selector.select(
+                request.query_arguments, escape.recursive_unicode)
+        payload = {'correlation_id': correlation_id,
+                   'duration': self.duration,
+                   'headers': headers,
+                   'method': request.method,
+                   'path': request.path,
+                   'protocol': request.protocol,
+                   'query_args': query_args,
+                   'remote_ip': request.remote_ip,
+                   'status_code': self.status_code,
+                   'environment': self.environment}
+        get_fields = getattr(handler, 'get_access_log_fields', None)
+        if get_fields is not None:
+            payload.update(get_fields())
+        return payload
+
+    def log(self, logger, **extra):
+        """Log the payload if `logger` is enabled for its level.
+
+        :param logging.Logger logger: the logger to write to
+        :param extra: additional keys to add to the payload
+        :returns: was the payload logged?
+        :rtype: bool
+
+        """
+        if not logger.isEnabledFor(self.level):
+            return False
+        payload = self.as_dict()
+        payload.update(extra)
+        logger.log(self.level, '', payload)
+        return True
+
+
+def _make_safe(value):
+    """Replace values that an encoder may reject with strings."""
+    if isinstance(value, dict):
+        return dict((str(key), _make_safe(item))
+                    for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_make_safe(item) for item in value]
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, (int, float)) and abs(value) < 2 ** 63:
+        return value
+    return str(value)
+
+
+def _finish_request(handler, status_code, duration):
+    # only handlers that use RequestBufferMixin have a log buffer
+    if getattr(handler, 'log_buffer', None) is not None:
+        from sprockets.logging import buffering
+        buffering.finish_request(handler, status_code, duration)
+
+
+_environment = []
+
+
+def _get_environment():
+    """Return the ``ENVIRONMENT`` variable as of the first call."""
+    if not _environment:
+        _environment.append(os.environ.get('ENVIRONMENT'))
+    return _environment[0]
+
+
+#: the objects that :func:`configure` created
+Pipeline = collections.namedtuple(
+    'Pipeline', ['filter', 'formatter', 'handler', 'log_function'])
+
+_CONFIGURE_DEFAULTS = {
+    'access_log': None,
+    'encoder': 'json',
+    'find_caller': True,
+    'format': 'json',
+    'handler': 'stream',
+    'level': 'INFO',
+    'levels': None,
+    'properties': None,
+    'queue': None,
+    'stream': 'stderr',
+    'timestamp_format': 'local',
+}
+_configured_handlers = []
+
+
+def configure(spec=None, **options):
+    """Set up the root logger with the standard logging pipeline.
+
+    :param dict spec: the configuration.  Keyword arguments override the
+        values in `spec`.
+    :rtype: Pipeline
+    :raises ValueError: if the configuration contains an unknown key
+
+    This is a shortcut for the common :func:`logging.config.dictConfig`
+    document.  It creates a :class:`ContextFilter`, a formatter, and a
+    handler, attaches them to the root logger, and returns them along
+    with an access log function for :class:`tornado.web.Application`:
+
+    .. code:: python
+
+        pipeline = sprockets.logging.configure(
+            level='INFO', properties=['correlation_id'],
+            access_log={'sampling': {'status_rates': {'2xx': 0.1}}})
+        app = web.Application(routes, log_function=pipeline.log_function)
+
+    The configuration keys are:
+
+    - ``level``: the root logger level.  Defaults to ``INFO``.
+    - ``levels``: a dictionary of logger names to levels
+    - ``format``: ``json`` for :class:`JSONRequestFormatter` or a
+      :class:`logging.Formatter` format string.  Defaults to ``json``.
+    - ``encoder`` and ``timestamp_format``: passed to
+      :class:`JSONRequestFormatter`
+    - ``find_caller``: passed to :func:`sprockets.logging.frames.install`,
+      which is always called so records are attributed to the caller of
+      logging wrappers.  Set this to :data:`False` to skip the caller
+      lookup when the output does not include the module, line number,
+      or file.  Defaults to :data:`True`.
+    - ``properties``: context properties that the filter adds to every
+      record and the JSON formatter emits
+    - ``stream``: ``stdout``, ``stderr``, or a file-like object.
+      Defaults to ``stderr``.
+    - ``handler``: ``stream`` for :class:`logging.StreamHandler`,
+      ``binary`` for :class:`BinaryStreamHandler`, or ``queue`` for
+      :class:`QueueHandler`.  Defaults to ``stream``.
+    - ``queue``: keyword arguments for :class:`QueueHandler`
+    - ``access_log``: keyword arguments for :class:`AccessLogFunction`.
+      ``sampling`` may be a dictionary of
+      :class:`~sprockets.logging.sampling.SamplingPolicy` arguments.
+      If this is not set, the log function is
+      :func:`tornado_log_function`.
+
+    Calling this again replaces the handler that the previous call
+    installed.  Other handlers on the root logger are left alone.
+
+    """
+    settings = dict(_CONFIGURE_DEFAULTS)
+    unknown = set(spec or {}).union(options).difference(settings)
+    if unknown:
+        raise ValueError('unknown configuration keys: {0}'.format(
+            ', '.join(sorted(unknown))))
+    settings.update(spec or {})
+    settings.update(options)
+
+    properties = list(settings['properties'] or [])
+    log_filter = ContextFilter(properties=properties)
+    if settings['format'] == 'json':
+        formatter = JSONRequestFormatter(
+            encoder=settings['encoder'], properties=properties,
+            timestamp_format=settings['timestamp_format'])
+    else:
+        formatter = logging.Formatter(settings['format'])
+
+    stream = settings['stream']
+    if stream in ('stdout', 'stderr'):
+        stream = getattr(sys, stream)
+    if settings['handler'] == 'stream':
+        handler = logging.StreamHandler(stream)
+    elif settings['handler'] == 'binary':
+        from sprockets.logging.handlers import BinaryStreamHandler
+        handler = BinaryStreamHandler(stream)
+    elif settings['handler'] == 'queue':
+        from sprockets.logging.handlers import QueueHandler
+        handler = QueueHandler(stream=stream, **(settings['queue'] or {}))
     else:
-        log_method = log.access_log.error
-    correlation_id = (getattr(handler, 'correlation_id', None) or
-                      handler.request.headers.get('Correlation-ID', None))
-    log_method('', {'correlation_id': correlation_id,
-                    'duration': 1000.0 * handler.request.request_time(),
-                    'headers': dict(handler.request.headers),
-                    'method': handler.request.method,
-                    'path': handler.request.path,
-                    'protocol': handler.request.protocol,
-                    'query_args': escape.recursive_unicode(
-                        handler.request.query_arguments),
-                    'remote_ip': handler.request.remote_ip,
-                    'status_code': status_code,
-                    'environment': os.environ.get('ENVIRONMENT')})
-
-
-def currentframe():
-    """Return the frame object for the caller's stack frame."""
-    try:
-        raise Exception
-    except:
-        traceback = sys.exc_info()[2]
-        frame = traceback.tb_frame
-        while True:
-            if hasattr(frame, 'f_code'):
-                filename = frame.f_code.co_filename
-                if filename.endswith('logging.py') or \
-                        filename.endswith('logging/__init__.py'):
-                    frame = frame.f_back
-                    continue
-                return frame
-        return traceback.tb_frame.f_back
-
-# Monkey-patch currentframe
-logging.currentframe = currentframe
+        raise ValueError('unknown handler {0!r}'.format(settings['handler']))
+    handler.addFilter(log_filter)
+    handler.setFormatter(formatter)
+
+    access_log = dict(settings['access_log'] or {})
+    if access_log:
+        if isinstance(access_log.get('sampling'), dict):
+            from sprockets.logging.sampling import SamplingPolicy
+            access_log['sampling'] = SamplingPolicy(**access_log['sampling'])
+        log_function = AccessLogFunction(**access_log)
+    else:
+        log_function = tornado_log_function
+
+    frames.install(find_caller=settings['find_caller'])
+    root = logging.getLogger()
+    while _configured_handlers:
+        previous = _configured_handlers.pop()
+        root.removeHandler(previous)
+        previous.close()
+    root.addHandler(handler)
+    _configured_handlers.append(handler)
+    root.setLevel(settings['level'])
+    for name, level in (settings['levels'] or {}).items():
+        logging.getLogger(name).setLevel(level)
+    return Pipeline(log_filter, formatter, handler, log_function)
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module('{0}.{1}'.format(__name__, name))
+    else:
+        raise AttributeError('module {0!r} has no attribute {1!r}'.format(
+            __name__, name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()).union(_LAZY_ATTRIBUTES, _SUBMODULES))
+
+
+if sys.version_info < (3, 7):  # pragma no cover -- no module __getattr__
+    for _name in list(_LAZY_ATTRIBUTES) + list(_SUBMODULES):
+        __getattr__(_name)
+
+
+currentframe = frames.currentframe
+frames.skip_file(tornado_log_function.__code__.co_filename)
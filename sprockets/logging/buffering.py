@@ -0,0 +1,254 @@
+"""
+Hold a request's debug records until it is known whether they are needed.
+
+- :class:`RequestBufferMixin` opens a buffer for each request that a
+    Tornado request handler processes
+- :class:`RequestBufferHandler` holds records that are logged while a
+    buffer is open and passes the others to its target handler
+- :class:`RequestBuffers` limits the number and size of the open buffers
+
+When :func:`~sprockets.logging.tornado_log_function` or
+:class:`~sprockets.logging.AccessLogFunction` logs a request that failed
+with a server error or was slow, the buffered records are written out
+before the access log line.  Otherwise they are discarded, so DEBUG
+records only cost an append to an in-memory list.
+
+.. code:: python
+
+    class RequestHandler(RequestBufferMixin, web.RequestHandler):
+        log_buffer_slow_threshold = 500
+
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    logging.getLogger().addHandler(RequestBufferHandler(console))
+    logging.getLogger().setLevel(logging.DEBUG)
+
+"""
+from __future__ import absolute_import
+
+import collections
+import itertools
+import logging
+import uuid
+
+from sprockets.logging import context
+from sprockets.logging.handlers import _resolve_handler
+
+#: the context key that holds the active request's buffer key
+CONTEXT_KEY = 'log_buffer_key'
+
+_keys = itertools.count(1)
+
+
+class RequestBuffer(object):
+    """The records that were held for one request.
+
+    :param RequestBuffers buffers: the registry that owns the buffer
+    :param key: the key that identifies the request's buffer
+    :param int capacity: the maximum number of records to hold.  The
+        oldest records are discarded and counted in :attr:`dropped` once
+        the buffer is full.
+    :param str label: describes the request, usually its correlation ID
+
+    """
+
+    __slots__ = ('buffers', 'key', 'label', 'records', 'dropped')
+
+    def __init__(self, buffers, key, capacity, label=None):
+        self.buffers = buffers
+        self.key = key
+        self.label = label
+        self.records = collections.deque(maxlen=capacity)
+        self.dropped = 0
+
+    def append(self, target, record):
+        """Hold a record for `target`."""
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append((target, record))
+
+    def flush(self):
+        """Pass the held records to their targets and close the buffer."""
+        self.buffers.close(self)
+        while self.records:
+            target, record = self.records.popleft()
+            target.handle(record)
+
+    def discard(self):
+        """Drop the held records and close the buffer."""
+        self.buffers.close(self)
+        self.records.clear()
+
+
+class RequestBuffers(object):
+    """The open request buffers keyed by a unique key per request.
+
+    :param int capacity: the maximum number of records held per request
+    :param int max_requests: the maximum number of open buffers.  When a
+        buffer is opened beyond this, the oldest one is discarded and
+        counted in :attr:`evicted`.
+
+    """
+
+    def __init__(self, capacity=500, max_requests=1000):
+        self.capacity = capacity
+        self.max_requests = max_requests
+        self.evicted = 0
+        self._buffers = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def open(self, key=None, label=None):
+        """Open a buffer for a request.
+
+        :param key: the key to open the buffer under.  A key that is
+            unique in the process is generated by default.  Opening a
+            key that is already open replaces its buffer.
+        :param str label: describes the request, usually its correlation
+            ID.  Requests that share a correlation ID still get their
+            own buffers.
+        :rtype: RequestBuffer
+
+        """
+        if key is None:
+            key = next(_keys)
+        buffer = RequestBuffer(self, key, self.capacity, label)
+        self._buffers.pop(key, None)
+        self._buffers[key] = buffer
+        while len(self._buffers) > self.max_requests:
+            _, oldest = self._buffers.popitem(last=False)
+            oldest.records.clear()
+            self.evicted += 1
+        return buffer
+
+    def get(self, key):
+        """Return the open buffer for `key` or :data:`None`."""
+        return self._buffers.get(key)
+
+    def close(self, buffer):
+        """Stop routing records to `buffer`."""
+        if self._buffers.get(buffer.key) is buffer:
+            del self._buffers[buffer.key]
+
+
+#: the buffers that :class:`RequestBufferMixin` and
+#: :class:`RequestBufferHandler` use by default
+BUFFERS = RequestBuffers()
+
+
+class RequestBufferHandler(logging.Handler):
+    """Holds records below `passthrough_level` for the active request.
+
+    :param target: the handler that records are written to.  Handlers
+        can be named by the name used in a
+        :func:`logging.config.dictConfig` document.
+    :param int passthrough_level: records at this level or higher are
+        always passed to `target` immediately
+    :param RequestBuffers buffers: the buffers to use.  This defaults to
+        :data:`BUFFERS`.
+
+    The active request's buffer is found with the key that
+    :class:`RequestBufferMixin` binds to :data:`CONTEXT_KEY` in the
+    :mod:`sprockets.logging.context`.  Records that are logged outside
+    of a request are passed to `target` when they meet its level.
+    Buffered records are passed to `target` regardless of its level
+    when the buffer is flushed.
+
+    """
+
+    def __init__(self, target, passthrough_level=logging.INFO, buffers=None):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.passthrough_level = passthrough_level
+        self.buffers = buffers or BUFFERS
+
+    def handle(self, record):
+        # the target handler does its own locking
+        result = self.filter(record)
+        if result:
+            self.emit(record)
+        return result
+
+    def emit(self, record):
+        try:
+            target = self.target
+            if not isinstance(target, logging.Handler):
+                target = self.target = _resolve_handler(target)
+            if record.levelno < self.passthrough_level:
+                key = context.get().get(CONTEXT_KEY)
+                buffer = self.buffers.get(key) if key is not None else None
+                if buffer is not None:
+                    buffer.append(target, record)
+                    return
+                if record.levelno < target.level:
+                    return
+            target.handle(record)
+        except Exception:
+            self.handleError(record)
+
+
+class RequestBufferMixin(object):
+    """Opens a log buffer for each request.
+
+    The request's correlation ID is taken from the ``correlation_id``
+    attribute or ``Correlation-ID`` header, or generated if neither is
+    set, and is bound to the :mod:`sprockets.logging.context` along with
+    the buffer's key.  Each request gets a new key, so requests that
+    share a correlation ID do not share a buffer.  The buffer is flushed
+    by the access log function when the response status is at least
+    :attr:`log_buffer_status` or the request took at least
+    :attr:`log_buffer_slow_threshold` milliseconds.
+
+    """
+
+    #: the buffers to open the request's buffer in
+    log_buffers = None
+
+    #: flush the buffer for responses with this status code or higher
+    log_buffer_status = 500
+
+    #: flush the buffer for requests that take this many milliseconds
+    log_buffer_slow_threshold = None
+
+    log_buffer = None
+
+    def prepare(self):
+        correlation_id = getattr(self, 'correlation_id', None)
+        if not correlation_id:
+            correlation_id = (self.request.headers.get('Correlation-ID') or
+                              uuid.uuid4().hex)
+            self.correlation_id = correlation_id
+        self.log_buffer = (self.log_buffers or BUFFERS).open(
+            label=correlation_id)
+        context.bind(**{'correlation_id': correlation_id,
+                        CONTEXT_KEY: self.log_buffer.key})
+        return super(RequestBufferMixin, self).prepare()
+
+    def on_finish(self):
+        if self.log_buffer is not None:
+            self.log_buffer.discard()
+            self.log_buffer = None
+        super(RequestBufferMixin, self).on_finish()
+
+
+def finish_request(handler, status_code, duration):
+    """Flush or discard the log buffer of a finished request.
+
+    :param tornado.web.RequestHandler handler: the request handler
+    :param int status_code: the response status code
+    :param float duration: the request duration in milliseconds
+
+    This is called by the access log functions in this package.
+
+    """
+    buffer = getattr(handler, 'log_buffer', None)
+    if buffer is None:
+        return
+    handler.log_buffer = None
+    threshold = handler.log_buffer_slow_threshold
+    if status_code >= handler.log_buffer_status or (
+            threshold is not None and duration >= threshold):
+        buffer.flush()
+    else:
+        buffer.discard()
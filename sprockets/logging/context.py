@@ -0,0 +1,119 @@
+"""
+Request context that follows coroutines and tasks.
+
+- :func:`bind` adds values to the active logging context
+- :func:`scope` binds values for the duration of a ``with`` block
+- :func:`get` returns the active logging context
+
+The context is stored in a :class:`contextvars.ContextVar` so values
+that are bound while handling a request are visible to every coroutine,
+:mod:`asyncio` task, and IOLoop callback that the request starts.  There
+is no need to create a :class:`logging.LoggerAdapter` per request,
+:class:`~sprockets.logging.ContextFilter` adds the values to every
+record that passes through it.
+
+.. code:: python
+
+    class RequestHandler(web.RequestHandler):
+
+        def prepare(self):
+            sprockets.logging.context.bind(
+                correlation_id=self.request.headers.get('Correlation-ID'))
+
+On Python versions without :mod:`contextvars`, the context is stored
+per thread instead.
+
+"""
+from __future__ import absolute_import
+
+import contextlib
+import threading
+
+try:
+    import contextvars
+except ImportError:  # pragma no cover
+    contextvars = None
+
+_EMPTY = {}
+
+
+class _ThreadLocalVar(object):
+    """Minimal :class:`contextvars.ContextVar` stand-in."""
+
+    def __init__(self, name, default):
+        self.name = name
+        self.default = default
+        self._local = threading.local()
+
+    def get(self):
+        return getattr(self._local, 'value', self.default)
+
+    def set(self, value):
+        token = self.get()
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        self._local.value = token
+
+
+if contextvars is not None:
+    _context = contextvars.ContextVar('sprockets.logging.context',
+                                      default=_EMPTY)
+else:  # pragma no cover
+    _context = _ThreadLocalVar('sprockets.logging.context', _EMPTY)
+
+
+def get():
+    """Return the active logging context.
+
+    :rtype: dict
+
+    The returned dictionary is shared and must not be modified.  Use
+    :func:`bind` to change the context instead.
+
+    """
+    return _context.get()
+
+
+def bind(**values):
+    """Add values to the active logging context.
+
+    :returns: a token that can be passed to :func:`reset`
+
+    The existing context is copied so that contexts that were captured
+    by other tasks are not affected.
+
+    """
+    current = _context.get()
+    updated = dict(current)
+    updated.update(values)
+    return _context.set(updated)
+
+
+def reset(token):
+    """Restore the context that was active before :func:`bind`.
+
+    :param token: the value returned from :func:`bind`
+
+    """
+    _context.reset(token)
+
+
+def clear():
+    """Remove every value from the active logging context.
+
+    :returns: a token that can be passed to :func:`reset`
+
+    """
+    return _context.set(_EMPTY)
+
+
+@contextlib.contextmanager
+def scope(**values):
+    """Bind values to the logging context inside of a ``with`` block."""
+    token = bind(**values)
+    try:
+        yield
+    finally:
+        reset(token)
@@ -0,0 +1,160 @@
+"""
+Collapse repeated log records into periodic summaries.
+
+- :class:`DuplicateFilter` lets the first of a series of identical
+    records through and replaces the rest with a single "repeated N
+    times" record per window
+
+When a dependency fails, every request can log the same error with the
+same traceback.  Formatting and writing thousands of identical records
+per second makes the logs harder to read and slows the application down
+at the worst possible time.
+
+.. code:: python
+
+    handler.addFilter(DuplicateFilter(window=10))
+
+"""
+from __future__ import absolute_import
+
+import collections
+import logging
+import threading
+import time
+
+#: the record attributes that describe when a record was created
+_TIME_ATTRIBUTES = ('created', 'msecs', 'relativeCreated')
+
+
+class DuplicateFilter(logging.Filter):
+    """Suppresses records that repeat within a time window.
+
+    :param str name: only filter records from this logger and its
+        children, as with :class:`logging.Filter`
+    :param float window: the number of seconds that duplicates of a
+        record are collapsed for
+    :param int level: records below this level are never suppressed
+    :param int max_fingerprints: the maximum number of distinct records
+        that are tracked.  The oldest is forgotten once there are more.
+
+    Records are considered duplicates when they come from the same
+    logger at the same level with the same message template, and have
+    the same exception type raised from the same line.  The first record
+    passes through the filter.  Duplicates that arrive within `window`
+    seconds of it are dropped and counted.  Once the window has passed,
+    a record is logged to the original logger with the message
+    ``<message> (repeated N times)`` and a ``repeated`` attribute, and
+    the next duplicate starts a new window.
+
+    Expired windows are checked at most once a second when a record is
+    filtered.  Call :meth:`flush` to log the pending summaries if the
+    application stops logging, for example before shutting down.
+
+    Summaries pass through every handler of the logger, so the filter
+    should be added to the logger or to every handler that it uses.
+
+    """
+
+    def __init__(self, name='', window=60.0, level=logging.WARNING,
+                 max_fingerprints=1000):
+        logging.Filter.__init__(self, name)
+        self.window = window
+        self.level = level
+        self.max_fingerprints = max_fingerprints
+        self.suppressed = 0
+        self._seen = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._next_sweep = 0
+
+    @staticmethod
+    def fingerprint(record):
+        """Return the key that identifies duplicates of `record`.
+
+        :param logging.LogRecord record: the record to identify
+        :rtype: tuple
+
+        """
+        msg = record.msg
+        if not isinstance(msg, str):
+            msg = '{0}:{1}'.format(type(msg).__name__, id(msg))
+        exc_info = record.exc_info
+        if not exc_info or exc_info[0] is None:
+            return record.name, record.levelno, msg
+        tb = exc_info[2]
+        if tb is None:
+            return record.name, record.levelno, msg, exc_info[0]
+        while tb.tb_next is not None:
+            tb = tb.tb_next
+        return (record.name, record.levelno, msg, exc_info[0],
+                tb.tb_frame.f_code.co_filename, tb.tb_lineno)
+
+    def filter(self, record):
+        if record.levelno < self.level or \
+                getattr(record, 'repeated', None) is not None or \
+                not logging.Filter.filter(self, record):
+            return True
+        now = time.time()
+        key = self.fingerprint(record)
+        expired = []
+        with self._lock:
+            entry = self._seen.get(key)
+            suppress = entry is not None and now < entry[0] + self.window
+            if suppress:
+                entry[1] += 1
+                self.suppressed += 1
+            else:
+                if entry is not None:
+                    del self._seen[key]
+                    if entry[1]:
+                        expired.append(entry)
+                self._seen[key] = [now, 0, _summary_attributes(record)]
+            if now >= self._next_sweep or \
+                    len(self._seen) > self.max_fingerprints:
+                self._next_sweep = now + 1.0
+                self._expire(now, expired)
+        for entry in expired:
+            self._log_summary(entry)
+        return not suppress
+
+    def _expire(self, now, expired):
+        # entries are ordered by the start of their window
+        while self._seen:
+            key, entry = next(iter(self._seen.items()))
+            if now < entry[0] + self.window and \
+                    len(self._seen) <= self.max_fingerprints:
+                break
+            del self._seen[key]
+            if entry[1]:
+                expired.append(entry)
+
+    def flush(self):
+        """Log the summaries of every window that suppressed records."""
+        with self._lock:
+            pending = [entry for entry in self._seen.values() if entry[1]]
+            self._seen.clear()
+        for entry in pending:
+            self._log_summary(entry)
+
+    @staticmethod
+    def _log_summary(entry):
+        _, count, attributes = entry
+        summary = logging.makeLogRecord({})
+        # the summary is logged now, only its origin is copied
+        timestamps = dict((name, summary.__dict__[name])
+                          for name in _TIME_ATTRIBUTES)
+        summary.__dict__.update(attributes)
+        summary.__dict__.update(timestamps)
+        summary.args = (summary.msg, count)
+        summary.msg = '%s (repeated %d times)'
+        summary.repeated = count
+        logger = logging.getLogger(summary.name)
+        if logger.isEnabledFor(summary.levelno):
+            logger.handle(summary)
+
+
+def _summary_attributes(record):
+    """Return the attributes of `record` without its traceback."""
+    attributes = dict(record.__dict__)
+    attributes.update(msg=record.getMessage(), args=(), exc_info=None,
+                      exc_text=None, stack_info=None)
+    return attributes
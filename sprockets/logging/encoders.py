@@ -0,0 +1,137 @@
+"""
+JSON encoder backends for :class:`~sprockets.logging.JSONRequestFormatter`.
+
+- :func:`get_encoder` returns an :class:`Encoder` for a backend name
+- :func:`register` adds a new backend
+
+Every backend is configured to produce the same output as
+:func:`json.dumps` with its default arguments so that switching
+backends never changes the log lines.  Backends that are not installed
+fall back to the standard library implementation.
+
+"""
+from __future__ import absolute_import
+
+import json
+import re
+
+AUTO = 'auto'
+STDLIB = 'json'
+UJSON = 'ujson'
+
+_factories = {}
+_preference = []
+
+
+class Encoder(object):
+    """Serializes objects as JSON.
+
+    :param str name: the name of the backend
+    :param dumps: callable that returns the JSON representation of
+        an object as a :class:`str`
+    :param dumps_bytes: optional callable that returns the JSON
+        representation as :class:`bytes`.  If this is omitted, the
+        result of `dumps` is ASCII-encoded.
+
+    """
+
+    def __init__(self, name, dumps, dumps_bytes=None):
+        self.name = name
+        self.dumps = dumps
+        if dumps_bytes is None:
+            dumps_bytes = self._encode_dumps
+        self.dumps_bytes = dumps_bytes
+
+    def _encode_dumps(self, obj):
+        # every backend escapes non-ASCII characters so this is
+        # a straight copy instead of a real transcoding
+        return self.dumps(obj).encode('ascii')
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(self.__class__.__name__, self.name)
+
+
+def register(name, factory, preferred=False):
+    """Add a backend that :func:`get_encoder` can return.
+
+    :param str name: the name used to select the backend
+    :param factory: callable that returns an :class:`Encoder`.  It
+        should raise :exc:`ImportError` when the backend is not
+        available.
+    :param bool preferred: should ``auto`` try this backend before
+        the ones that are already registered?
+
+    """
+    _factories[name] = factory
+    if name in _preference:
+        _preference.remove(name)
+    if preferred:
+        _preference.insert(0, name)
+    else:
+        _preference.append(name)
+
+
+def get_encoder(name=STDLIB):
+    """Return the :class:`Encoder` for a backend.
+
+    :param str name: the backend to use or ``auto`` to select the
+        fastest available backend
+    :rtype: Encoder
+    :raises ValueError: if `name` is not a registered backend
+
+    If the backend is registered but cannot be loaded, the standard
+    library encoder is returned instead.
+
+    """
+    if isinstance(name, Encoder):
+        return name
+    if name == AUTO:
+        candidates = list(_preference)
+    elif name in _factories:
+        candidates = [name]
+    else:
+        raise ValueError('unknown JSON encoder {0!r}'.format(name))
+    for candidate in candidates:
+        try:
+            return _factories[candidate]()
+        except ImportError:
+            continue
+    return _factories[STDLIB]()
+
+
+def _stdlib_encoder():
+    encoder = json.JSONEncoder()
+    return Encoder(STDLIB, encoder.encode)
+
+
+#: a JSON string or a float exponent with a single negative digit
+_SHORT_EXPONENT = re.compile(r'"(?:[^"\\]|\\.)*"|e-(\d)(?!\d)')
+
+
+def _pad_exponent(match):
+    digit = match.group(1)
+    return match.group(0) if digit is None else 'e-0' + digit
+
+
+def _ujson_encoder():
+    import ujson
+    options = {'ensure_ascii': True,
+               'escape_forward_slashes': False,
+               'separators': (', ', ': ')}
+    try:
+        ujson.dumps({}, **options)
+    except TypeError:  # separators was added in ujson 5.4
+        raise ImportError('ujson does not support separators')
+
+    def dumps(obj):
+        text = ujson.dumps(obj, **options)
+        if 'e-' in text:
+            # ujson writes 1e-7 where json.dumps writes 1e-07
+            text = _SHORT_EXPONENT.sub(_pad_exponent, text)
+        return text
+
+    return Encoder(UJSON, dumps)
+
+
+register(STDLIB, _stdlib_encoder)
+register(UJSON, _ujson_encoder, preferred=True)
@@ -0,0 +1,95 @@
+"""
+Caller lookup for log records.
+
+- :func:`install` replaces :func:`logging.currentframe` so that frames
+    in logging wrappers are skipped when finding the caller
+- :func:`skip_file` and :func:`skip_module` register logging wrappers
+
+The standard library only skips frames from the :mod:`logging` package
+when it looks for the code that emitted a log record.  Records logged
+through :func:`~sprockets.logging.tornado_log_function` or any other
+wrapper are attributed to the wrapper instead of to its caller.
+
+"""
+from __future__ import absolute_import
+
+import logging
+import os
+import sys
+
+_skipped = set()
+_original = {}
+
+
+def _code_file(func):
+    return func.__code__.co_filename
+
+
+def skip_file(file_name):
+    """Skip frames from `file_name` when looking for the caller.
+
+    :param str file_name: path to the source file of a logging wrapper
+
+    """
+    _skipped.add(file_name)
+    _skipped.add(os.path.normcase(os.path.abspath(file_name)))
+
+
+def skip_module(module):
+    """Skip frames from `module` when looking for the caller.
+
+    :param module: the module object of a logging wrapper
+
+    """
+    file_name = module.__file__
+    if file_name.endswith(('.pyc', '.pyo')):
+        file_name = file_name[:-1]
+    skip_file(file_name)
+
+
+def currentframe():
+    """Return the innermost frame that :meth:`logging.Logger.findCaller`
+    should start from.
+
+    :meth:`~logging.Logger.findCaller` uses the caller of the frame that
+    this function returns so this returns the outermost frame of the
+    skipped files.
+
+    """
+    frame = sys._getframe(0)
+    skipped = _skipped
+    caller = frame.f_back
+    while caller is not None and caller.f_code.co_filename in skipped:
+        frame, caller = caller, caller.f_back
+    return frame
+
+
+def install(find_caller=True):
+    """Install the caller lookup into the :mod:`logging` package.
+
+    :param bool find_caller: should log records include the caller?
+        If you do not emit the ``module``, ``line_number``, or ``file``
+        fields, then disabling this skips the frame walk for every log
+        call.  The records will contain ``(unknown file)`` as the file
+        name and zero as the line number.
+
+    Caller lookup is disabled by clearing ``logging._srcfile`` as
+    described in the :mod:`logging` optimization documentation.
+
+    """
+    if not _original:
+        _original['currentframe'] = logging.currentframe
+        _original['_srcfile'] = logging._srcfile
+    logging.currentframe = currentframe
+    logging._srcfile = _original['_srcfile'] if find_caller else None
+
+
+def uninstall():
+    """Restore the :mod:`logging` package's caller lookup."""
+    if _original:
+        logging.currentframe = _original.pop('currentframe')
+        logging._srcfile = _original.pop('_srcfile')
+
+
+skip_file(_code_file(logging.addLevelName))
+skip_file(_code_file(currentframe))
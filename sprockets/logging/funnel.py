@@ -0,0 +1,298 @@
+"""
+Funnel log records from forked processes through the parent process.
+
+- :class:`LogFunnel` runs in the parent and writes the records that
+    its children send to the real output
+- :class:`FunnelHandler` sends formatted records from a child process
+    to the funnel
+
+When a Tornado application uses :func:`tornado.process.fork_processes`,
+each child that writes to a shared stdout pays for its own write calls
+and long lines from different children can be interleaved.  The funnel
+gives every child its own unix socket connection to the parent.  Records
+are framed with a four byte big-endian length prefix so they arrive
+intact, and a single thread in the parent batches them into large
+writes.
+
+.. code:: python
+
+    funnel = LogFunnel(sys.stdout)
+    funnel.start()
+    process.fork_processes(0)
+    handler = FunnelHandler(funnel.path)
+    handler.setFormatter(sprockets.logging.JSONRequestFormatter())
+    logging.getLogger().addHandler(handler)
+
+"""
+from __future__ import absolute_import
+
+import errno
+import logging
+import os
+import select
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from sprockets.logging import handlers, stats
+
+_HEADER = struct.Struct('>I')
+
+
+class LogFunnel(object):
+    """Collects framed records from child processes.
+
+    :param stream: the stream that records are written to.  Text streams
+        with a ``buffer`` attribute are written to through the buffer.
+    :param str path: the path of the unix socket to listen on.  A path
+        in a new temporary directory is used by default.
+    :param int batch_bytes: write once this many bytes are pending
+    :param float flush_interval: maximum number of seconds that records
+        wait before being written
+    :param int max_record_size: connections that send a frame larger
+        than this are closed
+
+    Each record is written followed by a newline.  A child that exits
+    in the middle of sending a record does not corrupt the output since
+    incomplete frames are discarded and counted in :attr:`truncated`.
+    Backpressure is handled by the operating system: while the parent
+    is writing, it is not reading and the children's sends block once
+    the socket buffers are full.
+
+    """
+
+    def __init__(self, stream=None, path=None, batch_bytes=65536,
+                 flush_interval=0.25, max_record_size=1048576):
+        stream = stream if stream is not None else sys.stdout
+        self.stream = getattr(stream, 'buffer', stream)
+        self._tempdir = None
+        if path is None:
+            self._tempdir = tempfile.mkdtemp(prefix='sprockets-logging-')
+            path = os.path.join(self._tempdir, 'funnel.sock')
+        self.path = path
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.max_record_size = max_record_size
+        self.records = 0
+        self.truncated = 0
+        self._listener = None
+        self._connections = {}
+        self._pending = []
+        self._pending_bytes = 0
+        self._thread = None
+        self._wakeup = None
+        self._stopping = False
+        self._pid = os.getpid()
+
+    def start(self):
+        """Listen for children and start the writer thread."""
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.path)
+        self._listener.listen(128)
+        self._wakeup = os.pipe()
+        self._thread = threading.Thread(target=self._run,
+                                        name='sprockets.logging.LogFunnel')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Read what the children have sent, write it, and shut down.
+
+        :param float timeout: maximum number of seconds to wait for the
+            writer thread
+
+        Only the process that created the funnel can stop it.
+
+        """
+        if self._thread is None or os.getpid() != self._pid:
+            return
+        self._stopping = True
+        os.write(self._wakeup[1], b'x')
+        self._thread.join(timeout)
+        self._thread = None
+        for fd in self._wakeup:
+            os.close(fd)
+        self._listener.close()
+        if self._tempdir is not None:
+            shutil.rmtree(self._tempdir, ignore_errors=True)
+        else:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _run(self):
+        deadline = None
+        while True:
+            readers = [self._listener, self._wakeup[0]]
+            readers.extend(self._connections)
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.time(), 0)
+            try:
+                readable, _, _ = select.select(readers, [], [], timeout)
+            except (OSError, select.error) as error:
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
+            for reader in readable:
+                if reader is self._listener:
+                    connection, _ = self._listener.accept()
+                    self._connections[connection] = b''
+                elif reader is not self._wakeup[0]:
+                    self._receive(reader)
+            if self._stopping:
+                self._drain()
+                self.flush()
+                for connection, buffered in list(self._connections.items()):
+                    if buffered:
+                        self.truncated += 1
+                    connection.close()
+                self._connections.clear()
+                return
+            if self._pending_bytes >= self.batch_bytes or (
+                    deadline is not None and time.time() >= deadline):
+                self.flush()
+                deadline = None
+            elif self._pending and deadline is None:
+                deadline = time.time() + self.flush_interval
+
+    def _drain(self):
+        while self._connections:
+            readable, _, _ = select.select(list(self._connections), [], [],
+                                           0)
+            if not readable:
+                break
+            for connection in readable:
+                self._receive(connection)
+
+    def _receive(self, connection):
+        try:
+            data = connection.recv(65536)
+        except socket.error:
+            data = b''
+        if not data:
+            if self._connections.pop(connection):
+                self.truncated += 1
+            connection.close()
+            return
+        buffered = self._connections[connection] + data
+        offset = 0
+        while len(buffered) - offset >= _HEADER.size:
+            size, = _HEADER.unpack_from(buffered, offset)
+            if size > self.max_record_size:
+                self._connections.pop(connection)
+                connection.close()
+                self.truncated += 1
+                return
+            end = offset + _HEADER.size + size
+            if len(buffered) < end:
+                break
+            self._pending.append(buffered[offset + _HEADER.size:end])
+            self._pending_bytes += size + 1
+            self.records += 1
+            offset = end
+        self._connections[connection] = buffered[offset:]
+
+    def flush(self):
+        """Write the pending records to the stream."""
+        if self._pending:
+            self._pending.append(b'')
+            data = b'\n'.join(self._pending)
+            self._pending, self._pending_bytes = [], 0
+            try:
+                self.stream.write(data)
+                self.stream.flush()
+            except Exception:
+                sys.stderr.write('sprockets.logging: funnel failed to write '
+                                 '{0} bytes\n'.format(len(data)))
+
+
+class FunnelHandler(handlers.EncodingMixin, logging.Handler):
+    """Sends formatted records to a :class:`LogFunnel`.
+
+    :param str path: the path of the funnel's unix socket
+    :param float send_timeout: maximum number of seconds to wait for the
+        funnel to accept a record.  :data:`None` waits forever.
+    :param int max_record_size: records larger than this are dropped
+        instead of being sent.  This should match the funnel's
+        `max_record_size`, which closes connections that send larger
+        frames.
+
+    The connection is opened on first use in each process so the handler
+    can be configured before forking.  Formatters with a ``format_bytes``
+    method, such as :class:`~sprockets.logging.JSONRequestFormatter`,
+    are used to produce the record's bytes directly.
+
+    Records that are too large, that cannot be sent before the timeout
+    expires, or that fail to send because the funnel went away are
+    dropped and counted in :attr:`dropped`.  After a failure the
+    connection is closed and the next record opens a new one.
+
+    """
+
+    def __init__(self, path, send_timeout=None, max_record_size=1048576):
+        logging.Handler.__init__(self)
+        self.path = path
+        self.send_timeout = send_timeout
+        self.max_record_size = max_record_size
+        self.dropped = 0
+        stats.STATS.register_handler(self)
+        self._socket = None
+        self._pid = None
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.send_timeout)
+            sock.connect(self.path)
+        except Exception:
+            sock.close()
+            raise
+        self._socket, self._pid = sock, os.getpid()
+
+    def emit(self, record):
+        try:
+            data = self.encode(record)
+            frame = _HEADER.pack(len(data)) + data
+            self.acquire()
+            try:
+                if len(data) > self.max_record_size:
+                    self.dropped += 1
+                    return
+                if self._socket is not None and self._pid != os.getpid():
+                    # closing the inherited descriptor leaves the
+                    # parent's connection open, but keeping it would
+                    # stop the funnel from seeing EOF when the parent
+                    # closes it
+                    self._socket.close()
+                    self._socket = None
+                if self._socket is None:
+                    self._connect()
+                self._socket.sendall(frame)
+                stats.STATS.bytes_emitted += len(frame)
+            except (socket.error, OSError):
+                # part of the frame may have been sent, reconnecting
+                # makes the funnel discard it
+                self.dropped += 1
+                if self._socket is not None:
+                    self._socket.close()
+                    self._socket = None
+            finally:
+                self.release()
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.acquire()
+        try:
+            if self._socket is not None:
+                self._socket.close()
+            self._socket = None
+        finally:
+            self.release()
+        logging.Handler.close(self)
@@ -0,0 +1,900 @@
+"""
+Handlers that keep log I/O off of the calling thread.
+
+- :class:`QueueHandler` hands records to a :class:`QueueWriter` running
+    in a background thread so that a slow stream never blocks the
+    IOLoop thread
+- :class:`BinaryStreamHandler` writes encoded records directly to the
+    binary layer of a stream
+- :class:`FileDescriptorHandler` batches encoded records and writes them
+    to a file descriptor with :func:`os.writev`
+- :class:`BatchingHandler` is the base of handlers that collect encoded
+    records and process them in batches on a background thread
+- :class:`EncodingMixin` formats records as bytes for the handlers in
+    this package
+- :func:`freeze_record` captures a record so that it can be formatted
+    in another thread
+
+"""
+from __future__ import absolute_import
+
+import copy
+import errno
+import logging
+import os
+import select
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # pragma no cover
+    import Queue as queue
+
+from sprockets.logging import stats
+
+BLOCK = 'block'
+DROP_NEWEST = 'drop-newest'
+DROP_OLDEST = 'drop-oldest'
+KEEP_ERRORS = 'keep-errors'
+OVERFLOW_POLICIES = (BLOCK, DROP_NEWEST, DROP_OLDEST, KEEP_ERRORS)
+
+_STOP = object()
+
+try:
+    _IMMUTABLE_TYPES = (type(None), bool, int, long, float, complex,
+                        str, unicode, bytes)
+except NameError:  # pragma no cover
+    _IMMUTABLE_TYPES = (type(None), bool, int, float, complex, str, bytes)
+_MISSING = object()
+_DEFAULT_FORMATTER = logging.Formatter()
+
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):  # pragma no cover
+    _IOV_MAX = 1024
+_RETRY_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+def _writev(fd, buffers):
+    """Write `buffers` to `fd` with as few system calls as possible."""
+    if hasattr(os, 'writev'):
+        return os.writev(fd, buffers)
+    return os.write(fd, b''.join(buffers))  # pragma no cover -- Windows
+
+
+def _resolve_handler(handler):
+    """Return the handler instance for `handler`.
+
+    :param handler: either a :class:`logging.Handler` instance or the
+        name of a handler created by :func:`logging.config.dictConfig`
+    :rtype: logging.Handler
+    :raises ValueError: if a named handler does not exist
+
+    """
+    if isinstance(handler, logging.Handler):
+        return handler
+    lookup = getattr(logging, 'getHandlerByName', None)
+    if lookup is None:  # pragma no cover
+        resolved = logging._handlers.get(handler)
+    else:
+        resolved = lookup(handler)
+    if resolved is None:
+        raise ValueError('unknown handler {0!r}'.format(handler))
+    return resolved
+
+
+def _is_immutable(value):
+    if isinstance(value, _IMMUTABLE_TYPES):
+        return True
+    if type(value) in (tuple, frozenset):
+        return all(_is_immutable(item) for item in value)
+    return False
+
+
+def _copy_value(value, convert=None):
+    """Return a copy of `value` or :data:`_MISSING` if it cannot be
+    copied safely.
+
+    Values that :func:`copy.deepcopy` rejects are passed to `convert`
+    when it is set instead of failing the whole copy.
+
+    """
+    if _is_immutable(value):
+        return value
+    if isinstance(value, dict):
+        copied = {}
+        for key, item in value.items():
+            copied[key] = _copy_value(item, convert)
+            if copied[key] is _MISSING:
+                return _MISSING
+        return copied
+    if isinstance(value, list) or type(value) is tuple:
+        copied = [_copy_value(item, convert) for item in value]
+        if _MISSING in copied:
+            return _MISSING
+        return copied if isinstance(value, list) else tuple(copied)
+    try:
+        return copy.deepcopy(value)
+    except Exception:
+        return _MISSING if convert is None else convert(value)
+
+
+def freeze_record(record, formatters=()):
+    """Return a copy of `record` that is safe to format in another thread.
+
+    :param logging.LogRecord record: the record to copy
+    :param list formatters: the formatters that will format the copy.
+        Exception information is rendered for each of them.
+    :rtype: logging.LogRecord
+
+    Formatting a record later must produce the same output as
+    formatting it immediately, even if the caller modifies the
+    arguments that it logged.  The copy is made as follows:
+
+    - arguments that are strings, numbers, :data:`None`, or tuples of
+      them are immutable and are kept as-is
+    - dictionary arguments, such as the payload that
+      :func:`~sprockets.logging.tornado_log_function` logs, are copied
+      along with any nested dictionaries, lists, and tuples.  Other
+      values, such as a :class:`uuid.UUID` or a
+      :class:`datetime.datetime`, are copied with :func:`copy.deepcopy`.
+    - if an argument cannot be deep copied, the message is rendered with
+      :meth:`logging.LogRecord.getMessage` in the calling thread and
+      the arguments are dropped from the copy.  A dictionary that is
+      logged without a message is kept with the values that could not
+      be copied replaced by their string form, which is what
+      :class:`~sprockets.logging.JSONRequestFormatter` would emit for
+      them.
+    - ``exc_info`` is rendered into ``exc_record`` for formatters that
+      have an ``extract_exc_record`` method and into ``exc_text`` for
+      the others.  The traceback itself is not retained.
+
+    """
+    frozen = record.__class__.__new__(record.__class__)
+    frozen.__dict__.update(record.__dict__)
+
+    args = _copy_value(record.args) if record.args else record.args
+    if args is _MISSING or not isinstance(record.msg, _IMMUTABLE_TYPES):
+        frozen.msg = record.getMessage()
+        frozen.args = ()
+        if not frozen.msg and isinstance(record.args, dict):
+            # the arguments are the record's data, not message arguments
+            frozen.args = _copy_value(record.args, str)
+    else:
+        frozen.args = args
+
+    if record.exc_info and record.exc_info[0] is not None:
+        for formatter in formatters:
+            extract = getattr(formatter, 'extract_exc_record', None)
+            if extract is not None:
+                if getattr(frozen, 'exc_record', None) is None:
+                    frozen.exc_record = extract(*record.exc_info)
+            elif not frozen.exc_text:
+                frozen.exc_text = formatter.formatException(record.exc_info)
+        frozen.exc_info = None
+    return frozen
+
+
+def _join_queue(record_queue, timeout):
+    """Wait up to `timeout` seconds for `record_queue` to be drained.
+
+    :returns: were all of the queued items processed?
+    :rtype: bool
+
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    with record_queue.all_tasks_done:
+        while record_queue.unfinished_tasks:
+            if deadline is None:
+                record_queue.all_tasks_done.wait()
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            record_queue.all_tasks_done.wait(remaining)
+    return True
+
+
+class QueueWriter(object):
+    """Drains a queue of log records in a background thread.
+
+    :param queue.Queue record_queue: the queue to read from
+    :param stream: optional file-like object that receives pre-formatted
+        lines from the queue
+    :param list handlers: optional list of handlers that receive the
+        queued records
+    :param int batch_size: maximum number of records written between
+        flushes
+    :param float flush_interval: maximum number of seconds to wait for a
+        batch to fill before writing it out
+    :param str terminator: string written after each formatted line
+    :param format_record: optional callable that formats the items on
+        the queue before they are written to `stream`.  When this is
+        omitted, the items are expected to be formatted already.
+
+    Records are pulled off of the queue in batches of up to `batch_size`
+    entries.  When writing to a `stream`, a batch is joined into a single
+    ``write`` followed by a single ``flush`` call.  When writing to
+    `handlers`, each record is passed to :meth:`logging.Handler.handle`
+    and the handlers are flushed once per batch.
+
+    """
+
+    def __init__(self, record_queue, stream=None, handlers=None,
+                 batch_size=100, flush_interval=0.5, terminator='\n',
+                 format_record=None):
+        self.queue = record_queue
+        self.format_record = format_record
+        self.stream = stream
+        self.handlers = list(handlers or [])
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.terminator = terminator
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start the background writer thread."""
+        self.handlers = [_resolve_handler(h) for h in self.handlers]
+        self._thread = threading.Thread(target=self._run,
+                                        name='sprockets.logging.QueueWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Write out everything that is queued and stop the thread.
+
+        :param float timeout: maximum number of seconds to wait for
+            the queue to drain
+
+        """
+        if self.running:
+            deadline = None if timeout is None else time.time() + timeout
+            try:
+                self.queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                pass  # the writer is stuck, leave the daemon thread
+            else:
+                self._thread.join(None if deadline is None else
+                                  max(deadline - time.time(), 0))
+        self._thread = None
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            batch, stopped = self._next_batch()
+            if batch:
+                try:
+                    self.write(batch)
+                except Exception:
+                    sys.stderr.write('sprockets.logging: failed to write {0} '
+                                     'queued records\n'.format(len(batch)))
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+            if stopped:
+                self.queue.task_done()
+
+    def _next_batch(self):
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            try:
+                if deadline is None:
+                    item = self.queue.get()
+                    deadline = time.time() + self.flush_interval
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        item = self.queue.get_nowait()
+                    else:
+                        item = self.queue.get(True, remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def write(self, batch):
+        """Write a batch of queued items.
+
+        :param list batch: formatted lines or records when writing to
+            a stream, otherwise :class:`logging.LogRecord` instances
+
+        """
+        if self.stream is not None:
+            lines = batch
+            if self.format_record is not None:
+                lines = []
+                for record in batch:
+                    try:
+                        lines.append(self.format_record(record))
+                    except Exception:
+                        sys.stderr.write('sprockets.logging: failed to '
+                                         'format {0!r}\n'.format(record))
+            if lines:
+                data = self.terminator.join(lines) + self.terminator
+                self.stream.write(data)
+                self.stream.flush()
+                stats.STATS.bytes_emitted += len(data)
+        for handler in self.handlers:
+            for record in batch:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            handler.flush()
+
+
+class QueueHandler(logging.Handler):
+    """Hands log records to a background writer thread.
+
+    :param stream: optional file-like object to write formatted records
+        to.  When this is set, records are formatted by this handler in
+        the calling thread and only the write happens in the background.
+    :param target: optional handler or list of handlers that the
+        background thread passes records to.  Handlers can be named by
+        the name used in a :func:`logging.config.dictConfig` document.
+    :param int max_size: the maximum number of queued records
+    :param str overflow: what to do when the queue is full.  One of
+        ``block``, ``drop-newest``, ``drop-oldest``, or ``keep-errors``.
+    :param int batch_size: maximum number of records written at once
+    :param float flush_interval: maximum number of seconds that a
+        partial batch waits before being written
+    :param float drain_timeout: maximum number of seconds that
+        :meth:`flush` and :meth:`close` wait for queued records to be
+        written
+    :param bool defer_format: format records in the background thread?
+        When this is enabled, the calling thread only captures a copy of
+        the record with :func:`freeze_record` and formatting and JSON
+        encoding happen in the background thread.
+
+    The ``keep-errors`` policy discards incoming records below
+    :data:`logging.ERROR` when the queue is full and makes room for
+    error records by discarding the oldest queued record.  The number
+    of records discarded is available as :attr:`dropped`.  The queue
+    depth and :attr:`dropped` are included in
+    :func:`sprockets.logging.stats.snapshot`.
+
+    This handler can be configured with :func:`logging.config.dictConfig`:
+
+    .. code:: python
+
+        'handlers': {
+            'console': {
+                'class': 'logging.StreamHandler',
+                'stream': 'ext://sys.stdout',
+                'formatter': 'json',
+            },
+            'queued': {
+                '()': 'sprockets.logging.QueueHandler',
+                'target': 'console',
+                'overflow': 'keep-errors',
+            },
+        }
+
+    """
+
+    def __init__(self, stream=None, target=None, max_size=10000,
+                 overflow=BLOCK, batch_size=100, flush_interval=0.5,
+                 drain_timeout=5.0, defer_format=False):
+        logging.Handler.__init__(self)
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of {0}, not {1!r}'.format(
+                ', '.join(OVERFLOW_POLICIES), overflow))
+        if stream is None and target is None:
+            stream = sys.stderr
+        if isinstance(target, (list, tuple)):
+            targets = list(target)
+        else:
+            targets = [target] if target is not None else []
+        self.stream = stream
+        self.targets = targets
+        self.max_size = max_size
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.drain_timeout = drain_timeout
+        self.defer_format = defer_format
+        self.dropped = 0
+        self.queue = None
+        self.writer = None
+        self._pid = None
+        stats.STATS.register_queue(self)
+
+    def _start(self):
+        self.acquire()
+        try:
+            if self._pid != os.getpid():
+                # the writer thread does not survive a fork, so each
+                # process gets its own queue and writer
+                self.queue = queue.Queue(self.max_size)
+                self.writer = QueueWriter(
+                    self.queue, stream=self.stream, handlers=self.targets,
+                    batch_size=self.batch_size,
+                    flush_interval=self.flush_interval,
+                    format_record=self.format if self.defer_format else None)
+                self.writer.start()
+                self._pid = os.getpid()
+        finally:
+            self.release()
+
+    def prepare(self, record):
+        """Return the item to queue for `record`.
+
+        :param logging.LogRecord record: the record being handled
+
+        When writing directly to a stream, the formatted line is queued
+        unless formatting is deferred.  Otherwise a frozen copy of the
+        record is queued, so the output does not change if the caller
+        modifies what it logged and the traceback is not kept alive
+        while the record waits.
+
+        """
+        if self.stream is not None:
+            if not self.defer_format:
+                return self.format(record)
+            formatters = [self.formatter or _DEFAULT_FORMATTER]
+        else:
+            formatters = [h.formatter or _DEFAULT_FORMATTER
+                          for h in self.writer.handlers]
+        return freeze_record(record, formatters)
+
+    def enqueue(self, item, record):
+        """Add `item` to the queue applying the overflow policy.
+
+        :param item: the value returned from :meth:`prepare`
+        :param logging.LogRecord record: the record being handled
+
+        """
+        if self.overflow == BLOCK:
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+            return
+        except queue.Full:
+            if self.overflow == DROP_NEWEST or (
+                    self.overflow == KEEP_ERRORS and
+                    record.levelno < logging.ERROR):
+                self.dropped += 1
+                return
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                continue
+
+    def emit(self, record):
+        try:
+            if self._pid != os.getpid():
+                self._start()
+            self.enqueue(self.prepare(record), record)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """Wait up to `drain_timeout` for the queued records to be written.
+
+        :func:`logging.shutdown` calls this before :meth:`close`, so it
+        must not wait forever when the stream is blocked.
+
+        """
+        if self.writer is not None and self.writer.running and \
+                self._pid == os.getpid():
+            _join_queue(self.queue, self.drain_timeout)
+
+    def close(self):
+        """Write out everything that is queued and stop the writer."""
+        self.acquire()
+        try:
+            if self.writer is not None and self._pid == os.getpid():
+                self.writer.stop(self.drain_timeout)
+            self.writer = None
+            self._pid = None
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+
+class EncodingMixin(object):
+    """Adds :meth:`encode` to a :class:`logging.Handler`.
+
+    When the formatter has a ``format_bytes`` method, such as
+    :class:`~sprockets.logging.JSONRequestFormatter`, it is used to
+    produce the bytes directly.  Otherwise the formatted record is UTF-8
+    encoded.
+
+    """
+
+    def encode(self, record):
+        """Return the formatted record as bytes.
+
+        :param logging.LogRecord record: the record to format
+        :rtype: bytes
+
+        """
+        format_bytes = getattr(self.formatter, 'format_bytes', None)
+        if format_bytes is not None:
+            return format_bytes(record)
+        return self.format(record).encode('utf-8')
+
+
+class BinaryStreamHandler(EncodingMixin, logging.StreamHandler):
+    """Writes encoded log records to the binary layer of a stream.
+
+    :param stream: the stream to write to.  If this is a text stream
+        with a ``buffer`` attribute such as :data:`sys.stdout`, the
+        records are written to the underlying buffer.
+
+    When the formatter has a ``format_bytes`` method, such as
+    :class:`~sprockets.logging.JSONRequestFormatter`, it is used to
+    produce the bytes to write which avoids the trip through the
+    text I/O layer.  Otherwise the formatted record is UTF-8 encoded.
+
+    """
+    terminator = b'\n'
+
+    def __init__(self, stream=None):
+        logging.StreamHandler.__init__(self, stream)
+        self.binary_stream = getattr(self.stream, 'buffer', self.stream)
+
+    def emit(self, record):
+        try:
+            data = self.encode(record)
+            if self.binary_stream is not self.stream:
+                self.stream.flush()  # keep text written elsewhere in order
+            data += self.terminator
+            self.binary_stream.write(data)
+            self.binary_stream.flush()
+            stats.STATS.bytes_emitted += len(data)
+        except Exception:
+            self.handleError(record)
+
+
+class FileDescriptorHandler(EncodingMixin, logging.Handler):
+    """Writes batches of encoded records to a file descriptor.
+
+    :param output: where to write.  This is a file descriptor, an
+        object with a ``fileno`` method such as :data:`sys.stdout`, or
+        the path of a file to append to.  Defaults to :data:`sys.stdout`.
+    :param int batch_bytes: write once this many bytes are pending
+    :param float flush_interval: maximum number of seconds that records
+        wait before being written
+    :param int max_pending_bytes: records that arrive while this many
+        bytes are waiting to be written are dropped and counted in
+        :attr:`dropped`
+    :param float write_timeout: maximum number of seconds that
+        :meth:`flush` and :meth:`close` wait for a non-blocking
+        descriptor to become writable
+
+    Records are formatted before the handler lock is acquired, using
+    the formatter's ``format_bytes`` method when it has one, and are
+    kept as a list of buffers that is handed to :func:`os.writev` so a
+    batch of records costs a single system call instead of a ``write``
+    and ``flush`` per record.  A background thread writes batches that
+    are older than `flush_interval`.
+
+    Partial writes are resumed from where they stopped.  When a
+    non-blocking descriptor such as a pipe returns ``EAGAIN``, the
+    records stay pending and are retried on the next record or timer
+    tick instead of blocking the caller.
+
+    This handler can be configured with :func:`logging.config.dictConfig`:
+
+    .. code:: python
+
+        'handlers': {
+            'stdout': {
+                '()': 'sprockets.logging.handlers.FileDescriptorHandler',
+                'output': 'ext://sys.stdout',
+                'formatter': 'json',
+            },
+        }
+
+    """
+    terminator = b'\n'
+
+    def __init__(self, output=None, batch_bytes=65536, flush_interval=1.0,
+                 max_pending_bytes=4194304, write_timeout=5.0):
+        logging.Handler.__init__(self)
+        if output is None:
+            output = sys.stdout
+        self.output = output
+        self._owns_fd = False
+        if isinstance(output, int):
+            self.fd = output
+        elif isinstance(output, str):
+            self.fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                              0o644)
+            self._owns_fd = True
+        else:
+            self.fd = output.fileno()
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.max_pending_bytes = max_pending_bytes
+        self.write_timeout = write_timeout
+        self.dropped = 0
+        stats.STATS.register_handler(self)
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_since = None
+        self._pid = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _start(self):
+        # buffered data belongs to the parent process and the timer
+        # thread does not survive a fork
+        self._pending, self._pending_bytes = [], 0
+        self._pending_since = None
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='sprockets.logging.FileDescriptorHandler')
+        self._thread.daemon = True
+        self._thread.start()
+        self._pid = os.getpid()
+
+    def _run(self):
+        while not self._stopping.wait(self.flush_interval):
+            # skip a busy tick instead of blocking so that close can
+            # join this thread while logging.shutdown holds the lock
+            if not self.lock.acquire(False):
+                continue
+            try:
+                if self._pending and (time.time() - self._pending_since >=
+                                      self.flush_interval):
+                    self.write_pending()
+            except Exception:
+                sys.stderr.write('sprockets.logging: failed to write {0} '
+                                 'bytes\n'.format(self._pending_bytes))
+            finally:
+                self.release()
+
+    def handle(self, record):
+        # the lock is taken in emit after the record is formatted
+        result = self.filter(record)
+        if result:
+            self.emit(record)
+        return result
+
+    def emit(self, record):
+        try:
+            data = self.encode(record) + self.terminator
+            self.acquire()
+            try:
+                if self._pid != os.getpid():
+                    self._start()
+                if self._pending_bytes + len(data) > self.max_pending_bytes:
+                    self.write_pending()
+                    if self._pending_bytes + len(data) > \
+                            self.max_pending_bytes:
+                        self.dropped += 1
+                        return
+                if not self._pending:
+                    self._pending_since = time.time()
+                self._pending.append(data)
+                self._pending_bytes += len(data)
+                if self._pending_bytes >= self.batch_bytes or (
+                        time.time() - self._pending_since >=
+                        self.flush_interval):
+                    self.write_pending()
+            finally:
+                self.release()
+        except Exception:
+            self.handleError(record)
+
+    def write_pending(self, timeout=None):
+        """Write as much of the pending data as possible.
+
+        :param float timeout: maximum number of seconds to wait for the
+            descriptor to become writable.  By default, this returns as
+            soon as the descriptor would block.
+        :returns: was everything written?
+        :rtype: bool
+
+        This must be called with the handler lock held.
+
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self._pending:
+            try:
+                written = _writev(self.fd, self._pending[:_IOV_MAX])
+            except (IOError, OSError) as error:
+                if error.errno == errno.EINTR:
+                    continue
+                if error.errno not in _RETRY_ERRORS:
+                    raise
+                remaining = 0 if deadline is None else deadline - time.time()
+                if remaining <= 0:
+                    return False
+                select.select([], [self.fd], [], remaining)
+                continue
+            stats.STATS.bytes_emitted += written
+            self._consume(written)
+        self._pending_since = None
+        return True
+
+    def _consume(self, written):
+        self._pending_bytes -= written
+        count = 0
+        for buffer in self._pending:
+            if written < len(buffer):
+                break
+            written -= len(buffer)
+            count += 1
+        del self._pending[:count]
+        if written:
+            # keep the unwritten part of a partially written record
+            self._pending[0] = memoryview(self._pending[0])[written:]
+
+    def flush(self):
+        """Write the pending records, waiting up to `write_timeout`."""
+        self.acquire()
+        try:
+            if self._pending and self._pid == os.getpid():
+                self.write_pending(self.write_timeout)
+        finally:
+            self.release()
+
+    def close(self):
+        """Write the pending records and stop the timer thread."""
+        if self._thread is not None and self._pid == os.getpid():
+            self._stopping.set()
+            self._thread.join()
+        self._thread = None
+        self.flush()
+        self.acquire()
+        try:
+            if self._owns_fd and self.fd is not None:
+                os.close(self.fd)
+            self.fd = None
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+
+class BatchingHandler(EncodingMixin, logging.Handler):
+    """Base class for handlers that process batches on a background thread.
+
+    :param int batch_bytes: wake the background thread once this many
+        bytes are pending
+    :param float flush_interval: maximum number of seconds that records
+        wait before they are processed
+    :param int max_pending_bytes: records that arrive while this many
+        bytes are pending are dropped and counted in :attr:`dropped`
+
+    Records are encoded in the calling thread and appended to a list
+    under a lock that is only held for the append.  The background
+    thread takes the whole list and passes it to :meth:`write_pending`,
+    which subclasses implement.  Neither thread takes the handler lock
+    while records are processed, so the background thread can be joined
+    while :func:`logging.shutdown` holds it.
+
+    The thread is started by the first record in each process, so the
+    handler can be configured before forking.  Subclasses reset their
+    per-process state in ``_reset`` and finish their output in
+    ``_finish``, which :meth:`close` calls after the thread stops.
+
+    """
+    terminator = b''
+
+    def __init__(self, batch_bytes=65536, flush_interval=1.0,
+                 max_pending_bytes=4194304):
+        logging.Handler.__init__(self)
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.max_pending_bytes = max_pending_bytes
+        self.dropped = 0
+        stats.STATS.register_handler(self)
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._pid = None
+        self._thread = None
+
+    def _start(self):
+        # the pending records belong to the parent process and the
+        # background thread does not survive a fork
+        self._pending, self._pending_bytes = [], 0
+        self._pending_lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._reset()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='sprockets.logging.' + self.__class__.__name__)
+        self._thread.daemon = True
+        self._thread.start()
+        self._pid = os.getpid()
+
+    def _reset(self):
+        """Discard the output state inherited from a parent process."""
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.write_pending()
+            except Exception:
+                sys.stderr.write('sprockets.logging: {0} failed to write '
+                                 'log records\n'.format(
+                                     self.__class__.__name__))
+
+    def _take_pending(self):
+        """Return the pending records and start a new batch."""
+        with self._pending_lock:
+            batch = self._pending
+            self._pending, self._pending_bytes = [], 0
+        return batch
+
+    def handle(self, record):
+        result = self.filter(record)
+        if result:
+            self.emit(record)
+        return result
+
+    def emit(self, record):
+        try:
+            data = self.encode(record) + self.terminator
+            if self._pid != os.getpid():
+                self.acquire()
+                try:
+                    if self._pid != os.getpid():
+                        self._start()
+                finally:
+                    self.release()
+            with self._pending_lock:
+                pending = self._pending_bytes + len(data)
+                if pending > self.max_pending_bytes:
+                    self.dropped += 1
+                    return
+                self._pending.append(data)
+                self._pending_bytes = pending
+            if pending >= self.batch_bytes > pending - len(data):
+                self._wakeup.set()
+        except Exception:
+            self.handleError(record)
+
+    def write_pending(self):
+        """Process the pending records.
+
+        This is called by the background thread and by :meth:`flush`.
+
+        """
+        raise NotImplementedError
+
+    def _finish(self):
+        """Process what is left after the background thread stopped."""
+        self.write_pending()
+
+    def flush(self):
+        """Process the pending records."""
+        if self._pid == os.getpid():
+            self.write_pending()
+
+    def close(self):
+        """Stop the background thread and process the last records."""
+        if self._thread is not None and self._pid == os.getpid():
+            self._stopping = True
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+            self._finish()
+        logging.Handler.close(self)
@@ -0,0 +1,258 @@
+"""
+Aggregated access log metrics.
+
+- :class:`AccessLogAggregator` is a Tornado ``log_function`` that
+    summarizes requests instead of logging each one
+
+"""
+from __future__ import absolute_import
+
+import bisect
+import logging
+
+try:
+    from tornado import ioloop, log
+except ImportError:  # pragma no cover
+    ioloop = None
+    log = None
+
+#: the default histogram buckets in milliseconds
+DEFAULT_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+#: the number of paths that the routes of handler classes mounted more
+#: than once are cached for
+MAX_CACHED_PATHS = 4096
+
+
+class RequestStats(object):
+    """Counts and latency histogram for one aggregation key.
+
+    :param tuple buckets: sorted upper bounds of the histogram buckets
+
+    """
+
+    __slots__ = ('buckets', 'count', 'errors', 'total', 'minimum',
+                 'maximum', 'histogram')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.histogram = [0] * (len(buckets) + 1)
+
+    def add(self, duration, error):
+        """Record a request.
+
+        :param float duration: the request duration in milliseconds
+        :param bool error: did the request fail?
+
+        """
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.total += duration
+        if self.minimum is None or duration < self.minimum:
+            self.minimum = duration
+        if self.maximum is None or duration > self.maximum:
+            self.maximum = duration
+        self.histogram[bisect.bisect_left(self.buckets, duration)] += 1
+
+    def as_dict(self):
+        """Return the statistics as a JSON-ready dictionary."""
+        histogram = dict((str(bound), count) for bound, count
+                         in zip(self.buckets, self.histogram))
+        histogram['+Inf'] = self.histogram[-1]
+        return {'count': self.count,
+                'errors': self.errors,
+                'duration': {'sum': self.total,
+                             'min': self.minimum,
+                             'max': self.maximum,
+                             'buckets': histogram}}
+
+
+class AccessLogAggregator(object):
+    """Summarizes requests instead of logging a line for each one.
+
+    :param float interval: the number of seconds between summaries
+    :param tuple buckets: upper bounds of the latency histogram buckets
+        in milliseconds
+    :param int log_status: requests with this status code or higher
+        are also logged individually.  :data:`None` disables this.
+    :param float slow_threshold: requests that take at least this many
+        milliseconds are also logged individually.  :data:`None`
+        disables this.
+    :param log_function: the function that logs individual requests.
+        This defaults to :func:`~sprockets.logging.tornado_log_function`.
+    :param logger: the logger that summaries are written to.  This
+        defaults to the ``tornado.access`` logger.
+
+    Requests are grouped by method, route pattern, and status class.
+    Every `interval` seconds a record is logged for each group with the
+    request count, the number of requests with a status code of 400 or
+    higher, and a latency histogram.  The record's message is empty and
+    its argument is the summary so that
+    :class:`~sprockets.logging.JSONRequestFormatter` emits it as the
+    ``request`` field.
+
+    .. code:: python
+
+        aggregator = AccessLogAggregator(interval=10, slow_threshold=500)
+        app = web.Application(routes, log_function=aggregator)
+        aggregator.start()
+
+    """
+
+    def __init__(self, interval=60.0, buckets=DEFAULT_BUCKETS,
+                 log_status=500, slow_threshold=None, log_function=None,
+                 logger=None):
+        if log_function is None:
+            from sprockets.logging import tornado_log_function
+            log_function = tornado_log_function
+        self.interval = interval
+        self.buckets = tuple(sorted(buckets))
+        self.log_status = log_status
+        self.slow_threshold = slow_threshold
+        self.log_function = log_function
+        self.logger = logger or log.access_log
+        self.stats = {}
+        self._routes = {}
+        self._paths = {}
+        self._callback = None
+
+    def __call__(self, handler):
+        status_code = handler.get_status()
+        duration = 1000.0 * handler.request.request_time()
+        key = (handler.request.method, self.get_route(handler),
+               '{0}xx'.format(status_code // 100))
+        try:
+            stats = self.stats[key]
+        except KeyError:
+            stats = self.stats[key] = RequestStats(self.buckets)
+        stats.add(duration, status_code >= 400)
+        if ((self.log_status is not None and
+             status_code >= self.log_status) or
+                (self.slow_threshold is not None and
+                 duration >= self.slow_threshold)):
+            self.log_function(handler)
+
+    def get_route(self, handler):
+        """Return the route pattern that matched a request.
+
+        :param tornado.web.RequestHandler handler: the request handler
+        :rtype: str
+
+        The pattern is found by looking up the handler class in the
+        application's rules, including the rules for other hosts and
+        the rules of nested routers.  The patterns of the nested
+        routers that the request passed through come first, separated
+        by spaces.  A class that is mounted once is cached per class.
+        When a class is mounted more than once, the request is matched
+        against its rules and the result is cached per host and path.
+        If the class is not found, the class name is used instead.
+
+        """
+        handler_class = handler.__class__
+        try:
+            routes = self._routes[handler_class]
+        except KeyError:
+            routes = [(_route_name(matchers), matchers)
+                      for target, matchers in _iter_routes(
+                          handler.application)
+                      if target is handler_class]
+            if not routes:
+                routes = '{0}.{1}'.format(handler_class.__module__,
+                                          handler_class.__name__)
+            elif len(routes) == 1:
+                routes = routes[0][0]
+            self._routes[handler_class] = routes
+        if not isinstance(routes, list):
+            return routes
+
+        request = handler.request
+        key = (handler_class, request.host, request.path)
+        try:
+            return self._paths[key]
+        except KeyError:
+            pass
+        route = routes[0][0]
+        for name, matchers in routes:
+            if all(_matches(matcher, request) for matcher in matchers):
+                route = name
+                break
+        if len(self._paths) >= MAX_CACHED_PATHS:
+            self._paths.clear()
+        self._paths[key] = route
+        return route
+
+    def flush(self):
+        """Log a summary record for each key and reset the counters."""
+        stats, self.stats = self.stats, {}
+        for (method, route, status_class), value in sorted(stats.items()):
+            summary = value.as_dict()
+            summary.update({'method': method, 'route': route,
+                            'status_class': status_class,
+                            'interval': self.interval})
+            self.logger.log(logging.INFO, '', summary)
+
+    def start(self):
+        """Start logging summaries on the current IOLoop."""
+        if self._callback is None:
+            self._callback = ioloop.PeriodicCallback(
+                self.flush, self.interval * 1000.0)
+            self._callback.start()
+
+    def stop(self):
+        """Stop the periodic summaries and log the pending counts."""
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+        self.flush()
+
+
+def _iter_routes(application):
+    """Yield the handler classes with the matchers that lead to them."""
+    router = getattr(application, 'default_router', None)
+    if router is not None:
+        return _iter_rules(router.rules, (), set())
+    return _iter_rules(  # pragma no cover -- tornado < 4.5
+        [spec for _, specs in application.handlers for spec in specs], (),
+        set())
+
+
+def _iter_rules(rules, parents, seen):
+    # rules added with add_handlers for other hosts and nested routers
+    # are reached through the default router's targets
+    for rule in rules:
+        target = getattr(rule, 'handler_class', None) or \
+            getattr(rule, 'target', None)
+        matcher = getattr(rule, 'matcher', rule)
+        nested = getattr(target, 'rules', None)
+        if nested is not None:
+            if id(target) not in seen:
+                seen.add(id(target))
+                for route in _iter_rules(nested, parents + (matcher, ),
+                                         seen):
+                    yield route
+            continue
+        if target is not None and _regex(matcher) is not None:
+            yield target, parents + (matcher, )
+
+
+def _regex(matcher):
+    # only path matchers have a regex, host matchers have host_pattern
+    return getattr(matcher, 'regex', None)
+
+
+def _route_name(matchers):
+    return ' '.join(_regex(matcher).pattern for matcher in matchers
+                    if _regex(matcher) is not None)
+
+
+def _matches(matcher, request):
+    match = getattr(matcher, 'match', None)
+    if match is not None:
+        return match(request) is not None
+    return matcher.regex.match(request.path) is not None  # tornado < 4.5
@@ -0,0 +1,244 @@
+"""
+Sample the stacks of slow requests for the access log.
+
+- :class:`StackSampler` samples the stack of the IOLoop thread from a
+    background thread and attributes each sample to the request that
+    was running
+- :class:`ProfilingMixin` registers each request with a sampler and adds
+    a ``profile`` key to the access log line of requests that take
+    longer than :attr:`~ProfilingMixin.profile_threshold`
+
+The ``profile`` key contains the sampling interval in milliseconds,
+the number of samples, and the most common stacks in the collapsed
+format that flame graph tools read: the frames from the request handler
+inwards separated by semicolons, followed by the number of samples.
+
+Profiling is opt-in.  The sampler costs the same whether requests are
+slow or not, so the interval sets the overhead.  A request that is
+faster than the threshold only pays for registering with the sampler.
+
+.. code:: python
+
+    sampler = profiling.StackSampler(interval=0.01)
+    sampler.start()  # on the IOLoop thread
+
+    class RequestHandler(ProfilingMixin, web.RequestHandler):
+        profiler = sampler
+        profile_threshold = 500
+
+"""
+from __future__ import absolute_import
+
+import sys
+import threading
+
+
+class RequestProfile(object):
+    """The stack samples of one request.
+
+    :attr:`samples` maps tuples of ``(code, line number)`` pairs, from
+    the request handler inwards, to the number of times that they were
+    sampled.
+
+    """
+
+    __slots__ = ('samples', 'total')
+
+    def __init__(self):
+        self.samples = {}
+        self.total = 0
+
+    def add(self, stack):
+        """Count a sample of `stack`."""
+        self.samples[stack] = self.samples.get(stack, 0) + 1
+        self.total += 1
+
+    def collapsed(self, limit=None):
+        """Return the samples as collapsed stack lines.
+
+        :param int limit: the maximum number of stacks to return.  The
+            most common stacks are returned first.
+        :rtype: list
+
+        """
+        counts = sorted(self.samples.items(), key=lambda item: -item[1])
+        return ['{0} {1}'.format(';'.join(_describe(code, line)
+                                          for code, line in stack), count)
+                for stack, count in counts[:limit]]
+
+
+def _describe(code, line):
+    return '{0} ({1}:{2})'.format(getattr(code, 'co_qualname', code.co_name),
+                                  code.co_filename, line)
+
+
+class StackSampler(object):
+    """Samples the stack of a thread at a fixed interval.
+
+    :param float interval: the number of seconds between samples
+    :param int max_depth: the maximum number of frames in a sample.
+        The innermost frames are kept.
+
+    Requests are registered with their request handler.  Each sample
+    walks the stack of the sampled thread and is counted for the
+    innermost registered request handler whose methods are running.
+    The sampled stack starts at the outermost method of that handler.
+    Samples taken while no handler method is running, for example in
+    a callback of a client library, are counted in
+    :attr:`unattributed`.
+
+    """
+
+    def __init__(self, interval=0.01, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.thread_id = None
+        self.unattributed = 0
+        self._requests = {}
+        self._codes = set()
+        self._class_codes = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        """Is the sampler thread running?"""
+        return self._thread is not None
+
+    def start(self, thread_id=None):
+        """Start sampling.
+
+        :param int thread_id: the thread to sample.  This defaults to the
+            calling thread, so call it on the IOLoop thread.
+
+        """
+        if self._thread is not None:
+            return
+        if thread_id is None:
+            thread_id = threading.current_thread().ident
+        self.thread_id = thread_id
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='sprockets.logging.profiling')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and wait for the sampler thread to exit."""
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopped.set()
+            thread.join()
+
+    def register(self, handler):
+        """Attribute samples of `handler`'s methods to a new profile.
+
+        :param tornado.web.RequestHandler handler: the request handler
+        :rtype: RequestProfile
+
+        """
+        profile = RequestProfile()
+        cls = type(handler)
+        with self._lock:
+            if cls not in self._class_codes:
+                self._class_codes[cls] = _method_codes(cls)
+                self._codes.update(self._class_codes[cls])
+            self._requests[handler] = profile
+        return profile
+
+    def unregister(self, handler):
+        """Stop sampling the request that `handler` is processing."""
+        with self._lock:
+            self._requests.pop(handler, None)
+
+    def sample(self):
+        """Take one sample of the sampled thread."""
+        if not self._requests:
+            return
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        profile = handler = None
+        with self._lock:
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code, frame.f_lineno))
+                if code in self._codes:
+                    owner = frame.f_locals.get('self')
+                    if handler is None and owner in self._requests:
+                        handler = owner
+                        profile = self._requests[owner]
+                    if owner is handler:
+                        depth = len(stack)
+                frame = frame.f_back
+            if profile is None:
+                self.unattributed += 1
+                return
+            del stack[min(depth, self.max_depth):]
+            stack.reverse()
+            profile.add(tuple(stack))
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+
+def _method_codes(cls):
+    """Return the code objects of the methods of `cls`."""
+    codes = set()
+    for klass in cls.__mro__:
+        for value in vars(klass).values():
+            while hasattr(value, '__wrapped__'):
+                value = value.__wrapped__
+            code = getattr(value, '__code__', None)
+            if code is not None:
+                codes.add(code)
+    return codes
+
+
+class ProfilingMixin(object):
+    """Adds a stack profile to the access log of slow requests.
+
+    This must come before :class:`tornado.web.RequestHandler` in the
+    class bases, and request handlers that implement :meth:`prepare`
+    must call the parent's implementation.  Nothing is recorded unless
+    :attr:`profiler` is set to a running :class:`StackSampler`.
+
+    """
+
+    #: the sampler to register requests with
+    profiler = None
+
+    #: add the profile to requests that take this many milliseconds
+    profile_threshold = 1000
+
+    #: the maximum number of stacks in the access log
+    profile_max_stacks = 25
+
+    request_profile = None
+
+    def prepare(self):
+        profiler = self.profiler
+        if profiler is not None and profiler.running:
+            self.request_profile = profiler.register(self)
+        return super(ProfilingMixin, self).prepare()
+
+    def on_finish(self):
+        if self.request_profile is not None:
+            self.profiler.unregister(self)
+            self.request_profile = None
+        super(ProfilingMixin, self).on_finish()
+
+    def get_access_log_fields(self):
+        parent = super(ProfilingMixin, self)
+        fields = getattr(parent, 'get_access_log_fields', dict)()
+        profile = self.request_profile
+        if profile is not None:
+            self.profiler.unregister(self)
+            if profile.total and (1000.0 * self.request.request_time() >=
+                                  self.profile_threshold):
+                fields['profile'] = {
+                    'interval': 1000.0 * self.profiler.interval,
+                    'samples': profile.total,
+                    'stacks': profile.collapsed(self.profile_max_stacks)}
+        return fields
@@ -0,0 +1,95 @@
+"""
+Selecting and redacting request values for access logs.
+
+- :class:`FieldSelector` picks the headers or query arguments that
+    :class:`~sprockets.logging.AccessLogFunction` includes in the log
+
+"""
+from __future__ import absolute_import
+
+REDACTED = '[REDACTED]'
+TRUNCATED = '...'
+
+try:
+    _text_types = (str, unicode)
+except NameError:  # pragma no cover
+    _text_types = (str, )
+
+#: headers that usually contain credentials
+SENSITIVE_HEADERS = ('Authorization', 'Cookie', 'Proxy-Authorization',
+                     'Set-Cookie', 'X-Api-Key')
+
+
+def _lower_set(names):
+    if names is None:
+        return None
+    if isinstance(names, _text_types):
+        names = [names]
+    return frozenset(name.lower() for name in names)
+
+
+class FieldSelector(object):
+    """Selects, redacts and truncates the values in a mapping.
+
+    :param list allow: if set, only these names are included
+    :param list deny: names that are never included
+    :param list redact: names whose values are replaced with
+        :data:`REDACTED`.  Each item of a list value is replaced so the
+        value keeps its shape.
+    :param int max_length: values longer than this are truncated and
+        end with :data:`TRUNCATED`
+
+    Names are compared case-insensitively.  The lists are converted
+    into lowercase sets when the selector is created and values are
+    only read for the names that are included.
+
+    """
+
+    def __init__(self, allow=None, deny=None, redact=None, max_length=None):
+        self.allow = _lower_set(allow)
+        self.deny = _lower_set(deny) or frozenset()
+        self.redact = _lower_set(redact) or frozenset()
+        self.max_length = max_length
+
+    def select(self, mapping, convert=None):
+        """Return the selected values from `mapping`.
+
+        :param mapping: the mapping to select values from
+        :param convert: optional function that is applied to each
+            selected value before it is truncated
+        :rtype: dict
+
+        """
+        allow, deny, redact = self.allow, self.deny, self.redact
+        selected = {}
+        for name in mapping:
+            lowered = name.lower()
+            if (allow is not None and lowered not in allow) or \
+                    lowered in deny:
+                continue
+            value = mapping[name]
+            if lowered in redact:
+                if isinstance(value, list):
+                    selected[name] = [REDACTED] * len(value)
+                else:
+                    selected[name] = REDACTED
+                continue
+            if convert is not None:
+                value = convert(value)
+            if self.max_length is not None:
+                value = self.truncate(value)
+            selected[name] = value
+        return selected
+
+    def truncate(self, value):
+        """Truncate a string or each string in a list.
+
+        :param value: the value to truncate
+        :returns: the truncated value
+
+        """
+        if isinstance(value, list):
+            return [self.truncate(item) for item in value]
+        if isinstance(value, _text_types) and len(value) > self.max_length:
+            return value[:self.max_length] + TRUNCATED
+        return value
@@ -0,0 +1,275 @@
+"""
+Flight recorder that keeps recent log records in a memory-mapped file.
+
+- :class:`RingBufferHandler` writes formatted records into a fixed-size
+    ring in a memory-mapped file
+- :func:`read_records` returns the records in a ring file from oldest
+    to newest
+
+The handler is meant to capture full DEBUG detail without writing it
+anywhere.  Records are copied into a shared memory mapping so appending
+one does not make a system call, and the operating system writes the
+pages to the file even if the process crashes.  After an incident, the
+recent records can be printed with::
+
+    python -m sprockets.logging.ringbuffer /var/run/app/flight.ring
+
+The handler can be configured with :func:`logging.config.dictConfig`
+next to a handler that writes less detail to stdout:
+
+.. code:: python
+
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'json',
+            'level': 'INFO',
+        },
+        'recorder': {
+            '()': 'sprockets.logging.ringbuffer.RingBufferHandler',
+            'path': '/var/run/app/flight-{pid}.ring',
+            'size': 16777216,
+            'formatter': 'json',
+            'level': 'DEBUG',
+        },
+    }
+
+"""
+from __future__ import absolute_import
+
+import argparse
+import logging
+import mmap
+import os
+import struct
+import sys
+
+from sprockets.logging import handlers, stats
+
+#: identifies ring files and their layout version
+MAGIC = b'SPRKRB01'
+
+#: marks the start of each record, as in JSON text sequences (RFC 7464)
+RECORD_SEPARATOR = b'\x1e'
+
+# magic, capacity, write offset, next sequence number, wrap count
+_HEADER = struct.Struct('>8sQQQQ')
+_HEADER_SIZE = 64
+_POSITION = struct.Struct('>QQQ')
+_POSITION_OFFSET = 16
+# separator, payload length, sequence number
+_FRAME = struct.Struct('>cIQ')
+
+
+class RingBufferHandler(handlers.EncodingMixin, logging.Handler):
+    """Writes formatted records into a memory-mapped ring file.
+
+    :param str path: the file to write to.  ``{pid}`` is replaced with
+        the process ID so that forked processes use their own files.
+    :param int size: the size of the record area in bytes.  The oldest
+        records are overwritten once it is full.
+
+    If the file exists and has the same size, new records are appended
+    after the ones that it already contains so that restarting a crashed
+    process does not erase the records that led up to the crash.
+
+    Records are formatted before the handler lock is acquired and the
+    lock is only held while the bytes are copied into the ring.  Records
+    that are larger than the ring are counted in :attr:`dropped`.
+    Formatters with a ``format_bytes`` method, such as
+    :class:`~sprockets.logging.JSONRequestFormatter`, are used to
+    produce the record's bytes directly.
+
+    """
+
+    def __init__(self, path, size=16777216):
+        logging.Handler.__init__(self)
+        if size <= _FRAME.size:
+            raise ValueError('size must be larger than {0}'.format(
+                _FRAME.size))
+        self.path_template = path
+        self.size = size
+        self.dropped = 0
+        stats.STATS.register_handler(self)
+        self.path = None
+        self._map = None
+        self._pid = None
+        self._offset = 0
+        self._sequence = 0
+        self._wraps = 0
+
+    def _open(self):
+        self.acquire()
+        try:
+            if self._pid == os.getpid():
+                return
+            self.path = self.path_template.format(pid=os.getpid())
+            total = _HEADER_SIZE + self.size
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size != total:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, total)
+                self._map = mmap.mmap(fd, total)
+            finally:
+                os.close(fd)
+            magic, capacity, offset, sequence, wraps = _HEADER.unpack_from(
+                self._map, 0)
+            if magic == MAGIC and capacity == self.size and offset <= \
+                    capacity:
+                self._offset, self._sequence, self._wraps = (
+                    offset, sequence, wraps)
+            else:
+                self._offset = self._sequence = self._wraps = 0
+                _HEADER.pack_into(self._map, 0, MAGIC, self.size, 0, 0, 0)
+            self._pid = os.getpid()
+        finally:
+            self.release()
+
+    def handle(self, record):
+        # the lock is taken in emit around the copy instead of around
+        # formatting as logging.Handler.handle would
+        result = self.filter(record)
+        if result:
+            self.emit(record)
+        return result
+
+    def emit(self, record):
+        try:
+            if self._pid != os.getpid():
+                self._open()
+            data = self.encode(record)
+            length = _FRAME.size + len(data)
+            if length > self.size:
+                self.dropped += 1
+                return
+            self.acquire()
+            try:
+                self.append(data, length)
+            finally:
+                self.release()
+        except Exception:
+            self.handleError(record)
+
+    def append(self, data, length):
+        """Copy a record into the ring.
+
+        :param bytes data: the formatted record
+        :param int length: the size of the framed record
+
+        This must be called with the handler lock held.
+
+        """
+        offset = self._offset
+        if offset + length > self.size:
+            # records never wrap, mark the rest of the ring as unused
+            if offset < self.size:
+                self._map[_HEADER_SIZE + offset] = 0
+            offset = 0
+            self._wraps += 1
+        start = _HEADER_SIZE + offset
+        _FRAME.pack_into(self._map, start, RECORD_SEPARATOR, len(data),
+                         self._sequence)
+        self._map[start + _FRAME.size:start + length] = data
+        self._offset = offset + length
+        self._sequence += 1
+        # publish the new position after the record is in place
+        _POSITION.pack_into(self._map, _POSITION_OFFSET, self._offset,
+                            self._sequence, self._wraps)
+
+    def flush(self):
+        """Ask the operating system to write the ring to disk.
+
+        This is not needed to survive a process crash, only to survive
+        the machine going down.
+
+        """
+        self.acquire()
+        try:
+            if self._map is not None and self._pid == os.getpid():
+                self._map.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            if self._map is not None and self._pid == os.getpid():
+                self._map.flush()
+                self._map.close()
+            self._map = None
+            self._pid = None
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+
+def _walk(data, offset, end, before):
+    """Return the ``(sequence, payload)`` pairs of consecutive records
+    between `offset` and `end` with sequence numbers below `before`."""
+    records = []
+    while offset + _FRAME.size <= end:
+        separator, length, sequence = _FRAME.unpack_from(
+            data, _HEADER_SIZE + offset)
+        stop = offset + _FRAME.size + length
+        if separator != RECORD_SEPARATOR or stop > end or \
+                sequence >= before or \
+                (records and sequence != records[-1][0] + 1):
+            break
+        start = _HEADER_SIZE + offset + _FRAME.size
+        records.append((sequence, bytes(data[start:start + length])))
+        offset = stop
+    return records
+
+
+def read_records(path):
+    """Return the records in a ring file from oldest to newest.
+
+    :param str path: the ring file to read
+    :rtype: list
+    :raises ValueError: if `path` is not a ring file
+
+    The file may belong to a running or crashed process.  A record that
+    was being written when the process stopped is not returned.
+
+    """
+    with open(path, 'rb') as handle:
+        data = handle.read()
+    if len(data) < _HEADER_SIZE:
+        raise ValueError('{0} is not a ring file'.format(path))
+    magic, capacity, offset, sequence, wraps = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC or len(data) < _HEADER_SIZE + capacity:
+        raise ValueError('{0} is not a ring file'.format(path))
+    offset = min(offset, capacity)
+    newer = _walk(data, 0, offset, sequence)
+    older = []
+    if wraps:
+        # the record that straddled the write position was partially
+        # overwritten, so look for the next intact record after it
+        before = newer[0][0] if newer else sequence
+        position = data.find(RECORD_SEPARATOR, _HEADER_SIZE + offset)
+        while 0 <= position < _HEADER_SIZE + capacity:
+            older = _walk(data, position - _HEADER_SIZE, capacity, before)
+            if older and older[-1][0] + 1 == before:
+                break
+            older = []
+            position = data.find(RECORD_SEPARATOR, position + 1)
+    return [payload for _, payload in older + newer]
+
+
+def main(args=None):
+    """Print the records in ring files, one per line."""
+    parser = argparse.ArgumentParser(
+        prog='python -m sprockets.logging.ringbuffer',
+        description='Print the records in flight recorder ring files.')
+    parser.add_argument('path', nargs='+', help='ring file to read')
+    options = parser.parse_args(args)
+    output = getattr(sys.stdout, 'buffer', sys.stdout)
+    for path in options.path:
+        for payload in read_records(path):
+            output.write(payload + b'\n')
+    output.flush()
+
+
+if __name__ == '__main__':  # pragma no cover
+    main()
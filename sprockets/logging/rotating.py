@@ -0,0 +1,220 @@
+"""
+Write compressed, rotated segments of newline-delimited JSON.
+
+- :class:`CompressedRotatingFileHandler` streams encoded records through
+    a gzip or zstd compressor on a background thread and rotates the
+    output by size and age
+
+Each segment is written to a file that ends in ``.tmp`` and is renamed
+to its final name, such as ``app-20151002T120000-0001-1234.ndjson.gz``,
+once the compressed stream is complete and synced to disk.  Log shippers
+that watch for ``*.ndjson.gz`` files only ever see complete segments.
+
+.. code:: python
+
+    'handlers': {
+        'archive': {
+            '()': 'sprockets.logging.rotating.CompressedRotatingFileHandler',
+            'directory': '/var/log/app',
+            'prefix': 'app',
+            'formatter': 'json',
+        },
+    }
+
+"""
+from __future__ import absolute_import
+
+import errno
+import os
+import time
+import zlib
+
+from sprockets.logging import handlers, stats
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+AUTO = 'auto'
+
+
+def _gzip_compressor(level):
+    # a window size of 31 writes the gzip header and trailer
+    return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 31)
+
+
+def _zstd_compressor(level):
+    level = 3 if level is None else level
+    try:
+        from compression import zstd
+    except ImportError:
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return zstd.ZstdCompressor(level=level)
+
+
+#: compression name to file suffix and compressor factory
+_CODECS = {GZIP: ('.gz', _gzip_compressor),
+           ZSTD: ('.zst', _zstd_compressor)}
+
+
+def _select_codec(name):
+    """Return the name of the codec to use for `name`."""
+    if name == AUTO:
+        candidates = [ZSTD, GZIP]
+    elif name in _CODECS:
+        candidates = [name]
+    else:
+        raise ValueError('unknown compression {0!r}'.format(name))
+    for candidate in candidates:
+        try:
+            _CODECS[candidate][1](None)
+        except ImportError:
+            continue
+        return candidate
+    return GZIP
+
+
+class _Segment(object):
+    """One compressed output file."""
+
+    __slots__ = ('path', 'temporary', 'fd', 'compressor', 'opened', 'size')
+
+    def __init__(self, path, compressor):
+        self.path = path
+        self.temporary = path + '.tmp'
+        self.compressor = compressor
+        self.fd = os.open(self.temporary,
+                          os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        self.opened = time.time()
+        self.size = 0
+
+    def write(self, data):
+        self._write(self.compressor.compress(data))
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                written = os.write(self.fd, view)
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                raise
+            view = view[written:]
+            self.size += written
+
+    def finish(self):
+        """Complete the compressed stream and publish the segment."""
+        try:
+            self._write(self.compressor.flush())
+            os.fsync(self.fd)
+        finally:
+            os.close(self.fd)
+        os.rename(self.temporary, self.path)
+
+    def abandon(self):
+        """Close the file without publishing it."""
+        os.close(self.fd)
+
+
+class CompressedRotatingFileHandler(handlers.BatchingHandler):
+    """Writes compressed segments of encoded records to a directory.
+
+    :param str directory: the directory to write segments to
+    :param str prefix: the start of each segment's file name
+    :param str compression: ``gzip``, ``zstd``, or ``auto`` to use zstd
+        when it is available.  zstd requires Python 3.14 or the
+        `zstandard`_ package and falls back to gzip without them.
+    :param int compress_level: the compression level.  This defaults to
+        6 for gzip and 3 for zstd.
+    :param int max_bytes: start a new segment once the compressed file
+        reaches about this many bytes
+    :param float interval: start a new segment once the current one is
+        this many seconds old
+    :param int batch_bytes: hand the pending records to the compression
+        thread once this many bytes are waiting
+    :param float flush_interval: maximum number of seconds that records
+        wait before they are compressed
+    :param int max_pending_bytes: records that arrive while this many
+        bytes are waiting for the compression thread are dropped and
+        counted in :attr:`dropped`
+
+    Records are formatted in the calling thread, using the formatter's
+    ``format_bytes`` method when it has one, and are appended to a list
+    under a lock that is only held for the append.  Compression,
+    writing, and rotation happen on a background thread so the logging
+    thread never waits for them.
+
+    Segments are named after `prefix`, the UTC time that they were
+    started, a sequence number, and the process ID.  Records compressed
+    by :meth:`flush` are not visible to log shippers until their segment
+    is finished by rotation or :meth:`close`.  Call :meth:`close` when
+    the application stops to finish the last segment.  A segment
+    that was still being written when a process crashed keeps its
+    ``.tmp`` name.
+
+    .. _zstandard: https://pypi.org/project/zstandard/
+
+    """
+    terminator = b'\n'
+
+    def __init__(self, directory, prefix='log', compression=GZIP,
+                 compress_level=None, max_bytes=67108864, interval=3600.0,
+                 batch_bytes=65536, flush_interval=1.0,
+                 max_pending_bytes=16777216):
+        handlers.BatchingHandler.__init__(self, batch_bytes, flush_interval,
+                                          max_pending_bytes)
+        self.directory = directory
+        self.prefix = prefix
+        self.compression = _select_codec(compression)
+        self.compress_level = compress_level
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.segments = 0
+        self._segment = None
+
+    def _reset(self):
+        # the open segment belongs to the parent process
+        if self._segment is not None:
+            self._segment.abandon()
+            self._segment = None
+
+    def write_pending(self):
+        """Compress the pending records and rotate the segment if needed.
+
+        This is called by the compression thread and blocks while the
+        records are compressed.
+
+        """
+        with self._io_lock:
+            batch = self._take_pending()
+            segment = self._segment
+            if segment is not None and (
+                    segment.size >= self.max_bytes or
+                    time.time() - segment.opened >= self.interval):
+                self._finish_segment()
+            if batch:
+                if self._segment is None:
+                    self._segment = self._open_segment()
+                data = b''.join(batch)
+                self._segment.write(data)
+                stats.STATS.bytes_emitted += len(data)
+                if self._segment.size >= self.max_bytes:
+                    self._finish_segment()
+
+    def _open_segment(self):
+        self.segments += 1
+        name = '{0}-{1}-{2:04d}-{3}.ndjson{4}'.format(
+            self.prefix, time.strftime('%Y%m%dT%H%M%S', time.gmtime()),
+            self.segments, os.getpid(), _CODECS[self.compression][0])
+        compressor = _CODECS[self.compression][1](self.compress_level)
+        return _Segment(os.path.join(self.directory, name), compressor)
+
+    def _finish_segment(self):
+        segment, self._segment = self._segment, None
+        if segment is not None:
+            segment.finish()
+
+    def _finish(self):
+        self.write_pending()
+        with self._io_lock:
+            self._finish_segment()
@@ -0,0 +1,180 @@
+"""
+Sampling and rate limiting for access logs.
+
+- :class:`SamplingPolicy` decides whether a request is logged and at
+    what sample rate
+- :class:`TokenBucket` is the rate limiter used for each route
+
+Use a policy with :class:`~sprockets.logging.AccessLogFunction`:
+
+.. code:: python
+
+    policy = SamplingPolicy(status_rates={'2xx': 0.01},
+                            path_rates={r'/status$': 0.0},
+                            rate_limits={r'/api/': (100, 200)},
+                            slow_threshold=250)
+    app = web.Application(routes,
+                          log_function=AccessLogFunction(sampling=policy))
+
+"""
+from __future__ import absolute_import
+
+import random
+import re
+import threading
+import time
+
+try:
+    _monotonic = time.monotonic
+except AttributeError:  # pragma no cover
+    _monotonic = time.time
+
+
+class TokenBucket(object):
+    """Rate limiter that allows bursts.
+
+    :param float rate: the number of tokens added each second
+    :param int burst: the maximum number of tokens that are available
+        at one time.  This defaults to `rate`.
+
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self.tokens = self.burst
+        self.updated = _monotonic()
+        self.suppressed = 0
+        self._lock = threading.Lock()
+
+    def consume(self):
+        """Take a token from the bucket.
+
+        :returns: :data:`True` if a token was available
+        :rtype: bool
+
+        The number of times that a token was not available since the
+        last successful call is kept in :attr:`suppressed`.
+
+        """
+        with self._lock:
+            now = _monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return True
+            self.suppressed += 1
+            return False
+
+    def reset_suppressed(self):
+        """Return and clear the suppressed count."""
+        with self._lock:
+            suppressed, self.suppressed = self.suppressed, 0
+        return suppressed
+
+
+class SamplingPolicy(object):
+    """Decides which requests are written to the access log.
+
+    :param float default_rate: the sample rate for requests that do not
+        match any other rule
+    :param dict status_rates: sample rates by status code.  Keys are
+        either a status code such as ``404`` or a status class such as
+        ``'2xx'``.  Specific codes take precedence.
+    :param dict path_rates: sample rates by request path.  Keys are
+        regular expressions that are matched against the start of the
+        path.  The first matching expression wins and path rates take
+        precedence over status rates.
+    :param dict rate_limits: token bucket rate limits by route.  Keys
+        are regular expressions like the ones in `path_rates` and
+        values are ``(rate, burst)`` pairs or a rate.  Each expression
+        is a separate route.
+    :param int always_log_status: requests with this status code or
+        higher are always logged.  :data:`None` disables this rule.
+    :param float slow_threshold: requests that take at least this many
+        milliseconds are always logged.  :data:`None` disables this rule.
+
+    The rules are compiled when the policy is created.  The sample rate
+    that applied to a logged request is returned from :meth:`sample` so
+    that it can be included in the log line and used to scale counts
+    back up.
+
+    """
+
+    def __init__(self, default_rate=1.0, status_rates=None, path_rates=None,
+                 rate_limits=None, always_log_status=400,
+                 slow_threshold=None):
+        self.default_rate = float(default_rate)
+        self.always_log_status = always_log_status
+        self.slow_threshold = slow_threshold
+        self.status_rates, self.status_class_rates = {}, {}
+        for key, rate in (status_rates or {}).items():
+            key = str(key).lower()
+            if key.endswith('xx'):
+                self.status_class_rates[int(key[0])] = float(rate)
+            else:
+                self.status_rates[int(key)] = float(rate)
+        self.path_rates = [(re.compile(pattern), float(rate))
+                           for pattern, rate in _items(path_rates)]
+        self.rate_limits = []
+        for pattern, limit in _items(rate_limits):
+            if not isinstance(limit, (list, tuple)):
+                limit = (limit, )
+            self.rate_limits.append((re.compile(pattern), TokenBucket(*limit)))
+        self.random = random.random
+
+    def get_rate(self, status_code, path):
+        """Return the sample rate for a request.
+
+        :param int status_code: the response status code
+        :param str path: the request path
+        :rtype: float
+
+        """
+        for pattern, rate in self.path_rates:
+            if pattern.match(path):
+                return rate
+        try:
+            return self.status_rates[status_code]
+        except KeyError:
+            return self.status_class_rates.get(status_code // 100,
+                                               self.default_rate)
+
+    def sample(self, status_code, path, duration):
+        """Decide whether a request should be logged.
+
+        :param int status_code: the response status code
+        :param str path: the request path
+        :param float duration: the request duration in milliseconds
+        :returns: :data:`None` if the request should not be logged,
+            otherwise a ``(sample_rate, suppressed)`` pair where
+            `suppressed` is the number of sampled requests on the same
+            route that were dropped by the rate limit since the last
+            one that was logged
+        :rtype: tuple
+
+        """
+        if ((self.always_log_status is not None and
+             status_code >= self.always_log_status) or
+                (self.slow_threshold is not None and
+                 duration >= self.slow_threshold)):
+            return 1.0, 0
+        rate = self.get_rate(status_code, path)
+        if rate < 1.0 and (rate <= 0.0 or self.random() >= rate):
+            return None
+        for pattern, bucket in self.rate_limits:
+            if pattern.match(path):
+                if not bucket.consume():
+                    return None
+                return rate, bucket.reset_suppressed()
+        return rate, 0
+
+
+def _items(mapping):
+    if mapping is None:
+        return []
+    if isinstance(mapping, dict):
+        return list(mapping.items())
+    return list(mapping)
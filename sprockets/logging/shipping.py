@@ -0,0 +1,236 @@
+"""
+Ship batches of encoded records to a log collector.
+
+- :class:`ShippingHandler` sends records to a collector agent over UDP,
+    a unix datagram socket, or a persistent TCP or unix stream
+    connection
+
+Sending one datagram or making one write per record spends more time
+in system calls than in logging.  The handler collects records in the
+logging thread and a background thread sends them in batches: datagram
+transports pack as many newline-terminated records as fit into each
+datagram, and stream transports write many records at once, each with
+the four byte big-endian length prefix that
+:class:`~sprockets.logging.funnel.LogFunnel` reads.
+
+.. code:: python
+
+    handler = ShippingHandler(('127.0.0.1', 5170), transport=UDP)
+    handler.setFormatter(sprockets.logging.JSONRequestFormatter())
+    logging.getLogger().addHandler(handler)
+
+"""
+from __future__ import absolute_import
+
+import errno
+import socket
+import time
+
+from sprockets.logging import handlers, stats
+from sprockets.logging.funnel import _HEADER
+
+UDP = 'udp'
+UNIX_DATAGRAM = 'unix-datagram'
+TCP = 'tcp'
+UNIX = 'unix'
+
+#: transport name to socket family, socket type, and default
+#: datagram size
+_TRANSPORTS = {
+    UDP: (socket.AF_INET, socket.SOCK_DGRAM, 1472),
+    TCP: (socket.AF_INET, socket.SOCK_STREAM, None),
+}
+if hasattr(socket, 'AF_UNIX'):
+    _TRANSPORTS[UNIX_DATAGRAM] = (socket.AF_UNIX, socket.SOCK_DGRAM, 16384)
+    _TRANSPORTS[UNIX] = (socket.AF_UNIX, socket.SOCK_STREAM, None)
+
+
+def pack_datagrams(records, max_size):
+    """Pack records into newline-delimited datagrams.
+
+    :param list records: the encoded records
+    :param int max_size: the largest datagram to build.  A record that
+        is larger than this is packed on its own.
+    :returns: an iterator of ``(datagram, record count)`` tuples
+
+    """
+    batch, size = [], 0
+    for record in records:
+        if batch and size + len(record) + 1 > max_size:
+            batch.append(b'')
+            yield b'\n'.join(batch), len(batch) - 1
+            batch, size = [], 0
+        batch.append(record)
+        size += len(record) + 1
+    if batch:
+        batch.append(b'')
+        yield b'\n'.join(batch), len(batch) - 1
+
+
+class ShippingHandler(handlers.BatchingHandler):
+    """Sends batches of encoded records to a collector.
+
+    :param address: the collector's ``(host, port)`` tuple for the
+        ``udp`` and ``tcp`` transports, or socket path for the ``unix``
+        and ``unix-datagram`` transports
+    :param str transport: ``udp``, ``unix-datagram``, ``tcp``, or
+        ``unix``
+    :param int max_datagram_size: the largest datagram to send.  This
+        defaults to 1472 bytes for UDP, which fits in a 1500 byte
+        Ethernet frame, and 16384 bytes for unix datagrams.
+    :param int batch_bytes: wake the sending thread once this many bytes
+        are pending
+    :param float flush_interval: maximum number of seconds that records
+        wait before being sent
+    :param int max_pending_bytes: records that arrive while this many
+        bytes are waiting to be sent are dropped
+    :param float send_timeout: maximum number of seconds to wait while
+        connecting or sending
+    :param float min_backoff: seconds to wait before reconnecting after
+        the first failure
+    :param float max_backoff: the longest wait between reconnection
+        attempts.  The wait doubles after each failure up to this.
+
+    The number of records that were lost is available as
+    :attr:`dropped` and the number of failed connections and sends as
+    :attr:`failures`.  Records are lost when more than
+    `max_pending_bytes` are waiting, when a datagram or stream write
+    fails, and when records are still pending after :meth:`close`.
+    Records wait while the collector cannot be reached, so a collector
+    that is restarted loses at most the batch that was being sent plus
+    what overflowed while it was down.
+
+    """
+
+    def __init__(self, address, transport=UDP, max_datagram_size=None,
+                 batch_bytes=65536, flush_interval=0.5,
+                 max_pending_bytes=4194304, send_timeout=1.0,
+                 min_backoff=0.1, max_backoff=30.0):
+        if transport not in _TRANSPORTS:
+            raise ValueError('unknown transport {0!r}'.format(transport))
+        handlers.BatchingHandler.__init__(self, batch_bytes, flush_interval,
+                                          max_pending_bytes)
+        family, socket_type, default_size = _TRANSPORTS[transport]
+        self.address = address
+        self.transport = transport
+        self.family = family
+        self.socket_type = socket_type
+        self.max_datagram_size = max_datagram_size or default_size
+        self.send_timeout = send_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.sent = 0
+        self.failures = 0
+        self._socket = None
+        self._delay = 0
+        self._retry_at = 0
+
+    def _reset(self):
+        # the connection belongs to the parent process
+        self._socket = None
+        self._delay, self._retry_at = 0, 0
+
+    def send_pending(self, force=False):
+        """Send the pending records.
+
+        :param bool force: try to connect even if the backoff delay has
+            not passed
+        :returns: were the pending records sent?
+        :rtype: bool
+
+        Records stay pending while the collector cannot be connected to.
+
+        """
+        with self._io_lock:
+            if not self._pending:
+                return True
+            if self._socket is None:
+                if not force and time.time() < self._retry_at:
+                    return False
+                try:
+                    self._connect()
+                except (socket.error, OSError):
+                    self._backoff()
+                    return False
+            batch = self._take_pending()
+            if not batch:
+                return True
+            if self.socket_type == socket.SOCK_DGRAM:
+                return self._send_datagrams(batch)
+            return self._send_stream(batch)
+
+    def _connect(self):
+        sock = socket.socket(self.family, self.socket_type)
+        try:
+            sock.settimeout(self.send_timeout)
+            sock.connect(self.address)
+        except Exception:
+            sock.close()
+            raise
+        self._socket = sock
+
+    def _backoff(self):
+        self._delay = min(max(self._delay * 2, self.min_backoff),
+                          self.max_backoff)
+        self._retry_at = time.time() + self._delay
+        self.failures += 1
+
+    def _disconnect(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        self._backoff()
+
+    def _send_datagrams(self, batch):
+        unsent = len(batch)
+        for datagram, count in pack_datagrams(batch,
+                                              self.max_datagram_size):
+            try:
+                self._socket.send(datagram)
+            except socket.timeout:
+                self.dropped += count
+            except (socket.error, OSError) as error:
+                if error.errno == errno.EMSGSIZE:
+                    self.dropped += count
+                else:
+                    self.dropped += unsent
+                    self._disconnect()
+                    return False
+            else:
+                self.sent += count
+                stats.STATS.bytes_emitted += len(datagram)
+            unsent -= count
+        self._delay = 0
+        return True
+
+    def _send_stream(self, batch):
+        frames = []
+        for record in batch:
+            frames.append(_HEADER.pack(len(record)))
+            frames.append(record)
+        data = b''.join(frames)
+        try:
+            self._socket.sendall(data)
+        except (socket.error, OSError):
+            # the collector discards a partially sent frame when the
+            # connection closes, so the whole batch is lost
+            self.dropped += len(batch)
+            self._disconnect()
+            return False
+        self.sent += len(batch)
+        stats.STATS.bytes_emitted += len(data)
+        self._delay = 0
+        return True
+
+    def write_pending(self):
+        """Send the pending records unless waiting to reconnect."""
+        self.send_pending()
+
+    def _finish(self):
+        # make a last attempt to send and count what is left as lost
+        self.send_pending(force=True)
+        with self._io_lock:
+            self.dropped += len(self._take_pending())
+            if self._socket is not None:
+                self._socket.close()
+                self._socket = None
@@ -0,0 +1,196 @@
+"""
+Statistics about the logging pipeline itself.
+
+- :data:`STATS` is the :class:`PipelineStats` instance that the
+    formatter, filter, and handlers in this package update
+- :func:`snapshot` returns the current statistics as a dictionary
+- :class:`StatsReporter` periodically logs the statistics
+
+The counters are plain integers that are updated without locking so
+that they are cheap enough to leave enabled.  Updates from different
+threads can occasionally be lost, which makes the numbers approximate
+when several threads log at the same time.
+
+"""
+from __future__ import absolute_import
+
+import bisect
+import logging
+import threading
+import time
+import weakref
+
+#: the clock used to time formatting
+clock = getattr(time, 'perf_counter', time.time)
+
+#: default bucket bounds for the format time histogram in microseconds
+FORMAT_TIME_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+
+class Histogram(object):
+    """Fixed bucket histogram.
+
+    :param tuple bounds: sorted upper bounds of the buckets
+
+    """
+
+    __slots__ = ('bounds', 'counts', 'count', 'total')
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        """Add a value to the histogram."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def as_dict(self):
+        """Return the histogram as a JSON-ready dictionary."""
+        buckets = dict((str(bound), count) for bound, count
+                       in zip(self.bounds, self.counts))
+        buckets['+Inf'] = self.counts[-1]
+        return {'count': self.count, 'sum': self.total, 'buckets': buckets}
+
+
+class PipelineStats(object):
+    """Counters for the logging pipeline.
+
+    :param tuple format_time_buckets: bucket bounds for the format time
+        histogram in microseconds
+
+    """
+
+    def __init__(self, format_time_buckets=FORMAT_TIME_BUCKETS):
+        self.format_time_buckets = format_time_buckets
+        self._queues = weakref.WeakSet()
+        self._handlers = weakref.WeakSet()
+        self.reset()
+
+    def reset(self):
+        """Set every counter back to zero."""
+        self.records = {}
+        self.bytes_emitted = 0
+        self.filtered = 0
+        self.encoder_failures = 0
+        self.traceback_failures = 0
+        self.format_time = Histogram(self.format_time_buckets)
+
+    def record_formatted(self, levelname, elapsed):
+        """Count a formatted record.
+
+        :param str levelname: the level of the record
+        :param float elapsed: seconds spent formatting the record
+
+        """
+        try:
+            self.records[levelname] += 1
+        except KeyError:
+            self.records[levelname] = 1
+        self.format_time.observe(elapsed * 1e6)
+
+    def register_handler(self, handler):
+        """Include a handler's count of lost records in the snapshots.
+
+        :param handler: a handler with a ``dropped`` attribute such as
+            :class:`~sprockets.logging.handlers.FileDescriptorHandler`
+
+        """
+        self._handlers.add(handler)
+
+    def register_queue(self, handler):
+        """Include a queueing handler's depth in the snapshots.
+
+        :param handler: a handler with ``queue``, ``max_size``, and
+            ``dropped`` attributes such as
+            :class:`~sprockets.logging.QueueHandler`
+
+        """
+        self._queues.add(handler)
+        self._handlers.add(handler)
+
+    def snapshot(self):
+        """Return the statistics as a JSON-ready dictionary."""
+        queues = {}
+        for handler in list(self._queues):
+            queue = handler.queue
+            queues[_handler_name(handler)] = {
+                'depth': queue.qsize() if queue else 0,
+                'max_size': handler.max_size,
+                'dropped': handler.dropped}
+        dropped = dict((_handler_name(handler), handler.dropped)
+                       for handler in list(self._handlers))
+        return {'records': dict(self.records),
+                'bytes_emitted': self.bytes_emitted,
+                'filtered': self.filtered,
+                'encoder_failures': self.encoder_failures,
+                'traceback_failures': self.traceback_failures,
+                'format_time_usec': self.format_time.as_dict(),
+                'queues': queues,
+                'dropped': dropped}
+
+
+def _handler_name(handler):
+    return handler.get_name() or '{0}-{1:x}'.format(
+        handler.__class__.__name__, id(handler))
+
+
+#: the statistics that this package's components update by default
+STATS = PipelineStats()
+
+
+def snapshot():
+    """Return the current statistics of :data:`STATS`."""
+    return STATS.snapshot()
+
+
+class StatsReporter(object):
+    """Periodically logs the pipeline statistics.
+
+    :param float interval: the number of seconds between records
+    :param str logger_name: the logger to write the statistics to
+    :param int level: the level of the statistics records
+    :param PipelineStats stats: the statistics to report
+
+    Each record has an empty message and the snapshot as its argument so
+    that :class:`~sprockets.logging.JSONRequestFormatter` emits it as
+    the ``request`` field.  The reporter runs in a daemon thread so it
+    works without an IOLoop.
+
+    """
+
+    def __init__(self, interval=60.0, logger_name='sprockets.logging.stats',
+                 level=logging.INFO, stats=None):
+        self.interval = interval
+        self.logger = logging.getLogger(logger_name)
+        self.level = level
+        self.stats = stats or STATS
+        self._stop = threading.Event()
+        self._thread = None
+
+    def report(self):
+        """Log the current statistics."""
+        self.logger.log(self.level, '', self.stats.snapshot())
+
+    def start(self):
+        """Start reporting in a background thread."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='sprockets.logging.StatsReporter')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop reporting."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
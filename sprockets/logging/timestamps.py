@@ -0,0 +1,97 @@
+"""
+Timestamp rendering for :class:`~sprockets.logging.JSONRequestFormatter`.
+
+- :class:`CachedTimestamp` formats the seconds portion of a timestamp
+    once per second in each thread
+- :func:`get_renderer` returns the renderer for a timestamp format name
+
+"""
+from __future__ import absolute_import
+
+import threading
+import time
+
+LOCAL = 'local'
+RFC3339 = 'rfc3339'
+EPOCH = 'epoch'
+FORMATS = (LOCAL, RFC3339, EPOCH)
+
+
+class CachedTimestamp(object):
+    """Renders record timestamps with a per-thread cache of the seconds.
+
+    :param converter: function that converts seconds since the epoch to
+        a :class:`time.struct_time`
+    :param str datefmt: :func:`time.strftime` format for the seconds
+    :param str msec_format: format string used to append the
+        milliseconds to the formatted seconds.  This is passed the
+        formatted seconds and :attr:`logging.LogRecord.msecs`.  If it
+        is :data:`None`, the milliseconds are omitted.
+
+    Records are usually logged in bursts within the same second so the
+    result of :func:`time.strftime` is cached and only the milliseconds
+    are formatted for each record.  The cache is thread-local so that
+    it does not require a lock.
+
+    """
+
+    def __init__(self, converter=time.localtime,
+                 datefmt='%Y-%m-%d %H:%M:%S', msec_format='%s,%03d'):
+        self.converter = converter
+        self.datefmt = datefmt
+        self.msec_format = msec_format
+        self._cache = threading.local()
+
+    def __call__(self, record):
+        seconds = int(record.created)
+        try:
+            cached_seconds, prefix = self._cache.entry
+        except AttributeError:
+            cached_seconds, prefix = None, None
+        if cached_seconds != seconds:
+            prefix = time.strftime(self.datefmt, self.converter(seconds))
+            self._cache.entry = seconds, prefix
+        if self.msec_format is None:
+            return prefix
+        return self.msec_format % (prefix, record.msecs)
+
+
+def epoch_timestamp(record):
+    """Return the record creation time as seconds since the epoch.
+
+    :param logging.LogRecord record: the record to render
+    :rtype: float
+
+    """
+    return record.created
+
+
+def get_renderer(name, formatter):
+    """Return a timestamp renderer for a format name.
+
+    :param str name: one of ``local``, ``rfc3339``, or ``epoch``
+    :param logging.Formatter formatter: the formatter that the renderer
+        is for.  The ``local`` format uses its ``datefmt`` and
+        ``converter`` attributes in the same manner as
+        :meth:`logging.Formatter.formatTime`.
+    :raises ValueError: if `name` is not a supported format
+
+    The ``local`` format matches :meth:`logging.Formatter.formatTime`,
+    ``rfc3339`` renders UTC times such as ``2015-10-02T12:34:56.789Z``,
+    and ``epoch`` emits a floating point number of seconds.
+
+    """
+    if name == LOCAL:
+        if formatter.datefmt:
+            return CachedTimestamp(formatter.converter, formatter.datefmt,
+                                   None)
+        return CachedTimestamp(
+            formatter.converter,
+            getattr(formatter, 'default_time_format', '%Y-%m-%d %H:%M:%S'),
+            getattr(formatter, 'default_msec_format', '%s,%03d'))
+    if name == RFC3339:
+        return CachedTimestamp(time.gmtime, '%Y-%m-%dT%H:%M:%S', '%s.%03dZ')
+    if name == EPOCH:
+        return epoch_timestamp
+    raise ValueError('timestamp format must be one of {0}, not {1!r}'.format(
+        ', '.join(FORMATS), name))
@@ -0,0 +1,187 @@
+"""
+Break a request's latency down by phase in the access log.
+
+- :class:`RequestTimingMixin` records when each phase of a Tornado
+    request starts and adds a ``timings`` key to the access log line
+- :func:`span` times a block of code, such as a database call, and
+    attributes it to the request that is being processed
+
+The ``timings`` key contains the milliseconds spent in each phase:
+
+``dispatch``
+    from the start of the request until :meth:`prepare` is called,
+    which includes reading the body and routing
+``prepare``
+    in :meth:`prepare`, including any coroutine that it returns
+``handler``
+    from the end of :meth:`prepare` until :meth:`finish` is called,
+    which is usually the request method
+``finish``
+    from the call to :meth:`finish` until the access log is written
+
+Spans are reported under ``spans`` with the number of times that each
+ran and their total duration.
+
+.. code:: python
+
+    class RequestHandler(RequestTimingMixin, web.RequestHandler):
+
+        @gen.coroutine
+        def get(self):
+            with self.timing_span('database'):
+                rows = yield self.query()
+
+"""
+from __future__ import absolute_import
+
+import time
+
+from sprockets.logging import context
+
+#: the clock used to time the phases
+clock = getattr(time, 'monotonic', time.time)
+
+if context.contextvars is not None:
+    _active = context.contextvars.ContextVar('sprockets.logging.timing',
+                                             default=None)
+else:  # pragma no cover
+    _active = context._ThreadLocalVar('sprockets.logging.timing', None)
+
+
+class RequestTimings(object):
+    """The phase timestamps and spans of one request.
+
+    :param float dispatch: milliseconds between the start of the request
+        and the start of the ``prepare`` phase
+
+    """
+
+    __slots__ = ('dispatch', 'marks', 'spans')
+
+    def __init__(self, dispatch):
+        self.dispatch = dispatch
+        self.marks = [('prepare', clock())]
+        self.spans = {}
+
+    def mark(self, phase):
+        """Record the start of `phase`."""
+        self.marks.append((phase, clock()))
+
+    def add(self, name, duration):
+        """Add `duration` milliseconds to the span called `name`."""
+        try:
+            span = self.spans[name]
+        except KeyError:
+            span = self.spans[name] = [0, 0.0]
+        span[0] += 1
+        span[1] += duration
+
+    def span(self, name):
+        """Return a context manager that times a span called `name`."""
+        return _Span(self, name)
+
+    def as_dict(self):
+        """Return the timings as a JSON-ready dictionary.
+
+        The last phase ends when this is called.
+
+        """
+        timings = {'dispatch': self.dispatch}
+        marks = self.marks + [(None, clock())]
+        for (phase, start), (_, end) in zip(marks, marks[1:]):
+            timings[phase] = timings.get(phase, 0.0) + 1000.0 * (end - start)
+        if self.spans:
+            timings['spans'] = dict(
+                (name, {'count': count, 'duration': total})
+                for name, (count, total) in self.spans.items())
+        return timings
+
+
+class _Span(object):
+
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            self.timings.add(self.name, 1000.0 * (clock() - self.start))
+
+
+def span(name):
+    """Time a block of code as part of the active request.
+
+    :param str name: the name of the span in the access log
+    :returns: a context manager
+
+    The request is found through the :mod:`contextvars` context that
+    :class:`RequestTimingMixin` sets in :meth:`prepare`, so this can be
+    used by code that does not have access to the request handler.
+    Outside of a request, the block is not timed.
+
+    """
+    return _Span(_active.get(), name)
+
+
+class RequestTimingMixin(object):
+    """Records the phases of a request for the access log.
+
+    This must come before :class:`tornado.web.RequestHandler` in the
+    class bases, and request handlers that implement :meth:`prepare`
+    must call the parent's implementation first.  The timings are added
+    to the access log line that
+    :func:`~sprockets.logging.tornado_log_function` and
+    :class:`~sprockets.logging.AccessLogFunction` write.
+
+    The ``handler`` phase starts when Tornado calls the request method,
+    so it does not matter how long the rest of :meth:`prepare` takes or
+    whether it is a coroutine.
+
+    """
+
+    request_timings = None
+
+    def prepare(self):
+        timings = RequestTimings(1000.0 * self.request.request_time())
+        self.request_timings = timings
+        _active.set(timings)
+        name = self.request.method.lower()
+        method = getattr(self, name, None)
+        if method is not None:
+            def timed(*args, **kwargs):
+                # prepare may have run in a copy of the context
+                _active.set(timings)
+                timings.mark('handler')
+                return method(*args, **kwargs)
+            setattr(self, name, timed)
+        return super(RequestTimingMixin, self).prepare()
+
+    def finish(self, chunk=None):
+        if self.request_timings is not None:
+            self.request_timings.mark('finish')
+            # the timed method refers to the handler, removing it breaks
+            # the reference cycle so the handler is freed without the
+            # garbage collector
+            self.__dict__.pop(self.request.method.lower(), None)
+        return super(RequestTimingMixin, self).finish(chunk)
+
+    def timing_span(self, name):
+        """Return a context manager that times a span of this request.
+
+        :param str name: the name of the span in the access log
+
+        """
+        return _Span(self.request_timings, name)
+
+    def get_access_log_fields(self):
+        parent = super(RequestTimingMixin, self)
+        fields = getattr(parent, 'get_access_log_fields', dict)()
+        if self.request_timings is not None:
+            fields['timings'] = self.request_timings.as_dict()
+        return fields
@@ -0,0 +1,126 @@
+"""
+Exception serialization for :class:`~sprockets.logging.JSONRequestFormatter`.
+
+- :class:`ExceptionSerializer` converts ``exc_info`` tuples into
+    dictionaries that are ready to be JSON encoded
+
+"""
+from __future__ import absolute_import
+
+import linecache
+import threading
+
+
+class ExceptionSerializer(object):
+    """Converts exceptions into JSON-ready dictionaries.
+
+    :param int max_depth: the maximum number of stack frames to include.
+        The innermost frames are kept since they are closest to where
+        the exception was raised.  :data:`None` includes every frame.
+    :param bool include_source: include the source line of each frame?
+    :param bool chained: include the exception that caused this one
+        as the ``cause`` key.  This is the exception's ``__cause__`` or
+        its ``__context__`` if the context is not suppressed.
+    :param int cache_size: the number of rendered stacks to remember
+
+    The serialized exception looks like:
+
+    .. code:: python
+
+        {'type': 'RuntimeError',
+         'message': 'something bad happened',
+         'stack': [{'file': 'app.py', 'line': '10', 'func': 'get',
+                    'text': 'raise RuntimeError(...)'}]}
+
+    Rendering the stack reads source lines through :mod:`linecache`
+    which is relatively expensive.  Rendered stacks are cached by the
+    signature of their frames so an exception that is raised from the
+    same place over and over again is only rendered once.  Unlike
+    :func:`traceback.extract_tb`, the source files are not checked for
+    modifications.
+
+    """
+
+    #: the maximum number of chained exceptions that are included
+    max_chain = 5
+
+    def __init__(self, max_depth=None, include_source=True, chained=True,
+                 cache_size=256):
+        self.max_depth = max_depth
+        self.include_source = include_source
+        self.chained = chained
+        self.cache_size = cache_size
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, typ, val, tb):
+        """Return the serialized representation of an exception.
+
+        :param `Exception` typ: Exception type of the exception
+        :param `Exception` instance val: instance of the Exception class
+        :param `traceback` tb: traceback object with the call stack
+        :rtype: dict
+
+        """
+        exc_record = self._serialize(typ, val, tb)
+        if self.chained:
+            current, seen = exc_record, set([id(val)])
+            for _ in range(self.max_chain):
+                cause = self._get_cause(val)
+                if cause is None or id(cause) in seen:
+                    break
+                seen.add(id(cause))
+                val = cause
+                current['cause'] = self._serialize(
+                    type(cause), cause, getattr(cause, '__traceback__', None))
+                current = current['cause']
+        return exc_record
+
+    @staticmethod
+    def _get_cause(val):
+        cause = getattr(val, '__cause__', None)
+        if cause is None and not getattr(val, '__suppress_context__', False):
+            cause = getattr(val, '__context__', None)
+        return cause
+
+    def _serialize(self, typ, val, tb):
+        return {'type': typ.__name__,
+                'message': str(val),
+                'stack': self.render_stack(tb)}
+
+    def render_stack(self, tb):
+        """Return the list of frames in a traceback.
+
+        :param `traceback` tb: traceback object with the call stack
+        :rtype: list
+
+        """
+        signature = []
+        while tb is not None:
+            code = tb.tb_frame.f_code
+            signature.append((code.co_filename, tb.tb_lineno, code.co_name))
+            tb = tb.tb_next
+        if self.max_depth is not None:
+            signature = signature[-self.max_depth:] if self.max_depth else []
+        signature = tuple(signature)
+
+        try:
+            return self._cache[signature]
+        except KeyError:
+            pass
+
+        stack = []
+        for file_name, line_no, func_name in signature:
+            if self.include_source:
+                text = linecache.getline(file_name, line_no).strip()
+            else:
+                text = None
+            stack.append({'file': file_name,
+                          'line': str(line_no),
+                          'func': func_name,
+                          'text': text})
+        with self._lock:
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[signature] = stack
+        return stack
@@ -1,12 +1,34 @@
+import datetime
+import gc
+import gzip
+import io
 import json
 import logging
+import logging.config
+import multiprocessing
 import os
+import re
+import select
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
 import unittest
 import uuid
+import weakref
 
-from tornado import web, testing
+from tornado import gen, httputil, ioloop, locks, routing, testing, web
 
 import sprockets.logging
+from sprockets.logging import (buffering, context, dedup, encoders, frames,
+                               funnel, handlers, metrics, profiling,
+                               redaction, ringbuffer, rotating, sampling,
+                               shipping, stats, timing, tracebacks)
 
 
 def setup_module():
@@ -47,10 +69,14 @@ class TornadoLoggingTestMixin(object):
         self.recorder = RecordingHandler()
         root_logger = logging.getLogger()
         root_logger.addHandler(self.recorder)
+        self.root_level = root_logger.level
+        root_logger.setLevel(logging.DEBUG)
 
     def tearDown(self):
         super(TornadoLoggingTestMixin, self).tearDown()
-        logging.getLogger().removeHandler(self.recorder)
+        root_logger = logging.getLogger()
+        root_logger.removeHandler(self.recorder)
+        root_logger.setLevel(self.root_level)
 
 
 class TornadoLogFunctionTests(TornadoLoggingTestMixin,
@@ -128,6 +154,248 @@ class TornadoLogFunctionTests(TornadoLoggingTestMixin,
         self.assertEqual(self.access_record.args['correlation_id'], cid)
 
 
+class AccessLogFunctionTests(TornadoLoggingTestMixin,
+                             testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.policy = sprockets.logging.SamplingPolicy(
+            status_rates={'2xx': 1.0}, path_rates={'/status': 0.0})
+        return web.Application(
+            [web.url('/', SimpleHandler), web.url('/status', SimpleHandler)],
+            log_function=sprockets.logging.AccessLogFunction(
+                sampling=self.policy))
+
+    @property
+    def access_records(self):
+        return [record for record, _ in self.recorder.emitted
+                if record.name == 'tornado.access']
+
+    def test_that_sample_rate_is_included(self):
+        self.fetch('/')
+        self.assertEqual(self.access_records[0].args['sample_rate'], 1.0)
+        self.assertEqual(self.access_records[0].args['status_code'], 204)
+
+    def test_that_unsampled_requests_are_not_logged(self):
+        self.fetch('/status')
+        self.assertEqual(self.access_records, [])
+
+    def test_that_errors_are_always_logged(self):
+        self.fetch('/status?status_code=503')
+        self.assertEqual(self.access_records[0].levelno, logging.ERROR)
+        self.assertEqual(self.access_records[0].args['sample_rate'], 1.0)
+
+    def test_that_rate_limited_requests_are_counted(self):
+        self.policy.rate_limits.append(
+            (re.compile('/'), sampling.TokenBucket(0.001, 1)))
+        for _ in range(3):
+            self.fetch('/')
+        self.assertEqual(len(self.access_records), 1)
+        self.policy.rate_limits[0][1].tokens = 1.0
+        self.fetch('/')
+        self.assertEqual(self.access_records[-1].args['rate_limited'], 2)
+
+
+class AccessLogAggregatorTests(TornadoLoggingTestMixin,
+                               testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.aggregator = metrics.AccessLogAggregator(
+            interval=0.01, buckets=(1000, 10))
+        return web.Application([web.url(r'/items/\d+', SimpleHandler),
+                                web.url(r'/things/\w+', SimpleHandler)],
+                               log_function=self.aggregator)
+
+    @property
+    def access_records(self):
+        return [record for record, _ in self.recorder.emitted
+                if record.name == 'tornado.access']
+
+    def test_that_requests_are_not_logged_individually(self):
+        self.fetch('/items/1')
+        self.fetch('/items/2?status_code=404')
+        self.assertEqual(self.access_records, [])
+
+    def test_that_errors_are_logged_individually(self):
+        self.fetch('/items/1?runtime_error=failed')
+        self.assertEqual(self.access_records[0].args['status_code'], 500)
+
+    def test_that_flush_logs_a_summary_per_key(self):
+        self.fetch('/items/1')
+        self.fetch('/items/2')
+        self.fetch('/items/3?status_code=404')
+        self.aggregator.flush()
+        summaries = [record.args for record in self.access_records]
+        self.assertEqual([(s['method'], s['route'], s['status_class'],
+                           s['count'], s['errors']) for s in summaries],
+                         [('GET', r'/items/\d+$', '2xx', 2, 0),
+                          ('GET', r'/items/\d+$', '4xx', 1, 1)])
+        self.assertEqual(summaries[0]['duration']['buckets'],
+                         {'10': 2, '1000': 0, '+Inf': 0})
+        self.aggregator.flush()
+        self.assertEqual(len(self.access_records), 2)
+
+    def test_that_summaries_are_logged_periodically(self):
+        self.aggregator.start()
+        self.fetch('/items/1')
+        self.io_loop.run_sync(lambda: gen.sleep(0.05))
+        self.aggregator.stop()
+        self.assertEqual(self.access_records[0].args['count'], 1)
+
+    def get_route(self, application, handler_class, path, host='localhost'):
+        handler = handler_class.__new__(handler_class)
+        handler.application = application
+        handler.request = httputil.HTTPServerRequest(
+            'GET', path, headers=httputil.HTTPHeaders({'Host': host}))
+        return self.aggregator.get_route(handler)
+
+    def test_that_host_and_nested_routes_are_found(self):
+
+        class HostHandler(SimpleHandler):
+            pass
+
+        class NestedHandler(SimpleHandler):
+            pass
+
+        application = self.get_app()
+        application.add_handlers(r'example\.com',
+                                 [web.url(r'/hosts/\d+', HostHandler)])
+        application.wildcard_router.add_rules([routing.Rule(
+            routing.PathMatches(r'/nested/.*'), routing.RuleRouter(
+                [routing.Rule(routing.PathMatches(r'/nested/\w+'),
+                              NestedHandler)]))])
+        self.assertEqual(
+            self.get_route(application, HostHandler, '/hosts/1',
+                           'example.com'), r'/hosts/\d+$')
+        self.assertEqual(
+            self.get_route(application, NestedHandler, '/nested/abc'),
+            r'/nested/.*$ /nested/\w+$')
+        self.assertEqual(self.get_route(application, SimpleHandler,
+                                        '/items/1'), r'/items/\d+$')
+
+    def test_that_classes_on_several_routes_are_counted_per_route(self):
+        self.fetch('/items/1')
+        self.fetch('/things/a')
+        self.fetch('/things/b')
+        self.aggregator.flush()
+        self.assertEqual(
+            sorted((record.args['route'], record.args['count'])
+                   for record in self.access_records),
+            [(r'/items/\d+$', 1), (r'/things/\w+$', 2)])
+
+    def test_that_matched_routes_are_cached_per_path(self):
+        self.fetch('/things/a')
+        self.fetch('/things/a')
+        self.assertEqual(list(self.aggregator._paths.values()),
+                         [r'/things/\w+$'])
+
+
+class AccessLogRedactionTests(TornadoLoggingTestMixin,
+                              testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        return web.Application(
+            [web.url('/', SimpleHandler)],
+            log_function=sprockets.logging.AccessLogFunction(
+                header_allowlist=['accept', 'authorization', 'x-long'],
+                redact_headers=redaction.SENSITIVE_HEADERS,
+                query_denylist=['token'], redact_query_args=['password'],
+                max_value_length=8))
+
+    def get_access_payload(self, url, **kwargs):
+        self.fetch(url, **kwargs)
+        for record, _ in self.recorder.emitted:
+            if record.name == 'tornado.access':
+                return record.args
+
+    def test_that_only_allowed_headers_are_logged(self):
+        payload = self.get_access_payload(
+            '/', headers={'Accept': '*/*', 'Cookie': 'secret=1'})
+        self.assertEqual(payload['headers'], {'Accept': '*/*'})
+
+    def test_that_redacted_headers_are_replaced(self):
+        payload = self.get_access_payload(
+            '/', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(payload['headers']['Authorization'],
+                         redaction.REDACTED)
+
+    def test_that_long_values_are_truncated(self):
+        payload = self.get_access_payload(
+            '/?name=abcdefghijkl', headers={'X-Long': 'abcdefghijkl'})
+        self.assertEqual(payload['headers']['X-Long'], 'abcdefgh...')
+        self.assertEqual(payload['query_args']['name'], ['abcdefgh...'])
+
+    def test_that_query_arguments_are_filtered(self):
+        payload = self.get_access_payload('/?token=1&password=2&page=3')
+        self.assertEqual(payload['query_args'],
+                         {'password': [redaction.REDACTED], 'page': ['3']})
+
+
+class FieldSelectorTests(unittest.TestCase):
+
+    def test_that_redacted_values_keep_their_shape(self):
+        selector = redaction.FieldSelector(redact=['token', 'key'])
+        self.assertEqual(selector.select({'token': ['a', 'b'], 'key': 'c'}),
+                         {'token': [redaction.REDACTED, redaction.REDACTED],
+                          'key': redaction.REDACTED})
+
+    def test_that_names_are_case_insensitive(self):
+        selector = redaction.FieldSelector(allow=['X-Keep'], deny=['X-DROP'])
+        self.assertEqual(selector.select({'x-keep': 1, 'x-drop': 2,
+                                          'other': 3}), {'x-keep': 1})
+
+    def test_that_values_are_only_read_when_selected(self):
+        class Mapping(dict):
+            def __getitem__(self, name):
+                if name == 'big':
+                    raise AssertionError('value of big was read')
+                return dict.__getitem__(self, name)
+        selector = redaction.FieldSelector(deny=['big'])
+        self.assertEqual(selector.select(Mapping(big='x', small='y')),
+                         {'small': 'y'})
+
+
+class SamplingPolicyTests(unittest.TestCase):
+
+    def test_that_status_codes_take_precedence_over_classes(self):
+        policy = sampling.SamplingPolicy(
+            default_rate=0.5, status_rates={'2xx': 0.1, 204: 0.2})
+        self.assertEqual(policy.get_rate(200, '/'), 0.1)
+        self.assertEqual(policy.get_rate(204, '/'), 0.2)
+        self.assertEqual(policy.get_rate(302, '/'), 0.5)
+
+    def test_that_paths_take_precedence_over_status(self):
+        policy = sampling.SamplingPolicy(status_rates={'2xx': 0.1},
+                                         path_rates=[('/health', 0.0),
+                                                     ('/', 0.25)])
+        self.assertEqual(policy.get_rate(200, '/health'), 0.0)
+        self.assertEqual(policy.get_rate(200, '/other'), 0.25)
+
+    def test_that_random_sampling_uses_rate(self):
+        policy = sampling.SamplingPolicy(default_rate=0.25)
+        policy.random = lambda: 0.3
+        self.assertIsNone(policy.sample(200, '/', 1.0))
+        policy.random = lambda: 0.2
+        self.assertEqual(policy.sample(200, '/', 1.0), (0.25, 0))
+
+    def test_that_slow_requests_are_always_logged(self):
+        policy = sampling.SamplingPolicy(default_rate=0.0,
+                                         slow_threshold=100)
+        self.assertIsNone(policy.sample(200, '/', 99.0))
+        self.assertEqual(policy.sample(200, '/', 100.0), (1.0, 0))
+
+    def test_that_always_log_status_can_be_disabled(self):
+        policy = sampling.SamplingPolicy(default_rate=0.0,
+                                         always_log_status=None)
+        self.assertIsNone(policy.sample(500, '/', 1.0))
+
+    def test_that_token_bucket_allows_bursts(self):
+        bucket = sampling.TokenBucket(0.001, burst=2)
+        self.assertTrue(bucket.consume())
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+        self.assertEqual(bucket.reset_suppressed(), 1)
+
+
 class JSONFormatterTests(TornadoLoggingTestMixin, testing.AsyncHTTPTestCase):
 
     def setUp(self):
@@ -162,6 +430,273 @@ class JSONFormatterTests(TornadoLoggingTestMixin, testing.AsyncHTTPTestCase):
             self.assertNotIn('traceback', entry)
 
 
+class JSONFormatterFieldTests(unittest.TestCase):
+
+    def make_record(self, msg='message %s', args=('value',), **kwargs):
+        kwargs.update({'msg': msg, 'args': args, 'name': 'some.logger',
+                       'levelno': logging.INFO, 'lineno': 10,
+                       'module': 'mod', 'filename': 'mod.py'})
+        return logging.makeLogRecord(kwargs)
+
+    def test_that_default_fields_match_previous_output(self):
+        formatter = sprockets.logging.JSONRequestFormatter()
+        record = self.make_record()
+        self.assertEqual(
+            formatter.format(record),
+            json.dumps({'name': 'some.logger', 'module': 'mod',
+                        'message': 'message value', 'level': 'INFO',
+                        'line_number': 10, 'process': record.processName,
+                        'timestamp': formatter.formatTime(record),
+                        'thread': record.threadName, 'file': 'mod.py'}))
+
+    def test_that_request_is_emitted_without_message(self):
+        formatter = sprockets.logging.JSONRequestFormatter()
+        entry = json.loads(formatter.format(
+            self.make_record('', {'status_code': 200})))
+        self.assertNotIn('message', entry)
+        self.assertEqual(entry['request'], {'status_code': 200})
+
+    def test_that_request_is_dropped_regardless_of_field_order(self):
+        formatter = sprockets.logging.JSONRequestFormatter(
+            fields=['request', 'message'])
+        self.assertEqual(
+            json.loads(formatter.format(self.make_record())),
+            {'message': 'message value'})
+        self.assertEqual(
+            json.loads(formatter.format(
+                self.make_record('', {'status_code': 200}))),
+            {'request': {'status_code': 200}})
+
+    def test_that_dict_config_class_form_is_accepted(self):
+        logging.config.dictConfig({
+            'version': 1,
+            'disable_existing_loggers': False,
+            'formatters': {'json': {
+                'class': 'sprockets.logging.JSONRequestFormatter',
+                'format': '{message}', 'datefmt': '%Y', 'style': '{'}},
+            'handlers': {'recorder': {'()': RecordingHandler,
+                                      'formatter': 'json'}},
+            'loggers': {'dict-config-formatter': {'handlers': ['recorder'],
+                                                  'propagate': False}},
+        })
+        logger = logging.getLogger('dict-config-formatter')
+        handler, = logger.handlers
+        try:
+            self.assertIsInstance(handler.formatter,
+                                  sprockets.logging.JSONRequestFormatter)
+            self.assertEqual(handler.formatter.datefmt, '%Y')
+            logger.warning('styled')
+            _, output = handler.emitted[0]
+            self.assertEqual(json.loads(output)['message'], 'styled')
+        finally:
+            logger.removeHandler(handler)
+
+    def test_that_style_is_passed_positionally(self):
+        formatter = sprockets.logging.JSONRequestFormatter(
+            '{message}', None, '{')
+        self.assertIsInstance(formatter._style, logging.StrFormatStyle)
+
+    def test_that_unknown_options_are_rejected(self):
+        with self.assertRaises(TypeError):
+            sprockets.logging.JSONRequestFormatter(encodr='json')
+
+    def test_that_properties_are_top_level_keys(self):
+        formatter = sprockets.logging.JSONRequestFormatter(
+            properties=['correlation_id'])
+        entry = json.loads(formatter.format(
+            self.make_record(correlation_id='CID')))
+        self.assertEqual(entry['correlation_id'], 'CID')
+
+    def test_that_fields_can_be_renamed_and_kept_when_empty(self):
+        formatter = sprockets.logging.JSONRequestFormatter(fields=[
+            {'key': 'logger', 'attribute': 'name'},
+            {'key': 'msg', 'attribute': 'message'},
+            {'key': 'cid', 'attribute': 'correlation_id',
+             'drop_empty': False}])
+        self.assertEqual(json.loads(formatter.format(self.make_record())),
+                         {'logger': 'some.logger', 'msg': 'message value',
+                          'cid': None})
+
+
+class TimestampTests(unittest.TestCase):
+
+    def make_record(self, created):
+        record = logging.makeLogRecord({'msg': 'message'})
+        record.created = created
+        record.msecs = int((created - int(created)) * 1000) + 0.0
+        return record
+
+    def test_that_local_format_matches_format_time(self):
+        formatter = sprockets.logging.JSONRequestFormatter()
+        for created in (1443789296.25, 1443789296.75, 1443789297.0):
+            record = self.make_record(created)
+            self.assertEqual(
+                json.loads(formatter.format(record))['timestamp'],
+                logging.Formatter().formatTime(record))
+
+    def test_that_datefmt_is_honored(self):
+        formatter = sprockets.logging.JSONRequestFormatter(datefmt='%Y')
+        record = self.make_record(1443789296.25)
+        self.assertEqual(json.loads(formatter.format(record))['timestamp'],
+                         '2015')
+
+    def test_that_rfc3339_format_is_utc(self):
+        formatter = sprockets.logging.JSONRequestFormatter(
+            timestamp_format='rfc3339')
+        record = self.make_record(1443789296.25)
+        self.assertEqual(json.loads(formatter.format(record))['timestamp'],
+                         '2015-10-02T12:34:56.250Z')
+
+    def test_that_epoch_format_is_a_number(self):
+        formatter = sprockets.logging.JSONRequestFormatter(
+            timestamp_format='epoch')
+        record = self.make_record(1443789296.25)
+        self.assertEqual(json.loads(formatter.format(record))['timestamp'],
+                         1443789296.25)
+
+    def test_that_overridden_format_time_is_used(self):
+        class Formatter(sprockets.logging.JSONRequestFormatter):
+            def formatTime(self, record, datefmt=None):
+                return 'now'
+        entry = json.loads(Formatter().format(self.make_record(1.0)))
+        self.assertEqual(entry['timestamp'], 'now')
+
+    def test_that_invalid_format_is_rejected(self):
+        with self.assertRaises(ValueError):
+            sprockets.logging.JSONRequestFormatter(timestamp_format='bad')
+
+
+def raise_error(depth, message='failure'):
+    if depth:
+        raise_error(depth - 1, message)
+    raise RuntimeError(message)
+
+
+def capture_exc_info(func, *args):
+    try:
+        func(*args)
+    except Exception:
+        return sys.exc_info()
+
+
+class ExceptionSerializerTests(unittest.TestCase):
+
+    def test_that_stack_matches_extract_tb(self):
+        typ, val, tb = capture_exc_info(raise_error, 2)
+        exc_record = tracebacks.ExceptionSerializer()(typ, val, tb)
+        self.assertEqual(exc_record['type'], 'RuntimeError')
+        self.assertEqual(exc_record['message'], 'failure')
+        self.assertEqual(
+            [(f['file'], f['line'], f['func'], f['text'])
+             for f in exc_record['stack']],
+            [(f[0], str(f[1]), f[2], f[3])
+             for f in traceback.extract_tb(tb)])
+
+    def test_that_max_depth_keeps_innermost_frames(self):
+        exc_info = capture_exc_info(raise_error, 5)
+        stack = tracebacks.ExceptionSerializer(max_depth=2)(
+            *exc_info)['stack']
+        self.assertEqual(len(stack), 2)
+        self.assertEqual(stack[-1]['text'], 'raise RuntimeError(message)')
+
+    def test_that_source_can_be_omitted(self):
+        exc_info = capture_exc_info(raise_error, 1)
+        stack = tracebacks.ExceptionSerializer(include_source=False)(
+            *exc_info)['stack']
+        self.assertTrue(all(frame['text'] is None for frame in stack))
+
+    def test_that_repeated_stacks_are_rendered_once(self):
+        serializer = tracebacks.ExceptionSerializer()
+        first = serializer(*capture_exc_info(raise_error, 1, 'first'))
+        second = serializer(*capture_exc_info(raise_error, 1, 'second'))
+        self.assertIs(first['stack'], second['stack'])
+        self.assertEqual(second['message'], 'second')
+
+    def test_that_chained_exceptions_are_included(self):
+        def chained():
+            try:
+                raise_error(0, 'inner')
+            except RuntimeError as error:
+                raise ValueError('outer: {0}'.format(error))
+        exc_record = tracebacks.ExceptionSerializer()(
+            *capture_exc_info(chained))
+        self.assertEqual(exc_record['type'], 'ValueError')
+        self.assertEqual(exc_record['cause']['message'], 'inner')
+        exc_record = tracebacks.ExceptionSerializer(chained=False)(
+            *capture_exc_info(chained))
+        self.assertNotIn('cause', exc_record)
+
+    def test_that_records_without_exc_info_skip_serialization(self):
+        formatter = sprockets.logging.JSONRequestFormatter()
+        calls = []
+        formatter.extract_exc_record = lambda *args: calls.append(args)
+        formatter.format(logging.makeLogRecord({'msg': 'no error'}))
+        formatter.format(logging.makeLogRecord(
+            {'msg': 'no error', 'exc_info': (None, None, None)}))
+        self.assertEqual(calls, [])
+
+
+def log_through_wrapper(logger, message):
+    logger.info(message)
+
+
+class CurrentFrameTests(TornadoLoggingTestMixin, testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        super(CurrentFrameTests, self).setUp()
+        self.logger = logging.getLogger('frame-tests')
+
+    def tearDown(self):
+        super(CurrentFrameTests, self).tearDown()
+        frames.uninstall()
+        frames._skipped.discard(__file__)
+
+    def get_app(self):
+        return web.Application(
+            [web.url('/', SimpleHandler)],
+            log_function=sprockets.logging.tornado_log_function)
+
+    def test_that_logging_currentframe_is_not_patched_on_import(self):
+        self.assertIsNot(logging.currentframe, frames.currentframe)
+
+    def test_that_direct_caller_is_reported(self):
+        frames.install()
+        line_number = sys._getframe().f_lineno + 1
+        self.logger.info('message')
+        record, _ = self.recorder.emitted[0]
+        self.assertEqual(record.lineno, line_number)
+        self.assertEqual(record.funcName,
+                         'test_that_direct_caller_is_reported')
+
+    def test_that_tornado_log_function_reports_its_caller(self):
+        frames.install()
+        self.fetch('/')
+        for record, _ in self.recorder.emitted:
+            if record.name == 'tornado.access':
+                break
+        self.assertEqual(record.module, 'web')
+
+    def test_that_registered_wrappers_are_skipped(self):
+        frames.install()
+        frames.skip_module(sys.modules[__name__])
+        log_through_wrapper(self.logger, 'message')
+        record, _ = self.recorder.emitted[0]
+        self.assertNotEqual(record.funcName, 'log_through_wrapper')
+
+    def test_that_caller_lookup_can_be_disabled(self):
+        frames.install(find_caller=False)
+        self.logger.info('message')
+        record, _ = self.recorder.emitted[0]
+        self.assertEqual(record.lineno, 0)
+
+    def test_that_uninstall_restores_logging(self):
+        original = logging.currentframe
+        frames.install(find_caller=False)
+        frames.uninstall()
+        self.assertIs(logging.currentframe, original)
+        self.assertIsNotNone(logging._srcfile)
+
+
 class ContextFilterTests(TornadoLoggingTestMixin, unittest.TestCase):
 
     def setUp(self):
@@ -177,6 +712,14 @@ class ContextFilterTests(TornadoLoggingTestMixin, unittest.TestCase):
         _, line = self.recorder.emitted[0]
         self.assertEqual(line, 'error message {CID None}')
 
+    def test_that_appended_properties_are_added(self):
+        log_filter = sprockets.logging.ContextFilter(properties=['first'])
+        log_filter.properties.append('second')
+        record = logging.makeLogRecord({})
+        log_filter.filter(record)
+        self.assertIsNone(record.first)
+        self.assertIsNone(record.second)
+
     def test_that_extras_property_is_used(self):
         self.logger.error('error message',
                           extra={'correlation_id': 'CORRELATION-ID'})
@@ -189,3 +732,1991 @@ class ContextFilterTests(TornadoLoggingTestMixin, unittest.TestCase):
         logger.error('error message')
         _, line = self.recorder.emitted[0]
         self.assertEqual(line, 'error message {CID %s}' % cid)
+
+
+class BlockingStream(object):
+
+    def __init__(self):
+        self.lines = []
+        self.writes = 0
+        self.unblocked = threading.Event()
+
+    def write(self, data):
+        self.unblocked.wait(5)
+        self.writes += 1
+        self.lines.extend(data.splitlines())
+
+    def flush(self):
+        pass
+
+
+class QueueHandlerTests(unittest.TestCase):
+
+    def setUp(self):
+        super(QueueHandlerTests, self).setUp()
+        self.logger = logging.getLogger('queue-tests')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        super(QueueHandlerTests, self).tearDown()
+        for handler in self.logger.handlers[:]:
+            self.logger.removeHandler(handler)
+            handler.close()
+
+    def add_handler(self, **kwargs):
+        handler = sprockets.logging.QueueHandler(**kwargs)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger.addHandler(handler)
+        return handler
+
+    def test_that_records_are_written_in_batches_on_close(self):
+        stream = BlockingStream()
+        stream.unblocked.set()
+        handler = self.add_handler(stream=stream, flush_interval=5)
+        for n in range(10):
+            self.logger.info('message %d', n)
+        handler.close()
+        self.assertEqual(stream.lines, ['message %d' % n for n in range(10)])
+        self.assertEqual(stream.writes, 1)
+
+    def test_that_emit_does_not_block_on_slow_stream(self):
+        stream = BlockingStream()
+        handler = self.add_handler(stream=stream, overflow='drop-newest',
+                                   max_size=2, batch_size=1)
+        start = time.time()
+        for n in range(10):
+            self.logger.info('message %d', n)
+        self.assertLess(time.time() - start, 1.0)
+        self.assertGreater(handler.dropped, 0)
+        stream.unblocked.set()
+
+    def test_that_drop_oldest_keeps_newest_records(self):
+        stream = BlockingStream()
+        handler = self.add_handler(stream=stream, overflow='drop-oldest',
+                                   max_size=2, batch_size=1)
+        self.logger.info('first')
+        while handler.queue.qsize():  # wait for the writer to block
+            time.sleep(0.001)
+        for n in range(5):
+            self.logger.info('message %d', n)
+        stream.unblocked.set()
+        handler.close()
+        self.assertEqual(stream.lines, ['first', 'message 3', 'message 4'])
+        self.assertEqual(handler.dropped, 3)
+
+    def test_that_keep_errors_preserves_error_records(self):
+        stream = BlockingStream()
+        handler = self.add_handler(stream=stream, overflow='keep-errors',
+                                   max_size=2, batch_size=1)
+        self.logger.info('first')
+        while handler.queue.qsize():
+            time.sleep(0.001)
+        self.logger.info('info 1')
+        self.logger.info('info 2')
+        self.logger.info('info 3')
+        self.logger.error('error')
+        stream.unblocked.set()
+        handler.close()
+        self.assertEqual(stream.lines, ['first', 'info 2', 'error'])
+
+    def test_that_invalid_overflow_policy_is_rejected(self):
+        with self.assertRaises(ValueError):
+            sprockets.logging.QueueHandler(overflow='explode')
+
+    def test_that_flush_waits_for_queued_records(self):
+        stream = BlockingStream()
+        stream.unblocked.set()
+        handler = self.add_handler(stream=stream)
+        self.logger.info('message')
+        handler.flush()
+        self.assertEqual(stream.lines, ['message'])
+
+    def test_that_flush_and_close_give_up_on_blocked_stream(self):
+        stream = BlockingStream()
+        handler = self.add_handler(stream=stream, drain_timeout=0.1,
+                                   max_size=1, batch_size=1)
+        self.logger.info('first')
+        while handler.queue.qsize():  # wait for the writer to block
+            time.sleep(0.001)
+        self.logger.info('second')  # fills the queue
+        start = time.time()
+        handler.flush()
+        handler.close()
+        self.assertLess(time.time() - start, 1.0)
+        self.logger.removeHandler(handler)
+        stream.unblocked.set()
+
+    def test_that_target_records_are_snapshotted(self):
+        stream = io.StringIO()
+        target = logging.StreamHandler(stream)
+        handler = self.add_handler(target=target)
+        items = [1]
+        self.logger.info('items %s', items)
+        items.append(2)
+        handler.flush()
+        self.assertEqual(stream.getvalue(), 'items [1]\n')
+
+    def test_that_target_payloads_keep_values_that_are_not_primitives(self):
+        stream = io.StringIO()
+        target = logging.StreamHandler(stream)
+        formatter = sprockets.logging.JSONRequestFormatter(
+            fields=['request'])
+        target.setFormatter(formatter)
+        handler = self.add_handler(target=target)
+        payload = {'id': uuid.UUID(int=5),
+                   'when': datetime.datetime(2015, 10, 2, 12, 30),
+                   'pair': ({'a': 1}, [2])}
+        record = logging.makeLogRecord({'msg': ''})
+        record.args = payload
+        expected = formatter.format(record)
+        self.logger.info('', payload)
+        payload['pair'][0]['a'] = 3
+        handler.flush()
+        self.assertEqual(stream.getvalue(), expected + '\n')
+        self.assertEqual(json.loads(expected)['request']['id'],
+                         str(uuid.UUID(int=5)))
+
+    def test_that_named_target_handler_is_used_with_dict_config(self):
+        stream = io.StringIO()
+        logging.config.dictConfig({
+            'version': 1,
+            'disable_existing_loggers': False,
+            'handlers': {
+                'console': {'class': 'logging.StreamHandler',
+                            'stream': stream},
+                'queued': {'()': 'sprockets.logging.QueueHandler',
+                           'target': 'console',
+                           'overflow': 'keep-errors'},
+            },
+            'loggers': {'queue-tests': {'handlers': ['queued'],
+                                        'propagate': False}},
+        })
+        self.logger.warning('message')
+        for handler in self.logger.handlers:
+            handler.flush()
+        self.assertEqual(stream.getvalue(), 'message\n')
+
+
+class Unprintable(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return 'Unprintable({0})'.format(self.value)
+
+
+class ThreadRecordingFormatter(sprockets.logging.JSONRequestFormatter):
+
+    def format(self, record):
+        self.thread = threading.current_thread()
+        return super(ThreadRecordingFormatter, self).format(record)
+
+
+class DeferredFormatTests(unittest.TestCase):
+
+    def setUp(self):
+        super(DeferredFormatTests, self).setUp()
+        self.stream = BlockingStream()
+        self.handler = sprockets.logging.QueueHandler(stream=self.stream,
+                                                      defer_format=True)
+        self.formatter = ThreadRecordingFormatter()
+        self.handler.setFormatter(self.formatter)
+        self.logger = logging.getLogger('deferred-tests')
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        super(DeferredFormatTests, self).tearDown()
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+
+    def get_entries(self):
+        self.stream.unblocked.set()
+        self.handler.close()
+        return [json.loads(line) for line in self.stream.lines]
+
+    def test_that_formatting_happens_in_writer_thread(self):
+        self.logger.warning('message')
+        self.get_entries()
+        self.assertIsNot(self.formatter.thread, threading.current_thread())
+
+    def test_that_mutated_arguments_do_not_change_output(self):
+        values, obj = [1, 2], Unprintable(1)
+        self.logger.warning('%s %s', values, obj)
+        values.append(3)
+        obj.value = 2
+        self.assertEqual(self.get_entries()[0]['message'],
+                         '[1, 2] Unprintable(1)')
+
+    def test_that_mutated_request_payload_does_not_change_output(self):
+        payload = {'headers': {'Accept': '*/*'}, 'status_code': 200}
+        self.logger.warning('', payload)
+        payload['headers']['Accept'] = 'text/html'
+        payload['status_code'] = 500
+        self.assertEqual(self.get_entries()[0]['request'],
+                         {'headers': {'Accept': '*/*'}, 'status_code': 200})
+
+    def test_that_exception_is_extracted_before_queueing(self):
+        try:
+            raise_error(0, 'deferred')
+        except RuntimeError:
+            self.logger.exception('failed')
+        self.assertEqual(self.get_entries()[0]['traceback']['message'],
+                         'deferred')
+
+
+class FreezeRecordTests(unittest.TestCase):
+
+    def test_that_immutable_arguments_are_not_rendered(self):
+        record = logging.makeLogRecord({'msg': '%s %d', 'args': ('a', 1)})
+        frozen = handlers.freeze_record(record)
+        self.assertEqual(frozen.msg, '%s %d')
+        self.assertIs(frozen.args, record.args)
+
+    def test_that_nested_tuples_are_copied(self):
+        items = [1]
+        record = logging.makeLogRecord({'msg': '', 'args': None})
+        record.args = {'pair': (items, 2)}
+        frozen = handlers.freeze_record(record)
+        items.append(2)
+        self.assertEqual(frozen.args, {'pair': ([1], 2)})
+
+    def test_that_uncopyable_payload_values_become_strings(self):
+        lock = threading.Lock()
+        record = logging.makeLogRecord({'msg': '', 'args': None})
+        record.args = {'lock': lock, 'status_code': 200}
+        frozen = handlers.freeze_record(record)
+        self.assertEqual(frozen.args, {'lock': str(lock),
+                                       'status_code': 200})
+        self.assertEqual(frozen.getMessage(), '')
+
+    def test_that_exc_info_is_replaced_by_rendered_text(self):
+        record = logging.makeLogRecord(
+            {'msg': 'failed', 'exc_info': capture_exc_info(raise_error, 0)})
+        frozen = handlers.freeze_record(record, [logging.Formatter()])
+        self.assertIsNone(frozen.exc_info)
+        self.assertIn('RuntimeError: failure', frozen.exc_text)
+        self.assertIsNotNone(record.exc_info)
+
+    def test_that_messages_without_arguments_are_not_interpolated(self):
+        formatter = sprockets.logging.JSONRequestFormatter()
+        entry = json.loads(formatter.format(
+            logging.makeLogRecord({'msg': '100% done'})))
+        self.assertEqual(entry['message'], '100% done')
+
+
+class EncoderTests(unittest.TestCase):
+
+    payload = {'name': 'tornado.access', 'line_number': 2243,
+               'message': u'caf\xe9 /path "quoted" \U0001f600',
+               'request': {'duration': 12.3456, 'headers': {'Accept': '*/*'},
+                           'floats': [1e-07, -2.5e-08, 1e-10, 1e+22,
+                                      1.5e+300, 0.0001, 5e-324],
+                           'note': 'e-5 "1e-5" \\e-7',
+                           'query_args': {'a': ['1', '2']},
+                           'correlation_id': None, 'status_code': 200}}
+
+    def test_that_stdlib_encoder_matches_json_dumps(self):
+        encoder = encoders.get_encoder('json')
+        self.assertEqual(encoder.dumps(self.payload),
+                         json.dumps(self.payload))
+
+    def test_that_all_backends_produce_identical_output(self):
+        expected = json.dumps(self.payload)
+        for name in ('json', 'ujson', 'auto'):
+            encoder = encoders.get_encoder(name)
+            self.assertEqual(encoder.dumps(self.payload), expected,
+                             'mismatch for {0!r}'.format(encoder))
+            self.assertEqual(encoder.dumps_bytes(self.payload),
+                             expected.encode('ascii'))
+
+    def test_that_unknown_backend_is_rejected(self):
+        with self.assertRaises(ValueError):
+            encoders.get_encoder('not-an-encoder')
+
+    def test_that_unavailable_backend_falls_back_to_stdlib(self):
+        def factory():
+            raise ImportError('not installed')
+        encoders.register('missing', factory)
+        self.assertEqual(encoders.get_encoder('missing').name, 'json')
+
+    def test_that_formatter_uses_configured_encoder(self):
+        formatter = sprockets.logging.JSONRequestFormatter(encoder='auto')
+        record = logging.makeLogRecord({'msg': 'hi %s', 'args': ('there',)})
+        self.assertEqual(formatter.format_bytes(record),
+                         formatter.format(record).encode('ascii'))
+        self.assertEqual(json.loads(formatter.format(record))['message'],
+                         'hi there')
+
+
+class BinaryStreamHandlerTests(unittest.TestCase):
+
+    def test_that_formatter_bytes_are_written_to_buffer(self):
+        stream = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+        handler = sprockets.logging.BinaryStreamHandler(stream)
+        handler.setFormatter(sprockets.logging.JSONRequestFormatter())
+        handler.handle(logging.makeLogRecord({'msg': 'hi', 'name': 'x'}))
+        line = stream.buffer.getvalue()
+        self.assertTrue(line.endswith(b'\n'))
+        self.assertEqual(json.loads(line.decode('ascii'))['message'], 'hi')
+
+    def test_that_plain_formatters_are_utf8_encoded(self):
+        stream = io.BytesIO()
+        handler = sprockets.logging.BinaryStreamHandler(stream)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        handler.handle(logging.makeLogRecord({'msg': u'caf\xe9'}))
+        self.assertEqual(stream.getvalue(), u'caf\xe9\n'.encode('utf-8'))
+
+
+class LogContextTests(unittest.TestCase):
+
+    def setUp(self):
+        super(LogContextTests, self).setUp()
+        self.token = context.clear()
+
+    def tearDown(self):
+        super(LogContextTests, self).tearDown()
+        context.reset(self.token)
+
+    def test_that_bind_adds_values(self):
+        context.bind(correlation_id='CID')
+        context.bind(user='me')
+        self.assertEqual(context.get(), {'correlation_id': 'CID',
+                                         'user': 'me'})
+
+    def test_that_reset_restores_previous_values(self):
+        context.bind(user='me')
+        token = context.bind(user='you')
+        context.reset(token)
+        self.assertEqual(context.get(), {'user': 'me'})
+
+    def test_that_scope_unbinds_on_exit(self):
+        with context.scope(user='me'):
+            self.assertEqual(context.get()['user'], 'me')
+        self.assertEqual(context.get(), {})
+
+    def test_that_coroutines_do_not_leak_values(self):
+        @gen.coroutine
+        def bind_in_coroutine():
+            context.bind(user='coroutine')
+            yield gen.moment
+            raise gen.Return(context.get()['user'])
+        result = ioloop.IOLoop.current().run_sync(bind_in_coroutine)
+        self.assertEqual(result, 'coroutine')
+        self.assertNotIn('user', context.get())
+
+
+class ContextPropagationHandler(web.RequestHandler):
+
+    logger = logging.getLogger('context-tests')
+
+    def prepare(self):
+        context.bind(correlation_id=self.request.headers['Correlation-ID'])
+
+    @gen.coroutine
+    def get(self):
+        yield gen.moment
+        self.logger.info('from coroutine')
+        done = locks.Event()
+        ioloop.IOLoop.current().add_callback(self.log_from_callback, done)
+        yield done.wait()
+        self.set_status(204)
+
+    def log_from_callback(self, done):
+        self.logger.info('from callback')
+        done.set()
+
+
+class ContextFilterPropagationTests(TornadoLoggingTestMixin,
+                                    testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        super(ContextFilterPropagationTests, self).setUp()
+        self.recorder.addFilter(sprockets.logging.ContextFilter(
+            properties=['correlation_id']))
+
+    def get_app(self):
+        return web.Application([web.url('/', ContextPropagationHandler)])
+
+    def test_that_context_reaches_coroutines_and_callbacks(self):
+        self.fetch('/', headers={'Correlation-ID': 'first'})
+        self.fetch('/', headers={'Correlation-ID': 'second'})
+        self.assertEqual(
+            [(record.getMessage(), record.correlation_id)
+             for record, _ in self.recorder.emitted
+             if record.name == 'context-tests'],
+            [('from coroutine', 'first'), ('from callback', 'first'),
+             ('from coroutine', 'second'), ('from callback', 'second')])
+
+    def test_that_extra_values_take_precedence(self):
+        with context.scope(correlation_id='context'):
+            ContextPropagationHandler.logger.info(
+                'message', extra={'correlation_id': 'extra'})
+        record, _ = self.recorder.emitted[-1]
+        self.assertEqual(record.correlation_id, 'extra')
+
+
+def log_from_child(path, child, count):
+    handler = funnel.FunnelHandler(path)
+    handler.setFormatter(sprockets.logging.JSONRequestFormatter())
+    logger = logging.getLogger('funnel-child')
+    logger.propagate = False
+    logger.addHandler(handler)
+    for n in range(count):
+        logger.warning('child %d record %d %s', child, n, 'x' * 5000)
+    handler.close()
+
+
+def send_partial_frame(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(struct.pack('>I', 100) + b'{"partial": ')
+    os._exit(1)
+
+
+class LogFunnelTests(unittest.TestCase):
+
+    def setUp(self):
+        super(LogFunnelTests, self).setUp()
+        self.context = multiprocessing.get_context('fork')
+        self.output = io.BytesIO()
+        self.funnel = funnel.LogFunnel(self.output, batch_bytes=1024)
+        self.funnel.start()
+
+    def tearDown(self):
+        super(LogFunnelTests, self).tearDown()
+        self.funnel.stop()
+
+    def run_children(self, target, *args_list):
+        children = [self.context.Process(target=target, args=args)
+                    for args in args_list]
+        for child in children:
+            child.start()
+        for child in children:
+            child.join(10)
+        self.funnel.stop()
+
+    def test_that_records_from_children_are_not_interleaved(self):
+        self.run_children(log_from_child,
+                          *[(self.funnel.path, child, 50)
+                            for child in range(4)])
+        lines = self.output.getvalue().splitlines()
+        self.assertEqual(len(lines), 200)
+        messages = set(json.loads(line.decode('ascii'))['message']
+                       for line in lines)
+        self.assertEqual(len(messages), 200)
+        self.assertEqual(self.funnel.records, 200)
+
+    def test_that_crashed_child_partial_frame_is_discarded(self):
+        self.run_children(send_partial_frame, (self.funnel.path, ))
+        self.assertEqual(self.output.getvalue(), b'')
+        self.assertEqual(self.funnel.truncated, 1)
+
+    def test_that_oversized_frames_close_the_connection(self):
+        self.funnel.max_record_size = 10
+        self.run_children(log_from_child, (self.funnel.path, 0, 1))
+        self.assertEqual(self.output.getvalue(), b'')
+        self.assertEqual(self.funnel.truncated, 1)
+
+    def test_that_stop_removes_the_socket(self):
+        self.funnel.stop()
+        self.assertFalse(os.path.exists(self.funnel.path))
+
+
+def log_after_fork(handler):
+    inherited = handler._socket
+    handler.handle(logging.makeLogRecord({'msg': 'child'}))
+    handler.close()
+    os._exit(0 if inherited.fileno() == -1 else 1)
+
+
+class FunnelHandlerTests(unittest.TestCase):
+
+    def setUp(self):
+        super(FunnelHandlerTests, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'funnel.sock')
+        self.output = io.BytesIO()
+        self.funnel = funnel.LogFunnel(self.output, path=self.path,
+                                       flush_interval=0.01)
+        self.funnel.start()
+        self.handler = funnel.FunnelHandler(self.path, send_timeout=1.0)
+
+    def tearDown(self):
+        super(FunnelHandlerTests, self).tearDown()
+        self.handler.close()
+        self.funnel.stop()
+        shutil.rmtree(self.tempdir)
+
+    def emit(self, message):
+        self.handler.handle(logging.makeLogRecord({'msg': message}))
+
+    def test_that_inherited_connection_is_closed_in_children(self):
+        self.emit('parent')
+        child = multiprocessing.get_context('fork').Process(
+            target=log_after_fork, args=(self.handler, ))
+        child.start()
+        child.join(10)
+        self.assertEqual(child.exitcode, 0)
+        self.emit('parent again')
+        self.funnel.stop()
+        self.assertEqual(sorted(self.output.getvalue().splitlines()),
+                         [b'child', b'parent', b'parent again'])
+
+    def test_that_oversized_records_are_dropped_before_sending(self):
+        self.handler.max_record_size = 5
+        self.emit('too long')
+        self.emit('short')
+        self.funnel.stop()
+        self.assertEqual(self.output.getvalue(), b'short\n')
+        self.assertEqual(self.handler.dropped, 1)
+        self.assertEqual(self.funnel.truncated, 0)
+
+    def test_that_handler_reconnects_after_a_failure(self):
+        self.emit('first')
+        self.funnel.stop()
+        output = io.BytesIO()
+        self.funnel = funnel.LogFunnel(output, path=self.path)
+        self.funnel.start()
+        self.emit('lost')
+        self.emit('second')
+        self.funnel.stop()
+        self.assertEqual(self.output.getvalue(), b'first\n')
+        self.assertEqual(output.getvalue(), b'second\n')
+        self.assertEqual(self.handler.dropped, 1)
+
+
+class FailingSerializerFormatter(sprockets.logging.JSONRequestFormatter):
+
+    def extract_exc_record(self, typ, val, tb):
+        raise RuntimeError('cannot serialize')
+
+
+class PipelineStatsTests(unittest.TestCase):
+
+    def setUp(self):
+        super(PipelineStatsTests, self).setUp()
+        stats.STATS.reset()
+        self.formatter = sprockets.logging.JSONRequestFormatter()
+
+    def tearDown(self):
+        super(PipelineStatsTests, self).tearDown()
+        stats.STATS.reset()
+
+    def test_that_formatted_records_are_counted_by_level(self):
+        self.formatter.format(logging.makeLogRecord(
+            {'levelname': 'INFO', 'levelno': logging.INFO}))
+        self.formatter.format_bytes(logging.makeLogRecord(
+            {'levelname': 'ERROR', 'levelno': logging.ERROR}))
+        self.formatter.format(logging.makeLogRecord(
+            {'levelname': 'ERROR', 'levelno': logging.ERROR}))
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['records'], {'INFO': 1, 'ERROR': 2})
+        self.assertEqual(snapshot['format_time_usec']['count'], 3)
+        self.assertEqual(
+            sum(snapshot['format_time_usec']['buckets'].values()), 3)
+
+    def test_that_encoder_failures_are_counted_and_recovered(self):
+        record = logging.makeLogRecord({'msg': '', 'args': None})
+        record.args = {'value': object(), 'items': (1, 2)}
+        output = json.loads(self.formatter.format(record))
+        self.assertTrue(output['request']['value'].startswith('<object'))
+        self.assertEqual(output['request']['items'], [1, 2])
+        self.assertEqual(stats.snapshot()['encoder_failures'], 1)
+
+    def test_that_traceback_failures_are_counted(self):
+        formatter = FailingSerializerFormatter()
+        record = logging.makeLogRecord(
+            {'exc_info': capture_exc_info(raise_error, 'boom')})
+        output = json.loads(formatter.format(record))
+        self.assertNotIn('traceback', output)
+        self.assertEqual(stats.snapshot()['traceback_failures'], 1)
+
+    def test_that_disabled_formatters_do_not_collect(self):
+        formatter = sprockets.logging.JSONRequestFormatter(
+            collect_stats=False)
+        formatter.format(logging.makeLogRecord({}))
+        self.assertEqual(stats.snapshot()['records'], {})
+
+    def test_that_context_filter_counts_records(self):
+        log_filter = sprockets.logging.ContextFilter(properties=['x'])
+        log_filter.filter(logging.makeLogRecord({}))
+        self.assertEqual(stats.snapshot()['filtered'], 1)
+
+    def test_that_binary_stream_handler_counts_bytes(self):
+        stream = io.BytesIO()
+        handler = sprockets.logging.BinaryStreamHandler(stream)
+        handler.setFormatter(self.formatter)
+        handler.handle(logging.makeLogRecord({'msg': 'hi'}))
+        self.assertEqual(stats.snapshot()['bytes_emitted'],
+                         len(stream.getvalue()))
+
+    def test_that_queue_depth_and_drops_are_reported(self):
+        stream = BlockingStream()
+        handler = sprockets.logging.QueueHandler(
+            stream=stream, overflow='drop-newest', max_size=2, batch_size=1)
+        handler.set_name('stats-queue')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        try:
+            handler.handle(logging.makeLogRecord({'msg': 'first'}))
+            while handler.queue.qsize():
+                time.sleep(0.001)
+            for n in range(4):
+                handler.handle(logging.makeLogRecord({'msg': n}))
+            queues = stats.snapshot()['queues']
+            self.assertEqual(queues['stats-queue'],
+                             {'depth': 2, 'max_size': 2, 'dropped': 2})
+        finally:
+            stream.unblocked.set()
+            handler.close()
+        self.assertEqual(stats.snapshot()['bytes_emitted'],
+                         len(''.join(line + '\n' for line in stream.lines)))
+
+    def test_that_handler_drops_are_reported(self):
+        ring = ringbuffer.RingBufferHandler(
+            os.path.join(tempfile.gettempdir(), 'unused.ring'))
+        ring.set_name('stats-ring')
+        shipper = shipping.ShippingHandler(('127.0.0.1', 9))
+        shipper.set_name('stats-shipper')
+        ring.dropped, shipper.dropped = 3, 5
+        dropped = stats.snapshot()['dropped']
+        self.assertEqual(dropped['stats-ring'], 3)
+        self.assertEqual(dropped['stats-shipper'], 5)
+        ring.close()
+        shipper.close()
+
+    def test_that_reporter_logs_snapshot(self):
+        recorder = RecordingHandler()
+        logger = logging.getLogger('stats-tests')
+        logger.addHandler(recorder)
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        try:
+            stats.StatsReporter(logger_name='stats-tests').report()
+        finally:
+            logger.removeHandler(recorder)
+        (record, _), = recorder.emitted
+        self.assertEqual(record.levelno, logging.INFO)
+        self.assertEqual(record.getMessage(), '')
+        self.assertIn('format_time_usec', record.args)
+
+    def test_that_reporter_runs_periodically(self):
+        reporter = stats.StatsReporter(interval=0.01,
+                                       logger_name='stats-tests')
+        reports = []
+        reporter.report = lambda: reports.append(1)
+        reporter.start()
+        deadline = time.time() + 5
+        while len(reports) < 2 and time.time() < deadline:
+            time.sleep(0.005)
+        reporter.stop()
+        self.assertGreaterEqual(len(reports), 2)
+
+
+def record_then_crash(path):
+    handler = ringbuffer.RingBufferHandler(path, size=4096)
+    handler.setFormatter(sprockets.logging.JSONRequestFormatter())
+    logger = logging.getLogger('ringbuffer-child')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    for n in range(3):
+        logger.debug('before crash %d', n)
+    os._exit(1)
+
+
+class RingBufferHandlerTests(unittest.TestCase):
+
+    def setUp(self):
+        super(RingBufferHandlerTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'flight.ring')
+
+    def tearDown(self):
+        super(RingBufferHandlerTests, self).tearDown()
+        for name in os.listdir(self.directory):
+            os.unlink(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def write(self, messages, size=4096, path=None):
+        handler = ringbuffer.RingBufferHandler(path or self.path, size)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        for message in messages:
+            handler.handle(logging.makeLogRecord({'msg': message}))
+        handler.close()
+        return handler
+
+    def read(self):
+        return [payload.decode('utf-8')
+                for payload in ringbuffer.read_records(self.path)]
+
+    def test_that_records_are_read_in_order(self):
+        self.write(['first', 'second', 'third'])
+        self.assertEqual(self.read(), ['first', 'second', 'third'])
+
+    def test_that_oldest_records_are_overwritten(self):
+        messages = ['message {0:03d} {1}'.format(n, 'x' * n)
+                    for n in range(100)]
+        self.write(messages, size=1024)
+        records = self.read()
+        self.assertGreater(len(records), 3)
+        self.assertEqual(records, messages[-len(records):])
+
+    def test_that_existing_records_are_kept_when_reopened(self):
+        self.write(['before restart'])
+        self.write(['after restart'])
+        self.assertEqual(self.read(), ['before restart', 'after restart'])
+
+    def test_that_files_of_another_size_are_reset(self):
+        self.write(['old'], size=2048)
+        self.write(['new'])
+        self.assertEqual(self.read(), ['new'])
+
+    def test_that_oversized_records_are_dropped(self):
+        handler = self.write(['small', 'x' * 100], size=64)
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(self.read(), ['small'])
+
+    def test_that_partially_written_records_are_ignored(self):
+        handler = ringbuffer.RingBufferHandler(self.path, 4096)
+        handler.handle(logging.makeLogRecord({'msg': 'complete'}))
+        # a frame that was copied but not published before a crash
+        handler._map[64 + handler._offset] = 0x1e
+        handler._map.close()
+        handler._map = handler._pid = None
+        self.assertEqual(self.read(), ['complete'])
+
+    def test_that_records_survive_a_crash(self):
+        process = multiprocessing.Process(target=record_then_crash,
+                                          args=(self.path, ))
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 1)
+        self.assertEqual([json.loads(record)['message'] for record in
+                          self.read()],
+                         ['before crash 0', 'before crash 1',
+                          'before crash 2'])
+
+    def test_that_pid_is_substituted_into_path(self):
+        path = os.path.join(self.directory, 'flight-{pid}.ring')
+        handler = self.write(['hi'], path=path)
+        self.assertEqual(handler.path, path.format(pid=os.getpid()))
+        self.assertTrue(os.path.exists(handler.path))
+
+    def test_that_handler_is_configurable_with_dict_config(self):
+        logging.config.dictConfig({
+            'version': 1,
+            'disable_existing_loggers': False,
+            'formatters': {'json': {
+                '()': 'sprockets.logging.JSONRequestFormatter'}},
+            'handlers': {'recorder': {
+                '()': 'sprockets.logging.ringbuffer.RingBufferHandler',
+                'path': self.path, 'size': 4096, 'formatter': 'json'}},
+            'loggers': {'ringbuffer-tests': {
+                'handlers': ['recorder'], 'level': 'DEBUG',
+                'propagate': False}},
+        })
+        logger = logging.getLogger('ringbuffer-tests')
+        logger.debug('configured')
+        handler, = logger.handlers
+        logger.removeHandler(handler)
+        handler.close()
+        record, = self.read()
+        self.assertEqual(json.loads(record)['message'], 'configured')
+
+    def test_that_dump_tool_prints_records(self):
+        self.write(['one', 'two'])
+        output = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+        original, sys.stdout = sys.stdout, output
+        try:
+            ringbuffer.main([self.path])
+        finally:
+            sys.stdout = original
+        self.assertEqual(output.buffer.getvalue(), b'one\ntwo\n')
+
+    def test_that_other_files_are_rejected(self):
+        with open(self.path, 'wb') as handle:
+            handle.write(b'not a ring' * 10)
+        with self.assertRaises(ValueError):
+            ringbuffer.read_records(self.path)
+
+
+class BufferedRequestHandler(buffering.RequestBufferMixin, web.RequestHandler):
+
+    logger = logging.getLogger('buffer-tests')
+
+    def get(self):
+        self.logger.debug('detail for %s', self.correlation_id)
+        self.logger.info('progress')
+        self.set_status(int(self.get_query_argument('status', '200')))
+
+
+class SlowBufferedRequestHandler(BufferedRequestHandler):
+    log_buffer_slow_threshold = 0
+
+
+class ConcurrentBufferedRequestHandler(BufferedRequestHandler):
+
+    released = None
+
+    @gen.coroutine
+    def get(self):
+        status = self.get_query_argument('status')
+        self.logger.debug('before %s', status)
+        yield self.released.wait()
+        self.logger.debug('after %s', status)
+        self.set_status(int(status))
+
+
+class RequestBufferTests(TornadoLoggingTestMixin, testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        super(RequestBufferTests, self).setUp()
+        self.recorder.setLevel(logging.INFO)
+        self.handler = buffering.RequestBufferHandler(self.recorder)
+        BufferedRequestHandler.logger.addHandler(self.handler)
+        BufferedRequestHandler.logger.propagate = False
+
+    def tearDown(self):
+        BufferedRequestHandler.logger.removeHandler(self.handler)
+        super(RequestBufferTests, self).tearDown()
+
+    def get_app(self):
+        self.log_function = sprockets.logging.tornado_log_function
+        return web.Application(
+            [web.url('/', BufferedRequestHandler),
+             web.url('/slow', SlowBufferedRequestHandler),
+             web.url('/concurrent', ConcurrentBufferedRequestHandler)],
+            log_function=lambda handler: self.log_function(handler))
+
+    def messages(self):
+        return [record.getMessage() or record.args['status_code']
+                for record, _ in self.recorder.emitted]
+
+    def test_that_debug_records_are_discarded_for_successful_requests(self):
+        self.fetch('/', headers={'Correlation-ID': 'ok'})
+        self.assertEqual(self.messages(), ['progress', 200])
+        self.assertEqual(len(buffering.BUFFERS), 0)
+
+    def test_that_debug_records_are_flushed_for_server_errors(self):
+        self.fetch('/?status=503', headers={'Correlation-ID': 'failed'})
+        self.assertEqual(self.messages(),
+                         ['progress', 'detail for failed', 503])
+        self.assertEqual(len(buffering.BUFFERS), 0)
+
+    def test_that_debug_records_are_flushed_for_slow_requests(self):
+        self.fetch('/slow', headers={'Correlation-ID': 'slow'})
+        self.assertEqual(self.messages(), ['progress', 'detail for slow', 200])
+
+    def test_that_access_log_function_flushes_buffers(self):
+        self.log_function = sprockets.logging.AccessLogFunction()
+        self.fetch('/?status=500', headers={'Correlation-ID': 'failed'})
+        self.assertEqual(self.messages(),
+                         ['progress', 'detail for failed', 500])
+
+    def test_that_buffers_are_discarded_without_package_log_function(self):
+        self.log_function = lambda handler: None
+        self.fetch('/?status=500')
+        self.assertEqual(self.messages(), ['progress'])
+        self.assertEqual(len(buffering.BUFFERS), 0)
+
+    @testing.gen_test
+    def test_that_requests_sharing_a_correlation_id_are_kept_apart(self):
+        ConcurrentBufferedRequestHandler.released = locks.Event()
+        headers = {'Correlation-ID': 'shared'}
+        failed = self.http_client.fetch(self.get_url('/concurrent?status=500'),
+                                        headers=headers, raise_error=False)
+        succeeded = self.http_client.fetch(
+            self.get_url('/concurrent?status=200'), headers=headers)
+        while len(buffering.BUFFERS) < 2:
+            yield gen.moment
+        ConcurrentBufferedRequestHandler.released.set()
+        yield [failed, succeeded]
+        messages = self.messages()
+        self.assertEqual(sorted(m for m in messages if m in (200, 500)),
+                         [200, 500])
+        self.assertEqual([m for m in messages if m not in (200, 500)],
+                         ['before 500', 'after 500'])
+        self.assertEqual(len(buffering.BUFFERS), 0)
+
+    def test_that_records_outside_requests_use_target_level(self):
+        BufferedRequestHandler.logger.debug('dropped')
+        BufferedRequestHandler.logger.info('kept')
+        self.assertEqual(self.messages(), ['kept'])
+
+
+class RequestBuffersTests(unittest.TestCase):
+
+    def test_that_buffer_capacity_is_bounded(self):
+        buffers = buffering.RequestBuffers(capacity=2)
+        buffer = buffers.open('request')
+        target = RecordingHandler()
+        for n in range(5):
+            buffer.append(target, logging.makeLogRecord({'msg': n}))
+        buffer.flush()
+        self.assertEqual([record.msg for record, _ in target.emitted], [3, 4])
+        self.assertEqual(buffer.dropped, 3)
+
+    def test_that_oldest_buffers_are_evicted(self):
+        buffers = buffering.RequestBuffers(max_requests=2)
+        first = buffers.open('first')
+        buffers.open('second')
+        buffers.open('third')
+        self.assertIsNone(buffers.get('first'))
+        self.assertEqual(buffers.evicted, 1)
+        self.assertEqual(len(buffers), 2)
+        first.discard()
+        self.assertEqual(len(buffers), 2)
+
+    def test_that_reused_keys_do_not_close_newer_buffers(self):
+        buffers = buffering.RequestBuffers()
+        first = buffers.open('same')
+        second = buffers.open('same')
+        first.discard()
+        self.assertIs(buffers.get('same'), second)
+
+
+class ExplodingRequest(object):
+    method = 'GET'
+    path = '/'
+
+    def request_time(self):
+        return 0.01
+
+    def __getattr__(self, name):
+        raise AssertionError('payload built for disabled logger')
+
+
+class StubHandler(object):
+
+    def __init__(self, status_code=200):
+        self.request = ExplodingRequest()
+        self.status_code = status_code
+
+    def get_status(self):
+        return self.status_code
+
+
+class AccessLogPayloadTests(unittest.TestCase):
+
+    def setUp(self):
+        super(AccessLogPayloadTests, self).setUp()
+        self.access_log = logging.getLogger('tornado.access')
+        self.level = self.access_log.level
+        self.access_log.setLevel(logging.WARNING)
+
+    def tearDown(self):
+        super(AccessLogPayloadTests, self).tearDown()
+        self.access_log.setLevel(self.level)
+
+    def test_that_payload_is_not_built_when_level_is_disabled(self):
+        sprockets.logging.tornado_log_function(StubHandler(200))
+
+    def test_that_access_log_function_skips_disabled_levels(self):
+        policy = sprockets.logging.SamplingPolicy(
+            rate_limits={'/': (0.001, 1)})
+        log_function = sprockets.logging.AccessLogFunction(sampling=policy)
+        log_function(StubHandler(200))
+        self.assertEqual(policy.rate_limits[0][1].tokens, 1.0)
+
+    def test_that_level_follows_status_code(self):
+        self.assertEqual([sprockets.logging.AccessLogPayload(
+            StubHandler(), status, 1.0).level for status in (200, 404, 500)],
+            [logging.INFO, logging.WARNING, logging.ERROR])
+
+    def test_that_log_reports_whether_payload_was_logged(self):
+        payload = sprockets.logging.AccessLogPayload(StubHandler(), 200, 1.0)
+        self.assertFalse(payload.log(self.access_log))
+
+    def test_that_environment_is_read_when_created(self):
+        original = os.environ.get('ENVIRONMENT')
+        os.environ['ENVIRONMENT'] = 'at-setup'
+        try:
+            log_function = sprockets.logging.AccessLogFunction()
+            os.environ['ENVIRONMENT'] = 'changed'
+            self.assertEqual(log_function.environment, 'at-setup')
+        finally:
+            if original is None:
+                os.environ.pop('ENVIRONMENT')
+            else:
+                os.environ['ENVIRONMENT'] = original
+
+
+IMPORT_CHECK = """
+import json, sys
+import sprockets
+before = set(sys.modules)
+import sprockets.logging
+print(json.dumps(sorted(set(sys.modules) - before)))
+"""
+
+
+class ImportTests(unittest.TestCase):
+
+    def test_that_import_does_not_load_heavy_modules(self):
+        output = subprocess.check_output(
+            [sys.executable, '-c', IMPORT_CHECK],
+            env=dict(os.environ, PYTHONPATH=os.path.dirname(
+                os.path.abspath(__file__))))
+        imported = set(json.loads(output.decode('utf-8')))
+        for module in ('tornado', 'json', 'logging.config', 'queue',
+                       'traceback', 'uuid', 'sprockets.logging.encoders',
+                       'sprockets.logging.handlers'):
+            self.assertNotIn(module, imported)
+
+    def test_that_lazy_attributes_are_resolved(self):
+        self.assertIs(sprockets.logging.QueueHandler, handlers.QueueHandler)
+        self.assertIs(sprockets.logging.SamplingPolicy,
+                      sampling.SamplingPolicy)
+        self.assertIs(sprockets.logging.dictConfig,
+                      logging.config.dictConfig)
+        self.assertIs(sprockets.logging.metrics, metrics)
+        self.assertIn('QueueHandler', dir(sprockets.logging))
+
+    def test_that_unknown_attributes_raise_attribute_error(self):
+        with self.assertRaises(AttributeError):
+            getattr(sprockets.logging, 'not_an_attribute')
+
+
+class ConfigureTests(unittest.TestCase):
+
+    def setUp(self):
+        super(ConfigureTests, self).setUp()
+        self.root = logging.getLogger()
+        self.handlers = self.root.handlers[:]
+        self.level = self.root.level
+        self.stream = io.StringIO()
+
+    def tearDown(self):
+        super(ConfigureTests, self).tearDown()
+        for handler in self.root.handlers[:]:
+            if handler not in self.handlers:
+                self.root.removeHandler(handler)
+                handler.close()
+        self.root.setLevel(self.level)
+        logging.getLogger('configure-tests').setLevel(logging.NOTSET)
+        frames.uninstall()
+
+    def test_that_json_pipeline_is_installed(self):
+        pipeline = sprockets.logging.configure(
+            stream=self.stream, properties=['correlation_id'])
+        self.assertIn(pipeline.handler, self.root.handlers)
+        self.assertIs(pipeline.log_function,
+                      sprockets.logging.tornado_log_function)
+        with context.scope(correlation_id='abc'):
+            logging.getLogger('configure-tests').info('hello %s', 'world')
+        output = json.loads(self.stream.getvalue())
+        self.assertEqual(output['message'], 'hello world')
+        self.assertEqual(output['correlation_id'], 'abc')
+
+    def test_that_caller_lookup_is_installed(self):
+        sprockets.logging.configure(stream=self.stream)
+        self.assertIs(logging.currentframe, frames.currentframe)
+        logging.getLogger('configure-tests').warning('caller')
+        output = json.loads(self.stream.getvalue())
+        self.assertEqual(output['module'], 'tests')
+
+    def test_that_caller_lookup_can_be_disabled(self):
+        sprockets.logging.configure(stream=self.stream, find_caller=False)
+        logging.getLogger('configure-tests').warning('no caller')
+        self.assertIsNone(logging._srcfile)
+        self.assertNotIn('line_number', json.loads(self.stream.getvalue()))
+
+    def test_that_spec_and_options_are_merged(self):
+        pipeline = sprockets.logging.configure(
+            {'format': '%(levelname)s %(message)s', 'level': 'ERROR',
+             'levels': {'configure-tests': 'DEBUG'}}, stream=self.stream)
+        self.assertEqual(self.root.level, logging.ERROR)
+        logging.getLogger('configure-tests').debug('detail')
+        self.assertEqual(self.stream.getvalue(), 'DEBUG detail\n')
+        self.assertIsInstance(pipeline.filter,
+                              sprockets.logging.ContextFilter)
+
+    def test_that_queue_handler_can_be_configured(self):
+        pipeline = sprockets.logging.configure(
+            stream=self.stream, handler='queue',
+            queue={'overflow': 'drop-newest', 'flush_interval': 0.01})
+        self.assertIsInstance(pipeline.handler, handlers.QueueHandler)
+        self.assertEqual(pipeline.handler.overflow, 'drop-newest')
+        logging.getLogger('configure-tests').warning('queued')
+        pipeline.handler.flush()
+        self.assertEqual(json.loads(self.stream.getvalue())['message'],
+                         'queued')
+
+    def test_that_access_log_options_build_access_log_function(self):
+        pipeline = sprockets.logging.configure(
+            stream=self.stream, access_log={
+                'sampling': {'status_rates': {'2xx': 0.5}},
+                'redact_headers': ['Authorization']})
+        self.assertIsInstance(pipeline.log_function,
+                              sprockets.logging.AccessLogFunction)
+        self.assertEqual(pipeline.log_function.sampling.get_rate(200, '/'),
+                         0.5)
+
+    def test_that_configuring_again_replaces_the_handler(self):
+        first = sprockets.logging.configure(stream=self.stream)
+        second = sprockets.logging.configure(stream=self.stream)
+        self.assertNotIn(first.handler, self.root.handlers)
+        self.assertIn(second.handler, self.root.handlers)
+
+    def test_that_unknown_keys_are_rejected(self):
+        with self.assertRaises(ValueError):
+            sprockets.logging.configure(colour=True)
+        with self.assertRaises(ValueError):
+            sprockets.logging.configure(handler='socket')
+
+
+def read_available(fd):
+    chunks = []
+    while select_readable(fd):
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def select_readable(fd, timeout=0):
+    return bool(select.select([fd], [], [], timeout)[0])
+
+
+class FileDescriptorHandlerTests(unittest.TestCase):
+
+    def setUp(self):
+        super(FileDescriptorHandlerTests, self).setUp()
+        self.read_fd, self.write_fd = os.pipe()
+        self.writes = []
+        self.original_writev = handlers._writev
+
+        def counting_writev(fd, buffers):
+            self.writes.append(len(buffers))
+            return self.original_writev(fd, buffers)
+        handlers._writev = counting_writev
+        self.handler = None
+
+    def tearDown(self):
+        super(FileDescriptorHandlerTests, self).tearDown()
+        handlers._writev = self.original_writev
+        if self.handler is not None:
+            self.handler.close()
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+    def create_handler(self, **kwargs):
+        kwargs.setdefault('flush_interval', 60)
+        self.handler = handlers.FileDescriptorHandler(self.write_fd, **kwargs)
+        self.handler.setFormatter(sprockets.logging.JSONRequestFormatter())
+        return self.handler
+
+    def log(self, message):
+        self.handler.handle(logging.makeLogRecord({'msg': message}))
+
+    def messages(self, data):
+        return [json.loads(line)['message']
+                for line in data.decode('utf-8').splitlines()]
+
+    def test_that_records_are_written_in_one_call(self):
+        self.create_handler()
+        for n in range(10):
+            self.log('message {0}'.format(n))
+        self.assertEqual(read_available(self.read_fd), b'')
+        self.handler.flush()
+        self.assertEqual(self.messages(read_available(self.read_fd)),
+                         ['message {0}'.format(n) for n in range(10)])
+        self.assertEqual(self.writes, [10])
+
+    def test_that_records_are_written_when_batch_is_full(self):
+        self.create_handler(batch_bytes=2000)
+        for n in range(3):
+            self.log('x' * 1000)
+        self.assertEqual(self.writes, [2])
+        self.assertEqual(len(self.handler._pending), 1)
+
+    def test_that_records_are_written_after_flush_interval(self):
+        self.create_handler(flush_interval=0.01)
+        self.log('eventually')
+        self.assertTrue(select_readable(self.read_fd, 5))
+        self.assertEqual(self.messages(read_available(self.read_fd)),
+                         ['eventually'])
+
+    def fill_pipe(self):
+        os.set_blocking(self.write_fd, False)
+        filled = 0
+        while True:
+            try:
+                filled += os.write(self.write_fd, b'.' * 4096)
+            except BlockingIOError:
+                return filled
+
+    def test_that_full_pipes_do_not_block_or_lose_records(self):
+        filled = self.fill_pipe()
+        self.create_handler(batch_bytes=1)
+        self.log('first')
+        self.log('second')
+        self.assertEqual(len(self.handler._pending), 2)
+        self.assertEqual(len(read_available(self.read_fd)), filled)
+        self.handler.flush()
+        self.assertEqual(self.messages(read_available(self.read_fd)),
+                         ['first', 'second'])
+
+    def test_that_partial_writes_are_resumed(self):
+        filled = self.fill_pipe()
+        drained = len(os.read(self.read_fd, 8192))
+        self.create_handler(batch_bytes=1)
+        self.log('y' * 20000)
+        self.assertIsInstance(self.handler._pending[0], memoryview)
+        data = read_available(self.read_fd)
+        self.handler.flush()
+        data += read_available(self.read_fd)
+        self.assertEqual(self.messages(data[filled - drained:]),
+                         ['y' * 20000])
+
+    def test_that_records_are_dropped_when_too_much_is_pending(self):
+        self.fill_pipe()
+        self.create_handler(batch_bytes=1, max_pending_bytes=1000,
+                            write_timeout=0.01)
+        for n in range(20):
+            self.log('z' * 100)
+        self.assertGreater(self.handler.dropped, 0)
+        self.assertLessEqual(self.handler._pending_bytes, 1000)
+
+    def test_that_paths_are_opened_and_closed(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'output.log')
+        try:
+            handler = handlers.FileDescriptorHandler(path)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            handler.handle(logging.makeLogRecord({'msg': 'to file'}))
+            handler.close()
+            with open(path, 'rb') as output:
+                self.assertEqual(output.read(), b'to file\n')
+            self.assertIsNone(handler.fd)
+        finally:
+            os.unlink(path)
+            os.rmdir(directory)
+
+
+def fail_with(message):
+    raise ValueError(message)
+
+
+class DuplicateFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        super(DuplicateFilterTests, self).setUp()
+        self.recorder = RecordingHandler()
+        self.filter = dedup.DuplicateFilter(window=60)
+        self.logger = logging.getLogger('dedup-tests')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(self.recorder)
+        self.logger.addFilter(self.filter)
+
+    def tearDown(self):
+        super(DuplicateFilterTests, self).tearDown()
+        self.logger.removeHandler(self.recorder)
+        self.logger.removeFilter(self.filter)
+
+    def messages(self):
+        return [record.getMessage() for record, _ in self.recorder.emitted]
+
+    def log_failure(self, message='dependency failed', **kwargs):
+        try:
+            fail_with('connection refused')
+        except ValueError:
+            self.logger.exception(message, **kwargs)
+
+    def test_that_duplicates_are_suppressed(self):
+        for _ in range(100):
+            self.log_failure()
+        self.assertEqual(self.messages(), ['dependency failed'])
+        self.assertEqual(self.filter.suppressed, 99)
+
+    def test_that_different_records_are_not_suppressed(self):
+        self.log_failure()
+        self.log_failure('other failure')
+        self.logger.error('dependency failed')
+        try:
+            raise ValueError('raised elsewhere')
+        except ValueError:
+            self.logger.exception('dependency failed')
+        self.assertEqual(len(self.recorder.emitted), 4)
+
+    def test_that_message_arguments_do_not_affect_fingerprint(self):
+        for n in range(3):
+            self.logger.error('request %d failed', n)
+        self.assertEqual(self.messages(), ['request 0 failed'])
+
+    def test_that_records_below_level_are_not_suppressed(self):
+        for _ in range(3):
+            self.logger.info('progress')
+        self.assertEqual(self.messages(), ['progress'] * 3)
+
+    def test_that_summary_is_logged_when_window_expires(self):
+        self.filter.window = 0.01
+        for _ in range(5):
+            self.log_failure()
+        time.sleep(0.02)
+        self.log_failure()
+        self.assertEqual(self.messages(), [
+            'dependency failed', 'dependency failed (repeated 4 times)',
+            'dependency failed'])
+        summary = self.recorder.emitted[1][0]
+        self.assertEqual(summary.repeated, 4)
+        self.assertEqual(summary.levelno, logging.ERROR)
+        self.assertIsNone(summary.exc_info)
+
+    def test_that_flush_logs_pending_summaries(self):
+        for _ in range(3):
+            self.log_failure()
+        self.logger.warning('once')
+        self.filter.flush()
+        self.assertEqual(self.messages(), [
+            'dependency failed', 'once',
+            'dependency failed (repeated 2 times)'])
+
+    def test_that_oldest_fingerprints_are_evicted(self):
+        self.filter.max_fingerprints = 2
+        self.log_failure('first')
+        self.log_failure('first')
+        self.log_failure('second')
+        self.log_failure('third')
+        self.assertEqual(self.messages(), [
+            'first', 'second', 'first (repeated 1 times)', 'third'])
+        self.assertEqual(len(self.filter._seen), 2)
+
+    def test_that_summary_is_stamped_when_it_is_logged(self):
+        self.filter.window = 0.01
+        self.log_failure()
+        self.log_failure()
+        time.sleep(0.02)
+        self.filter.flush()
+        first, summary = [record for record, _ in self.recorder.emitted]
+        self.assertGreater(summary.created, first.created)
+        self.assertAlmostEqual(
+            summary.msecs, (summary.created - int(summary.created)) * 1000,
+            delta=1)
+        self.assertAlmostEqual(
+            summary.relativeCreated - first.relativeCreated,
+            (summary.created - first.created) * 1000, delta=1)
+        self.assertEqual(summary.lineno, first.lineno)
+
+
+def query_database():
+    with timing.span('database'):
+        time.sleep(0.01)
+
+
+class TimedRequestHandler(timing.RequestTimingMixin, web.RequestHandler):
+
+    @gen.coroutine
+    def prepare(self):
+        super(TimedRequestHandler, self).prepare()
+        yield gen.sleep(0.01)
+
+    @gen.coroutine
+    def get(self):
+        with self.timing_span('cache'):
+            yield gen.sleep(0.01)
+        query_database()
+        query_database()
+        self.write('done')
+
+
+class TimedRedirectHandler(timing.RequestTimingMixin, web.RequestHandler):
+
+    def prepare(self):
+        super(TimedRedirectHandler, self).prepare()
+        self.redirect('/')
+
+
+class TrackedTimedHandler(timing.RequestTimingMixin, web.RequestHandler):
+
+    instances = []
+
+    def prepare(self):
+        super(TrackedTimedHandler, self).prepare()
+        self.instances.append(weakref.ref(self))
+        if self.get_query_argument('redirect', None):
+            self.redirect('/')
+
+    def get(self):
+        self.set_status(204)
+
+
+class RequestTimingTests(TornadoLoggingTestMixin, testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        return web.Application(
+            [web.url('/', TimedRequestHandler),
+             web.url('/redirect', TimedRedirectHandler),
+             web.url('/tracked', TrackedTimedHandler),
+             web.url('/plain', SimpleHandler)],
+            log_function=sprockets.logging.tornado_log_function)
+
+    def access_log_payload(self):
+        for record, _ in self.recorder.emitted:
+            if record.name == 'tornado.access':
+                return record.args
+        self.fail('access log was not written')
+
+    def test_that_phases_are_timed(self):
+        self.fetch('/')
+        timings = self.access_log_payload()['timings']
+        self.assertEqual(sorted(timings), ['dispatch', 'finish', 'handler',
+                                           'prepare', 'spans'])
+        self.assertGreaterEqual(timings['prepare'], 9.0)
+        self.assertGreaterEqual(timings['handler'], 29.0)
+        self.assertGreaterEqual(timings['dispatch'], 0.0)
+
+    def test_that_spans_are_accumulated(self):
+        self.fetch('/')
+        spans = self.access_log_payload()['timings']['spans']
+        self.assertEqual(spans['database']['count'], 2)
+        self.assertGreaterEqual(spans['database']['duration'], 19.0)
+        self.assertEqual(spans['cache']['count'], 1)
+        self.assertGreaterEqual(spans['cache']['duration'], 9.0)
+
+    def test_that_finishing_in_prepare_skips_handler_phase(self):
+        self.fetch('/redirect', follow_redirects=False)
+        timings = self.access_log_payload()['timings']
+        self.assertEqual(sorted(timings),
+                         ['dispatch', 'finish', 'prepare'])
+
+    def test_that_handlers_are_freed_without_garbage_collection(self):
+        TrackedTimedHandler.instances = []
+        gc.collect()
+        gc.disable()
+        try:
+            self.fetch('/tracked')
+            self.fetch('/tracked?redirect=1', follow_redirects=False)
+        finally:
+            gc.enable()
+        self.assertEqual(len(TrackedTimedHandler.instances), 2)
+        self.assertEqual([handler() for handler in
+                          TrackedTimedHandler.instances], [None, None])
+
+    def test_that_handlers_without_mixin_have_no_timings(self):
+        self.fetch('/plain')
+        self.assertNotIn('timings', self.access_log_payload())
+
+    def test_that_access_log_function_includes_timings(self):
+        self._app.settings['log_function'] = \
+            sprockets.logging.AccessLogFunction()
+        self.fetch('/')
+        self.assertIn('timings', self.access_log_payload())
+
+    def test_that_spans_outside_requests_are_not_recorded(self):
+        with timing.span('orphan') as span:
+            pass
+        self.assertIsNone(span.timings)
+
+
+class RequestTimingsTests(unittest.TestCase):
+
+    def test_that_repeated_phases_are_summed(self):
+        timings = timing.RequestTimings(1.5)
+        timings.mark('handler')
+        timings.mark('prepare')
+        result = timings.as_dict()
+        self.assertEqual(result['dispatch'], 1.5)
+        self.assertEqual(sorted(result), ['dispatch', 'handler', 'prepare'])
+
+    def test_that_spans_can_be_added_directly(self):
+        timings = timing.RequestTimings(0.0)
+        timings.add('remote', 2.0)
+        timings.add('remote', 3.0)
+        self.assertEqual(timings.as_dict()['spans'],
+                         {'remote': {'count': 2, 'duration': 5.0}})
+
+
+def block_the_ioloop(seconds):
+    time.sleep(seconds)
+
+
+SAMPLER = profiling.StackSampler(interval=0.002)
+
+
+class ProfiledRequestHandler(profiling.ProfilingMixin, web.RequestHandler):
+
+    profiler = SAMPLER
+    profile_threshold = 20
+
+    @gen.coroutine
+    def prepare(self):
+        yield super(ProfiledRequestHandler, self).prepare()
+
+    @gen.coroutine
+    def get(self):
+        yield gen.moment
+        block_the_ioloop(float(self.get_query_argument('seconds', '0.05')))
+        self.set_status(204)
+
+
+class TimedProfiledRequestHandler(timing.RequestTimingMixin,
+                                  ProfiledRequestHandler):
+    pass
+
+
+class ProfilingTests(TornadoLoggingTestMixin, testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        super(ProfilingTests, self).setUp()
+        SAMPLER.start()
+
+    def tearDown(self):
+        SAMPLER.stop()
+        super(ProfilingTests, self).tearDown()
+
+    def get_app(self):
+        return web.Application(
+            [web.url('/', ProfiledRequestHandler),
+             web.url('/timed', TimedProfiledRequestHandler)],
+            log_function=sprockets.logging.tornado_log_function)
+
+    def access_log_payload(self):
+        for record, _ in self.recorder.emitted:
+            if record.name == 'tornado.access':
+                return record.args
+        self.fail('access log was not written')
+
+    def test_that_slow_requests_include_profile(self):
+        self.fetch('/')
+        profile = self.access_log_payload()['profile']
+        self.assertEqual(profile['interval'], 2.0)
+        self.assertGreater(profile['samples'], 0)
+        self.assertEqual(sum(int(line.rsplit(' ', 1)[1])
+                             for line in profile['stacks']),
+                         profile['samples'])
+        top = profile['stacks'][0]
+        self.assertTrue(top.startswith('ProfiledRequestHandler.get ('), top)
+        self.assertIn(';block_the_ioloop (', top)
+
+    def test_that_fast_requests_do_not_include_profile(self):
+        self.fetch('/?seconds=0')
+        self.assertNotIn('profile', self.access_log_payload())
+
+    def test_that_requests_are_unregistered(self):
+        self.fetch('/')
+        self.fetch('/?seconds=0')
+        self.assertEqual(SAMPLER._requests, {})
+
+    def test_that_profiling_is_skipped_when_sampler_is_stopped(self):
+        SAMPLER.stop()
+        self.fetch('/')
+        self.assertNotIn('profile', self.access_log_payload())
+
+    def test_that_profile_combines_with_timings(self):
+        self.fetch('/timed')
+        payload = self.access_log_payload()
+        self.assertIn('profile', payload)
+        self.assertIn('timings', payload)
+
+
+class SampledObject(object):
+
+    def run(self, sampler):
+        return self.nested(sampler)
+
+    def nested(self, sampler):
+        sampler.sample()
+
+
+class StackSamplerTests(unittest.TestCase):
+
+    def setUp(self):
+        super(StackSamplerTests, self).setUp()
+        self.sampler = profiling.StackSampler()
+        self.sampler.thread_id = threading.current_thread().ident
+
+    def test_that_samples_outside_registered_methods_are_unattributed(self):
+        self.sampler.register(SampledObject())
+        self.sampler.sample()
+        self.assertEqual(self.sampler.unattributed, 1)
+
+    def test_that_samples_are_counted_for_the_running_instance(self):
+        running, idle = SampledObject(), SampledObject()
+        profile = self.sampler.register(running)
+        other = self.sampler.register(idle)
+        running.run(self.sampler)
+        running.run(self.sampler)
+        self.assertEqual(profile.total, 2)
+        self.assertEqual(other.total, 0)
+        (stack, count), = profile.samples.items()
+        self.assertEqual(count, 2)
+        self.assertEqual([code.co_name for code, _ in stack],
+                         ['run', 'nested', 'sample'])
+
+    def test_that_stacks_are_limited_to_max_depth(self):
+        self.sampler.max_depth = 1
+        profile = self.sampler.register(SampledObject())
+        SampledObject.run(next(iter(self.sampler._requests)), self.sampler)
+        (stack, _), = profile.samples.items()
+        self.assertEqual([code.co_name for code, _ in stack], ['sample'])
+
+    def test_that_unregistered_instances_are_not_sampled(self):
+        target = SampledObject()
+        profile = self.sampler.register(target)
+        self.sampler.unregister(target)
+        target.run(self.sampler)
+        self.assertEqual(profile.total, 0)
+
+    def test_that_collapsed_stacks_are_ordered_by_count(self):
+        profile = profiling.RequestProfile()
+        outer = (sys._getframe().f_code, 10)
+        profile.add((outer,))
+        profile.add((outer, (block_the_ioloop.__code__, 2)))
+        profile.add((outer, (block_the_ioloop.__code__, 2)))
+        lines = profile.collapsed(limit=1)
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith(';block_the_ioloop ({0}:2) 2'.format(
+            block_the_ioloop.__code__.co_filename)), lines[0])
+
+
+class CollectingBatchHandler(handlers.BatchingHandler):
+    terminator = b';'
+
+    def __init__(self, **kwargs):
+        super(CollectingBatchHandler, self).__init__(**kwargs)
+        self.batches = []
+        self.finished = False
+
+    def write_pending(self):
+        batch = self._take_pending()
+        if batch:
+            self.batches.append(b''.join(batch))
+
+    def _finish(self):
+        super(CollectingBatchHandler, self)._finish()
+        self.finished = True
+
+
+class BatchingHandlerTests(unittest.TestCase):
+
+    def setUp(self):
+        super(BatchingHandlerTests, self).setUp()
+        self.handler = CollectingBatchHandler(
+            batch_bytes=1024, flush_interval=60, max_pending_bytes=6)
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+
+    def tearDown(self):
+        super(BatchingHandlerTests, self).tearDown()
+        self.handler.close()
+
+    def emit(self, message):
+        self.handler.handle(logging.makeLogRecord({'msg': message}))
+
+    def test_that_records_are_written_in_batches(self):
+        self.emit('a')
+        self.emit('b')
+        self.handler.flush()
+        self.emit('c')
+        self.handler.close()
+        self.assertEqual(self.handler.batches, [b'a;b;', b'c;'])
+        self.assertTrue(self.handler.finished)
+
+    def test_that_records_beyond_the_pending_limit_are_dropped(self):
+        for message in ('one', 'two', 'six'):
+            self.emit(message)
+        self.handler.flush()
+        self.assertEqual(self.handler.batches, [b'one;'])
+        self.assertEqual(self.handler.dropped, 2)
+
+    def test_that_the_thread_is_named_after_the_class(self):
+        self.emit('a')
+        self.assertEqual(self.handler._thread.name,
+                         'sprockets.logging.CollectingBatchHandler')
+
+
+class CompressedRotatingFileHandlerTests(unittest.TestCase):
+
+    def setUp(self):
+        super(CompressedRotatingFileHandlerTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.handler = None
+
+    def tearDown(self):
+        super(CompressedRotatingFileHandlerTests, self).tearDown()
+        if self.handler is not None:
+            self.handler.close()
+        shutil.rmtree(self.directory)
+
+    def create_handler(self, **kwargs):
+        kwargs.setdefault('flush_interval', 60)
+        self.handler = rotating.CompressedRotatingFileHandler(
+            self.directory, prefix='test', **kwargs)
+        self.handler.setFormatter(sprockets.logging.JSONRequestFormatter())
+        return self.handler
+
+    def log(self, *messages):
+        for message in messages:
+            self.handler.handle(logging.makeLogRecord(
+                {'name': 'archive', 'msg': message,
+                 'levelno': logging.INFO, 'levelname': 'INFO'}))
+
+    def files(self, suffix=''):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith(suffix))
+
+    def read_messages(self):
+        messages = []
+        for name in self.files('.ndjson.gz'):
+            with gzip.open(os.path.join(self.directory, name)) as handle:
+                messages.extend(json.loads(line.decode('utf-8'))['message']
+                                for line in handle)
+        return messages
+
+    def test_that_close_publishes_the_segment(self):
+        self.create_handler()
+        self.log('one', 'two')
+        self.handler.close()
+        self.handler = None
+        self.assertEqual(self.files('.tmp'), [])
+        self.assertEqual(len(self.files('.ndjson.gz')), 1)
+        self.assertEqual(self.read_messages(), ['one', 'two'])
+
+    def test_that_close_does_not_need_the_handler_lock(self):
+        # logging.shutdown holds the handler lock while calling close
+        self.create_handler(flush_interval=0.01)
+        self.log('shutdown')
+        self.handler.acquire()
+        try:
+            self.handler.close()
+        finally:
+            self.handler.release()
+        self.handler = None
+        self.assertEqual(self.read_messages(), ['shutdown'])
+
+    def test_that_open_segment_is_not_published(self):
+        self.create_handler()
+        self.log('pending')
+        self.handler.flush()
+        self.assertEqual(self.files('.ndjson.gz'), [])
+        self.assertEqual(len(self.files('.ndjson.gz.tmp')), 1)
+
+    def test_that_segments_rotate_by_size(self):
+        self.create_handler(max_bytes=1)
+        for message in ('first', 'second', 'third'):
+            self.log(message)
+            self.handler.flush()
+        self.assertEqual(len(self.files('.ndjson.gz')), 3)
+        self.assertEqual(self.files('.tmp'), [])
+        self.assertEqual(self.read_messages(), ['first', 'second', 'third'])
+
+    def test_that_segments_rotate_by_age(self):
+        self.create_handler(interval=0.05, flush_interval=0.01)
+        self.log('old')
+        deadline = time.time() + 5
+        while not self.files('.ndjson.gz') and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.read_messages(), ['old'])
+        self.assertEqual(self.files('.tmp'), [])
+
+    def test_that_full_batches_wake_the_compression_thread(self):
+        self.create_handler(batch_bytes=1)
+        self.log('wake')
+        deadline = time.time() + 5
+        while self.handler._pending and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.handler._pending, [])
+        self.assertEqual(len(self.files('.tmp')), 1)
+
+    def test_that_records_are_dropped_when_pending_bytes_are_full(self):
+        self.create_handler(max_pending_bytes=10)
+        self.log('this record is larger than ten bytes')
+        self.assertEqual(self.handler.dropped, 1)
+
+    def test_that_unknown_compression_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.create_handler(compression='lzma')
+
+    def test_that_auto_selects_an_available_codec(self):
+        handler = self.create_handler(compression='auto')
+        try:
+            rotating._zstd_compressor(None)
+        except ImportError:
+            self.assertEqual(handler.compression, rotating.GZIP)
+        else:
+            self.assertEqual(handler.compression, rotating.ZSTD)
+
+
+class FakeCollector(object):
+    """Receives what a ShippingHandler sends."""
+
+    def __init__(self, family, socket_type, address):
+        self.socket = socket.socket(family, socket_type)
+        self.socket.bind(address)
+        self.address = self.socket.getsockname()
+        self.connection = None
+        if socket_type == socket.SOCK_STREAM:
+            self.socket.listen(1)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.socket.close()
+
+    def receive_datagrams(self):
+        datagrams = []
+        while select_readable(self.socket, 0.2):
+            datagrams.append(self.socket.recv(1 << 20))
+        return datagrams
+
+    def receive_frames(self, count):
+        if self.connection is None:
+            self.connection, _ = self.socket.accept()
+        data, frames = b'', []
+        while len(frames) < count and select_readable(self.connection, 5):
+            data += self.connection.recv(65536)
+            while len(data) >= 4:
+                size, = struct.unpack('>I', data[:4])
+                if len(data) < 4 + size:
+                    break
+                frames.append(data[4:4 + size])
+                data = data[4 + size:]
+        return frames
+
+
+class ShippingHandlerTests(unittest.TestCase):
+
+    def setUp(self):
+        super(ShippingHandlerTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.collector = None
+        self.handler = None
+
+    def tearDown(self):
+        super(ShippingHandlerTests, self).tearDown()
+        if self.handler is not None:
+            self.handler.close()
+        if self.collector is not None:
+            self.collector.close()
+        shutil.rmtree(self.directory)
+
+    def create_handler(self, address, **kwargs):
+        kwargs.setdefault('flush_interval', 60)
+        self.handler = shipping.ShippingHandler(address, **kwargs)
+        self.handler.setFormatter(sprockets.logging.JSONRequestFormatter())
+        return self.handler
+
+    def log(self, *messages):
+        for message in messages:
+            self.handler.handle(logging.makeLogRecord(
+                {'name': 'shipping', 'msg': message,
+                 'levelno': logging.INFO, 'levelname': 'INFO'}))
+
+    def messages(self, datagrams):
+        return [json.loads(line.decode('utf-8'))['message']
+                for datagram in datagrams
+                for line in datagram.splitlines()]
+
+    def test_that_udp_records_are_packed_into_datagrams(self):
+        self.collector = FakeCollector(socket.AF_INET, socket.SOCK_DGRAM,
+                                       ('127.0.0.1', 0))
+        self.create_handler(self.collector.address, max_datagram_size=1000)
+        expected = ['message {0}'.format(index) for index in range(20)]
+        self.log(*expected)
+        self.assertTrue(self.handler.send_pending())
+        datagrams = self.collector.receive_datagrams()
+        self.assertGreater(len(datagrams), 1)
+        self.assertLess(len(datagrams), 20)
+        self.assertTrue(all(len(datagram) <= 1000 for datagram in datagrams))
+        self.assertEqual(self.messages(datagrams), expected)
+        self.assertEqual(self.handler.sent, 20)
+
+    def test_that_unix_datagrams_are_sent(self):
+        path = os.path.join(self.directory, 'collector.sock')
+        self.collector = FakeCollector(socket.AF_UNIX, socket.SOCK_DGRAM,
+                                       path)
+        self.create_handler(path, transport=shipping.UNIX_DATAGRAM)
+        self.log('one', 'two')
+        self.handler.flush()
+        datagrams = self.collector.receive_datagrams()
+        self.assertEqual(len(datagrams), 1)
+        self.assertEqual(self.messages(datagrams), ['one', 'two'])
+
+    def test_that_oversized_datagrams_are_counted(self):
+        path = os.path.join(self.directory, 'collector.sock')
+        self.collector = FakeCollector(socket.AF_UNIX, socket.SOCK_DGRAM,
+                                       path)
+        self.create_handler(path, transport=shipping.UNIX_DATAGRAM)
+        self.log('x' * (4 << 20), 'fits')
+        self.assertTrue(self.handler.send_pending())
+        self.assertEqual(self.handler.dropped, 1)
+        self.assertEqual(
+            self.messages(self.collector.receive_datagrams()), ['fits'])
+
+    def test_that_tcp_records_are_framed(self):
+        self.collector = FakeCollector(socket.AF_INET, socket.SOCK_STREAM,
+                                       ('127.0.0.1', 0))
+        self.create_handler(self.collector.address, transport=shipping.TCP)
+        self.log('one', 'two', 'three')
+        self.assertTrue(self.handler.send_pending())
+        self.assertEqual(self.messages(self.collector.receive_frames(3)),
+                         ['one', 'two', 'three'])
+
+    def test_that_unix_stream_reaches_a_log_funnel(self):
+        output = io.BytesIO()
+        log_funnel = funnel.LogFunnel(output)
+        log_funnel.start()
+        try:
+            self.create_handler(log_funnel.path, transport=shipping.UNIX)
+            self.log('one', 'two')
+            self.handler.close()
+            self.handler = None
+        finally:
+            log_funnel.stop()
+        self.assertEqual(self.messages([output.getvalue()]), ['one', 'two'])
+
+    def test_that_records_wait_for_the_collector(self):
+        path = os.path.join(self.directory, 'collector.sock')
+        self.create_handler(path, transport=shipping.UNIX, min_backoff=1,
+                            max_backoff=3)
+        self.log('waiting')
+        self.assertFalse(self.handler.send_pending())
+        self.assertFalse(self.handler.send_pending())
+        self.assertEqual(self.handler.failures, 1)
+        self.assertEqual(self.handler._delay, 1)
+        for delay in (2, 3, 3):
+            self.assertFalse(self.handler.send_pending(force=True))
+            self.assertEqual(self.handler._delay, delay)
+
+        output = io.BytesIO()
+        log_funnel = funnel.LogFunnel(output, path=path)
+        log_funnel.start()
+        try:
+            self.assertTrue(self.handler.send_pending(force=True))
+            self.assertEqual(self.handler._delay, 0)
+            self.handler.close()
+            self.handler = None
+        finally:
+            log_funnel.stop()
+        self.assertEqual(self.messages([output.getvalue()]), ['waiting'])
+
+    def test_that_overflow_is_counted_while_disconnected(self):
+        path = os.path.join(self.directory, 'collector.sock')
+        self.create_handler(path, transport=shipping.UNIX,
+                            max_pending_bytes=200)
+        self.log(*['message {0}'.format(index) for index in range(10)])
+        self.assertGreater(self.handler.dropped, 0)
+        self.assertEqual(self.handler.dropped + len(self.handler._pending),
+                         10)
+
+    def test_that_close_counts_unsent_records(self):
+        path = os.path.join(self.directory, 'collector.sock')
+        self.create_handler(path, transport=shipping.UNIX)
+        self.log('lost', 'also lost')
+        self.handler.close()
+        self.assertEqual(self.handler.dropped, 2)
+        self.handler = None
+
+    def test_that_unknown_transports_are_rejected(self):
+        with self.assertRaises(ValueError):
+            shipping.ShippingHandler(('127.0.0.1', 1), transport='carrier')
+
+    def test_that_large_records_are_packed_alone(self):
+        packed = list(shipping.pack_datagrams([b'a', b'b' * 10, b'c'], 5))
+        self.assertEqual(packed, [(b'a\n', 1), (b'b' * 10 + b'\n', 1),
+                                  (b'c\n', 1)])